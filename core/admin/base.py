@@ -110,6 +110,7 @@ class SAISAdminSite(admin.AdminSite):
                 processing=Count('id', filter=Q(sync_state='PROCESSING')),
                 idle=Count('id', filter=Q(sync_state='IDLE')),
                 retry_waiting=Count('id', filter=Q(sync_state='RETRY_WAITING')),
+                parked=Count('id', filter=Q(sync_state='PARKED')),
                 retry_1=Count('id', filter=Q(sync_state='RETRY_WAITING', retry_count=1)),
                 retry_2=Count('id', filter=Q(sync_state='RETRY_WAITING', retry_count=2)),
                 retry_3=Count('id', filter=Q(sync_state='RETRY_WAITING', retry_count=3)),
@@ -121,7 +122,9 @@ class SAISAdminSite(admin.AdminSite):
 
             # PERFORMANCE: Use annotate(Count) to avoid N+1 queries when calculating gateway loads.
             # We fetch the list to perform just-in-time online status calculation in Python.
-            gateways = list(gateways_qs.annotate(tag_count_ann=Count('tags')))
+            # Live heartbeat telemetry (core/gateway_telemetry.py) overlaid in one round trip
+            from ..gateway_telemetry import apply as apply_live_telemetry
+            gateways = apply_live_telemetry(gateways_qs.annotate(tag_count_ann=Count('tags')))
             gateway_count = len(gateways)
             active_gateways = sum(1 for gw in gateways if gw.is_currently_online())
 
@@ -156,9 +159,13 @@ class SAISAdminSite(admin.AdminSite):
                 date_done__gte=timezone.now() - timezone.timedelta(days=1)
             ).order_by('-date_done')[:10]
 
+            # INGESTION HEALTH: Published by the MQTT worker (see core/ingestion.py)
+            from ..ingestion import get_metrics as get_ingest_metrics
+
             context = {
                 'active_store': active_store,
                 'recent_failures': recent_failures,
+                'ingest_metrics': get_ingest_metrics(),
                 'gateway_count': gateway_count,
                 'active_gateways': active_gateways,
                 'tag_count': tag_count,
@@ -175,6 +182,7 @@ class SAISAdminSite(admin.AdminSite):
                     'processing': tag_stats['processing'],
                     'idle': tag_stats['idle'],
                     'retry_waiting': tag_stats['retry_waiting'],
+                    'parked': tag_stats['parked'],
                     'retry_1': tag_stats['retry_1'],
                     'retry_2': tag_stats['retry_2'],
                     'retry_3': tag_stats['retry_3'],
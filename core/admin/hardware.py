@@ -9,6 +9,8 @@ from .mixins import StoreFilteredAdmin
 from ..models import Gateway, TagHardware, ESLTag
 from ..views import download_tag_template, preview_tag_import, bulk_map_tags_view, configure_gateway_view
 from ..tasks import update_tag_image_task
+from ..delivery_queue import PRIORITY_INTERACTIVE, PRIORITY_TEMPLATE, PRIORITY_BULK
+from .. import gateway_telemetry
 import time
 import logging
 
@@ -81,7 +83,8 @@ class GatewayAdmin(CompanySecurityMixin, UIHelperMixin, StoreFilteredAdmin):
         ('General', {'fields': ('estation_id', 'name', 'alias', 'store')}),
         ('Technical', {'fields': (
             'gateway_mac', 'gateway_ip', 'app_server_ip', 'app_server_port',
-            'ap_type', 'ap_version', 'module_version', 'disk_size', 'free_space', 'heartbeat_interval'
+            'ap_type', 'ap_version', 'module_version', 'disk_size', 'free_space', 'heartbeat_interval',
+            'payload_encoding'
         )}),
         ('Monitoring', {'fields': ('tags_queued_count', 'tags_comm_count', 'last_error_message', 'last_error_code', 'last_error_timestamp')}),
         ('Credentials', {'fields': ('username', 'password')}),
@@ -93,6 +96,18 @@ class GatewayAdmin(CompanySecurityMixin, UIHelperMixin, StoreFilteredAdmin):
         ('Audit', {'fields': ('created_at', 'updated_at', 'updated_by')}),
     )
 
+    def get_changelist_instance(self, request):
+        """Live heartbeat telemetry for the whole page in one Redis round trip."""
+        changelist = super().get_changelist_instance(request)
+        gateway_telemetry.apply(changelist.result_list)
+        return changelist
+
+    def get_object(self, request, object_id, from_field=None):
+        obj = super().get_object(request, object_id, from_field)
+        if obj is not None:
+            gateway_telemetry.apply([obj])
+        return obj
+
     def status_indicator(self, obj):
         """Visual Dot showing online status with descriptive labels."""
         status_code, text, color = obj.get_real_time_status()
@@ -262,7 +277,8 @@ class ESLTagAdmin(CompanySecurityMixin, UIHelperMixin, StoreFilteredAdmin):
             color_map = {
                 'SUCCESS': '#059669', 'PROCESSING': '#2563eb', 'PUSHED': '#7c3aed',
                 'IDLE': '#a2a2a3', 'GEN_FAILED': '#f50000', 'PUSH_FAILED': '#f50000',
-                'IMAGE_READY': '#f5ac00', 'FAILED': '#f50000', 'RETRY_WAITING': '#f5ac00'
+                'IMAGE_READY': '#f5ac00', 'FAILED': '#f50000', 'RETRY_WAITING': '#f5ac00',
+                'PARKED': '#f5ac00'
             }
             color = color_map.get(obj.sync_state, '#ea580c')
             status_text = obj.get_sync_state_display()
@@ -330,6 +346,7 @@ class ESLTagAdmin(CompanySecurityMixin, UIHelperMixin, StoreFilteredAdmin):
 
         # GATEWAY STATUS VALIDATION
         if tag.gateway:
+            gateway_telemetry.apply([tag.gateway])
             status, label, _ = tag.gateway.get_real_time_status()
             if status == 'OFFLINE':
                 messages.warning(request, f"Warning: Gateway {tag.gateway.estation_id} is OFFLINE. Update may be delayed.")
@@ -340,7 +357,8 @@ class ESLTagAdmin(CompanySecurityMixin, UIHelperMixin, StoreFilteredAdmin):
         else:
             messages.warning(request, "Warning: This tag has no assigned gateway. It will try to find one automatically.")
 
-        update_tag_image_task.delay(object_id) # Queue the task
+        # Front of the gateway queue; forced, so the image is sent even if the tag should already show it
+        update_tag_image_task.delay(object_id, priority=PRIORITY_INTERACTIVE, force=True)
         return redirect(request.META.get('HTTP_REFERER', 'admin:index'))
 
     def get_urls(self):
@@ -369,7 +387,9 @@ class ESLTagAdmin(CompanySecurityMixin, UIHelperMixin, StoreFilteredAdmin):
             offline_gateways = set()
             # Performance: Iterate once to collect IDs and check gateway status
             # Uses prefetched 'gateway' from get_queryset()
-            for tag in queryset[:101]:
+            tags = list(queryset[:101])
+            gateway_telemetry.apply([tag.gateway for tag in tags if tag.gateway])
+            for tag in tags:
                 tag_ids.append(tag.id)
                 if tag.gateway and not tag.gateway.is_currently_online():
                     offline_gateways.add(tag.gateway.estation_id)
@@ -380,7 +400,7 @@ class ESLTagAdmin(CompanySecurityMixin, UIHelperMixin, StoreFilteredAdmin):
                 return
 
             if tag_ids:
-                trigger_bulk_sync(tag_ids)
+                trigger_bulk_sync(tag_ids, priority=PRIORITY_INTERACTIVE, force=True)
 
             if offline_gateways:
                 self.message_user(
@@ -424,7 +444,7 @@ class ESLTagAdmin(CompanySecurityMixin, UIHelperMixin, StoreFilteredAdmin):
             # Safety limit: max 500 for ALL refresh to prevent queue flooding
             tag_ids = list(tags.values_list('id', flat=True)[:500])
             if tag_ids:
-                trigger_bulk_sync(tag_ids)
+                trigger_bulk_sync(tag_ids, priority=PRIORITY_BULK)
             self.message_user(request, f"Queued refresh for {min(count, 500)} tags in {request.active_store.name}.")
         except Exception as e:
             logger.exception("Error in refresh_all_store_tags")
@@ -445,7 +465,7 @@ class ESLTagAdmin(CompanySecurityMixin, UIHelperMixin, StoreFilteredAdmin):
             # Sync only tags with products (Max 500)
             tag_ids = list(tags.filter(paired_product__isnull=False).values_list('id', flat=True)[:500])
             if tag_ids:
-                trigger_bulk_sync(tag_ids)
+                trigger_bulk_sync(tag_ids, priority=PRIORITY_TEMPLATE)
             self.message_user(request, f"Updated {count} tags to V1 and queued sync for paired tags.")
         except Exception as e:
             logger.exception("Error in set_all_template_v1")
@@ -466,7 +486,7 @@ class ESLTagAdmin(CompanySecurityMixin, UIHelperMixin, StoreFilteredAdmin):
             # Sync only tags with products (Max 500)
             tag_ids = list(tags.filter(paired_product__isnull=False).values_list('id', flat=True)[:500])
             if tag_ids:
-                trigger_bulk_sync(tag_ids)
+                trigger_bulk_sync(tag_ids, priority=PRIORITY_TEMPLATE)
             self.message_user(request, f"Updated {count} tags to V2 and queued sync for paired tags.")
         except Exception as e:
             logger.exception("Error in set_all_template_v2")
@@ -487,7 +507,7 @@ class ESLTagAdmin(CompanySecurityMixin, UIHelperMixin, StoreFilteredAdmin):
             # Sync only tags with products (Max 500)
             tag_ids = list(tags.filter(paired_product__isnull=False).values_list('id', flat=True)[:500])
             if tag_ids:
-                trigger_bulk_sync(tag_ids)
+                trigger_bulk_sync(tag_ids, priority=PRIORITY_TEMPLATE)
             self.message_user(request, f"Updated {count} tags to V3 and queued sync for paired tags.")
         except Exception as e:
             logger.exception("Error in set_all_template_v3")
@@ -107,6 +107,7 @@ class ProductAdmin(CompanySecurityMixin, UIHelperMixin, StoreFilteredAdmin):
             raise PermissionDenied
         try:
             from ..utils import trigger_bulk_sync
+            from ..delivery_queue import PRIORITY_INTERACTIVE
             count = queryset.count()
             if count > 100:
                 self.message_user(request, "Error: Please select maximum 100 items.", messages.ERROR)
@@ -116,7 +117,7 @@ class ProductAdmin(CompanySecurityMixin, UIHelperMixin, StoreFilteredAdmin):
             tag_ids = list(ESLTag.objects.filter(paired_product__in=queryset).values_list('id', flat=True))
 
             if tag_ids:
-                trigger_bulk_sync(tag_ids) # Dispatch to Celery
+                trigger_bulk_sync(tag_ids, priority=PRIORITY_INTERACTIVE) # Dispatch to Celery
                 self.message_user(request, f"Queued {len(tag_ids)} tag updates across {count} products.")
             else:
                 self.message_user(request, "No paired tags found for selected products.", messages.WARNING)
@@ -50,7 +50,7 @@ class StoreAdmin(CompanySecurityMixin, admin.ModelAdmin):
     --------------------------------
     Manages the individual stores within a company.
     """
-    list_display = ('name', 'company', 'location_code', 'is_active', 'created_at', 'updated_at', 'updated_by')
+    list_display = ('name', 'company', 'location_code', 'is_active', 'coalesce_window_seconds', 'created_at', 'updated_at', 'updated_by')
     list_editable = ('location_code', 'is_active')
     readonly_fields = ('created_at', 'updated_at', 'updated_by')
 
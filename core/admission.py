@@ -0,0 +1,89 @@
+import logging
+from django.core.cache import cache
+from .models import ESLTag, Gateway
+from . import gateway_telemetry
+
+"""
+ADMISSION CONTROL: DON'T RENDER WHAT CAN'T BE DELIVERED
+-------------------------------------------------------
+The pipeline used to render a tag's image first and only find out at
+dispatch time that every gateway of the store was offline. The render
+was wasted, and by the time the store came back the image was often
+stale anyway.
+
+Render entry points (trigger_bulk_sync, update_tag_image_task,
+render_tag_batch_task, the render farm) now ask first whether the
+tag's store can be reached at all. Tags of unreachable stores are PARKED
+without rendering.
+
+Parking coalesces naturally: a tag is parked once no matter how many
+price changes arrive while the store is offline. When a gateway
+reconnects, release_store_backlog() renders every parked tag once, with
+the content current at that moment (see core/retries.py).
+
+Reachability comes from a per-store snapshot in the shared cache
+(refreshed every 'SNAPSHOT_TIMEOUT' seconds and cleared on reconnect),
+so admission costs no queries for a burst of updates.
+"""
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_TIMEOUT = 15
+
+# Tags mid-pipeline keep their state; dispatch parks them if needed
+IN_FLIGHT_STATES = ['PROCESSING', 'IMAGE_READY']
+
+
+def _snapshot_key(store_id):
+    return f"store_reachable_{store_id}"
+
+
+def get_reachable_stores(store_ids):
+    """Returns the subset of 'store_ids' with at least one online gateway."""
+    store_ids = {s for s in store_ids if s is not None}
+    if not store_ids:
+        return set()
+
+    keys = {_snapshot_key(s): s for s in store_ids}
+    cached = cache.get_many(list(keys))
+    snapshot = {keys[k]: v for k, v in cached.items()}
+
+    missing = store_ids - set(snapshot)
+    if missing:
+        fresh = dict.fromkeys(missing, False)
+        # Live heartbeat telemetry for all gateways in one round trip
+        for gateway in gateway_telemetry.apply(Gateway.objects.filter(store_id__in=missing)):
+            if gateway.is_currently_online():
+                fresh[gateway.store_id] = True
+        cache.set_many({_snapshot_key(s): v for s, v in fresh.items()}, SNAPSHOT_TIMEOUT)
+        snapshot.update(fresh)
+
+    return {s for s, reachable in snapshot.items() if reachable}
+
+
+def is_store_reachable(store_id):
+    return store_id is None or store_id in get_reachable_stores([store_id])
+
+
+def forget_store(store_id):
+    """Drops the cached snapshot (a gateway of the store just reconnected)."""
+    cache.delete(_snapshot_key(store_id))
+
+
+def admit(tag_stores):
+    """
+    Splits tags into those worth rendering now and those to defer.
+    'tag_stores' is a list of (tag_id, store_id). Deferred tags are
+    PARKED; returns the admitted IDs in their original order.
+    Tags without a store are admitted (dispatch decides for them).
+    """
+    reachable = get_reachable_stores(store_id for _, store_id in tag_stores)
+
+    admitted, deferred = [], []
+    for tag_id, store_id in tag_stores:
+        (admitted if store_id is None or store_id in reachable else deferred).append(tag_id)
+
+    if deferred:
+        parked = ESLTag.objects.filter(pk__in=deferred).exclude(sync_state__in=IN_FLIGHT_STATES).update(sync_state='PARKED')
+        logger.info(f"Admission: {parked} tags parked until their store's gateways reconnect")
+    return admitted
@@ -0,0 +1,101 @@
+import logging
+from django.core.cache import cache
+from django.db.models import Value
+from django.db.models.functions import Greatest, Least
+from django.utils import timezone
+from .models import TagBatteryDaily
+
+"""
+DOWNSAMPLED BATTERY HISTORY
+---------------------------
+Gateways repeat the battery level of every tag they hear in each
+heartbeat, hundreds of tags every 15 seconds. ESLTag.battery_level only
+holds the latest value, so trends (a tag draining faster than its
+neighbours) used to be invisible, and storing every sample would be the
+largest table in the system.
+
+'record_samples()' keeps one TagBatteryDaily row per tag and day with
+the lowest and highest level seen that day:
+- The current range of each tag is remembered in the shared cache
+  ('batt_day_<YYYYMMDD>_<tag_id>'), so a sample inside the known range
+  costs no query at all. That is nearly every sample.
+- The first sample of a tag on a day creates its row (one bulk INSERT
+  for the whole batch, read back in one query in case another worker
+  created a row first).
+- A sample outside the range widens the row with Least()/Greatest() in
+  the UPDATE itself, so concurrent workers never shrink a range.
+
+Rows are only ever added or widened, never rewritten with older values.
+History older than 'BATTERY_HISTORY_DAYS' (GlobalSetting, default 365)
+is purged by cleanup_old_logs_task.
+"""
+
+logger = logging.getLogger(__name__)
+
+# A day's range stays useful until the day is over (plus clock skew)
+RANGE_CACHE_TIMEOUT = 2 * 86400
+
+
+def _range_key(day, tag_id):
+    return f"batt_day_{day:%Y%m%d}_{tag_id}"
+
+
+def record_samples(samples, day=None):
+    """
+    Folds battery samples ({tag_id: level}) into the daily min/max rows.
+    Returns the number of rows created or widened.
+    """
+    if not samples:
+        return 0
+    day = day or timezone.localdate()
+
+    keys = {_range_key(day, tag_id): tag_id for tag_id in samples}
+    known = {keys[k]: tuple(v) for k, v in cache.get_many(list(keys)).items()}
+
+    # Cache misses: the row may exist already (restart, evicted key)
+    missing = [tag_id for tag_id in samples if tag_id not in known]
+    if missing:
+        for tag_id, low, high in TagBatteryDaily.objects.filter(day=day, tag_id__in=missing).values_list('tag_id', 'min_level', 'max_level'):
+            known[tag_id] = (low, high)
+
+    to_create, widened, changed = [], [], {}
+    for tag_id, level in samples.items():
+        current = known.get(tag_id)
+        if current is None:
+            to_create.append(TagBatteryDaily(tag_id=tag_id, day=day, min_level=level, max_level=level))
+            changed[tag_id] = (level, level)
+        elif level < current[0] or level > current[1]:
+            widened.append((tag_id, level))
+            changed[tag_id] = (min(level, current[0]), max(level, current[1]))
+        elif tag_id in missing:
+            # Loaded from the database: remember it for the next heartbeat
+            changed[tag_id] = current
+
+    if to_create:
+        TagBatteryDaily.objects.bulk_create(to_create, ignore_conflicts=True)
+        # Another worker may have created some of the rows meanwhile (the INSERT was
+        # skipped): read back what is stored and fold this sample into it
+        for tag_id, low, high in TagBatteryDaily.objects.filter(
+            day=day, tag_id__in=[row.tag_id for row in to_create]
+        ).values_list('tag_id', 'min_level', 'max_level'):
+            level = samples[tag_id]
+            if level < low or level > high:
+                widened.append((tag_id, level))
+            changed[tag_id] = (min(level, low), max(level, high))
+    for tag_id, level in widened:
+        TagBatteryDaily.objects.filter(tag_id=tag_id, day=day).update(
+            min_level=Least('min_level', Value(level)), max_level=Greatest('max_level', Value(level))
+        )
+
+    if changed:
+        cache.set_many({_range_key(day, tag_id): value for tag_id, value in changed.items()}, RANGE_CACHE_TIMEOUT)
+    if to_create or widened:
+        logger.debug(f"Battery history: {len(to_create)} days started, {len(widened)} ranges widened")
+    return len(to_create) + len(widened)
+
+
+def purge(days):
+    """Deletes history older than 'days' days. Returns the number of rows deleted."""
+    cutoff = timezone.localdate() - timezone.timedelta(days=days)
+    deleted, _ = TagBatteryDaily.objects.filter(day__lt=cutoff).delete()
+    return deleted
@@ -0,0 +1,114 @@
+import time
+import logging
+from collections import defaultdict
+from django.core.cache import cache
+from .models import Store
+from . import delivery_queue
+
+"""
+EDIT COALESCING: ONE RENDER PER SETTLED CHANGE
+----------------------------------------------
+Catalogue maintenance rarely touches a product only once: a price is
+corrected twice within a minute, or a product is saved from the list view
+and again from its change form. Every save used to render and push every
+linked tag, so the labels flashed (and drained their batteries) once per
+save for content that was already out of date.
+
+Label edits now only mark the affected tags as dirty:
+- Each store has a dirty set ('esl_dirty:<store_id>', a sorted set of tag
+  IDs scored like the delivery queues, so the most urgent lane a tag was
+  marked with wins).
+- The first edit opens the store's settle window
+  ('Store.coalesce_window_seconds'); further edits inside the window just
+  join the set.
+- When the window closes the set is flushed as one trigger_bulk_sync()
+  per lane. Rendering reads the database at that moment, so only the
+  latest state is rendered and pushed.
+
+Open windows are indexed in 'esl_dirty_stores' (score = flush time). A
+flush task is scheduled for the end of each window, and the minute beat
+flushes anything overdue in case that task was lost. A window of 0
+renders immediately, as before.
+"""
+
+logger = logging.getLogger(__name__)
+
+DIRTY_STORES_KEY = "esl_dirty_stores"
+
+# Upper bound for one flush of a store (the rest follows on the next flush)
+FLUSH_BATCH = 50000
+
+
+def dirty_key(store_id):
+    return f"esl_dirty:{store_id}"
+
+
+def get_window(store_id):
+    """Settle window of a store in seconds (0 = no coalescing)."""
+    window = Store.objects.filter(pk=store_id).values_list('coalesce_window_seconds', flat=True).first()
+    return window or 0
+
+
+def mark_dirty(store_id, tag_ids, priority=delivery_queue.PRIORITY_PRICE):
+    """
+    Records that 'tag_ids' of a store need a new image. They are rendered
+    together when the store's settle window closes.
+    """
+    from .utils import trigger_bulk_sync
+    from .tasks import flush_coalesced_edits_task
+
+    tag_ids = list(tag_ids)
+    if not tag_ids:
+        return
+
+    window = get_window(store_id) if store_id else 0
+    if not window:
+        trigger_bulk_sync(tag_ids, priority=priority)
+        return
+
+    client = delivery_queue.get_redis()
+    client.zadd(dirty_key(store_id), {str(tid): delivery_queue.make_score(priority) for tid in tag_ids}, lt=True)
+    # The first edit sets the flush time; later ones keep it (lt)
+    client.zadd(DIRTY_STORES_KEY, {str(store_id): time.time() + window}, lt=True)
+
+    if cache.add(f"coalesce_flush_scheduled_{store_id}", "scheduled", window):
+        flush_coalesced_edits_task.apply_async(countdown=window)
+
+
+def flush_store(store_id):
+    """Renders everything marked dirty for a store. Returns the number of tags."""
+    from .utils import trigger_bulk_sync
+
+    client = delivery_queue.get_redis()
+    lane_names = {lane: name for name, lane in delivery_queue.PRIORITY_LANES.items()}
+    total = 0
+    while True:
+        # The store has left the index: drain its set, one batch at a time
+        popped = client.zpopmin(dirty_key(store_id), FLUSH_BATCH)
+        if not popped:
+            break
+
+        by_priority = defaultdict(list)
+        for member, score in popped:
+            by_priority[lane_names.get(int(score // delivery_queue.LANE_WIDTH), delivery_queue.PRIORITY_PRICE)].append(int(member))
+        for priority, ids in by_priority.items():
+            trigger_bulk_sync(ids, priority=priority)
+
+        total += len(popped)
+        if len(popped) < FLUSH_BATCH:
+            break
+
+    if total:
+        logger.info(f"Coalesced edits for store {store_id}: {total} tags rendered")
+    return total
+
+
+def flush_due():
+    """Flushes every store whose settle window has closed. Returns the number of tags."""
+    client = delivery_queue.get_redis()
+    total = 0
+    for member in client.zrangebyscore(DIRTY_STORES_KEY, 0, time.time()):
+        # CLAIM: only the caller that removes the store from the index flushes it
+        if client.zrem(DIRTY_STORES_KEY, member):
+            total += flush_store(int(member))
+    return total
@@ -0,0 +1,262 @@
+import hashlib
+import logging
+from django.conf import settings
+from django.utils import timezone
+from .models import ESLTag, Gateway, GlobalSetting
+from .mqtt_client import mqtt_service
+from . import flow_control, delivery_queue, hardware_registry
+
+"""
+BATCHED DELIVERY: SEVERAL TAGS PER taskESL MESSAGE
+--------------------------------------------------
+The taskESL command takes a list of tasks ([[params1], [params2], ...])
+and the gateway reports a result per tag. Sending one tag per message
+and then waiting 'ESL_SEND_DELAY_MS' makes a 2,000-tag gateway take over
+16 minutes at 500 ms.
+
+Each delivery step here pops up to 'ESL_TASK_BATCH_SIZE' tags from the
+gateway's priority queue (core/delivery_queue.py) and publishes them in
+a single message. A batch is
+also capped by its encoded size ('ESL_MAX_PAYLOAD_BYTES', kept under the
+broker's max_packet_size), so large colour images simply form smaller
+batches. The send delay then applies per message instead of per tag.
+
+ESL_TASK_BATCH_SIZE = 1 (the default) keeps the original one-tag messages.
+With flow control (core/flow_control.py) a batch is further limited to
+the free slots of the gateway's delivery window.
+
+UNCHANGED IMAGES: every tag remembers the hash of the image it last
+confirmed ('displayed_image_hash', set from 'pushed_image_hash' when the
+gateway reports SUCCESS). A queued image with the same bytes is not sent
+at all; the tag goes straight to SUCCESS. Retries, store-wide refreshes
+and re-imports that change nothing visible therefore cost no air time and
+no tag battery. A forced sync (the admin Sync button) clears the
+displayed hash first, so the image is always sent.
+"""
+
+logger = logging.getLogger(__name__)
+
+# msgpack framing per task besides the image (MAC, flags, token, keys)
+TASK_OVERHEAD_BYTES = 64
+
+
+class DeliveryItem:
+    """One claimed tag ready to be sent."""
+    __slots__ = ('tag', 'token', 'image_bytes', 'image_hash')
+
+    def __init__(self, tag, token, image_bytes, image_hash):
+        self.tag = tag
+        self.token = token
+        self.image_bytes = image_bytes
+        self.image_hash = image_hash
+
+
+def get_batch_size():
+    """Maximum number of tags per taskESL message (GlobalSetting, default 1)."""
+    value = GlobalSetting.objects.filter(key='ESL_TASK_BATCH_SIZE').values_list('value', flat=True).first()
+    return max(1, int(value or 1))
+
+
+def estimate_task_bytes(image_bytes, encoding):
+    """Approximate encoded size of one task inside a taskESL payload."""
+    if encoding == 'BASE64':
+        size = 4 * ((len(image_bytes) + 2) // 3)
+    elif encoding == 'GZIP':
+        # Labels are mostly flat colour: assume a conservative 2:1 ratio.
+        size = len(image_bytes) // 2
+    else:
+        size = len(image_bytes)
+    return size + TASK_OVERHEAD_BYTES
+
+
+def claim_batch(gateway_id, max_tags, max_bytes, encoding, block_seconds=0):
+    """
+    Pops up to 'max_tags' tags from the gateway's delivery queue (most
+    urgent first) and claims those still IMAGE_READY as PROCESSING.
+    Returns (items, missing_image_ids, unchanged_ids, consumed): tags whose
+    image file is missing or unreadable, or whose image is already displayed, are claimed
+    and reported separately; 'consumed' counts the queue entries used up,
+    including stale ones (0 = queue empty).
+    The first tag is always taken, even if it alone exceeds 'max_bytes'.
+    """
+    popped = delivery_queue.pop(gateway_id, max_tags, block_seconds=block_seconds)
+    if not popped:
+        return [], [], [], 0
+
+    # The database stays authoritative: skip entries for tags that were
+    # re-rendered, delivered or moved to another gateway since queuing.
+    tags = ESLTag.objects.filter(
+        pk__in=[tag_id for tag_id, _ in popped],
+        gateway__estation_id=gateway_id,
+        sync_state='IMAGE_READY'
+    ).in_bulk()
+
+    items, missing_image_ids, unchanged_ids, leftover = [], [], [], []
+    total_bytes = 0
+    for tag_id, score in popped:
+        tag = tags.get(tag_id)
+        if tag is None: continue
+        if leftover:
+            leftover.append((tag_id, score))
+            continue
+
+        if not tag.tag_image:
+            missing_image_ids.append(tag.pk)
+            continue
+
+        try:
+            with tag.tag_image.open('rb') as f:
+                image_bytes = f.read()
+        except (OSError, ValueError):
+            # Deleted or unreadable file: fail this tag, deliver the rest of the batch
+            logger.exception(f"Image of tag {tag.tag_mac} could not be read")
+            missing_image_ids.append(tag.pk)
+            continue
+
+        image_hash = hashlib.sha1(image_bytes).hexdigest()
+        if image_hash == tag.displayed_image_hash:
+            unchanged_ids.append(tag.pk)
+            continue
+
+        size = estimate_task_bytes(image_bytes, encoding)
+        if items and total_bytes + size > max_bytes:
+            leftover.append((tag_id, score))
+            continue
+        total_bytes += size
+
+        # TOKEN LOGIC: 2 bits for retry, 14 bits for unique ID
+        base_token = (tag.last_image_task_token or 0) & 0x3FFF
+        token = ((tag.retry_count & 0x03) << 14) | base_token
+        items.append(DeliveryItem(tag, token, image_bytes, image_hash))
+
+    # Tags that didn't fit keep their place at the head of the queue
+    delivery_queue.requeue(gateway_id, leftover)
+
+    claimed_ids = [item.tag.pk for item in items] + missing_image_ids + unchanged_ids
+    if claimed_ids:
+        # Mark as 'PROCESSING' immediately to claim them
+        ESLTag.objects.filter(pk__in=claimed_ids, sync_state='IMAGE_READY').update(sync_state='PROCESSING')
+
+    return items, missing_image_ids, unchanged_ids, len(popped) - len(leftover)
+
+
+def assign_gateways(tag_ids, store_id, priority=delivery_queue.PRIORITY_BULK):
+    """
+    BULK GATEWAY ASSIGNMENT
+    -----------------------
+    Bulk counterpart of dispatch_tag_image_task for IMAGE_READY tags of
+    one store: prefers the last successful gateway, then the assigned one,
+    then any online gateway, and queues them in the given lane.
+    Without an online gateway the tags are PARKED until one reconnects.
+    Returns the estation IDs that received work.
+    """
+    from .gateway_telemetry import apply
+    online = [gw for gw in apply(Gateway.objects.filter(store_id=store_id)) if gw.is_currently_online()]
+    if not online:
+        ESLTag.objects.filter(pk__in=tag_ids).update(sync_state='PARKED')
+        logger.warning(f"No online gateways for store {store_id}. {len(tag_ids)} tags parked.")
+        return set()
+
+    online_by_id = {gw.estation_id: gw for gw in online}
+    online_pks = {gw.pk for gw in online}
+    fallback = online[0]
+
+    by_gateway = {}
+    rows = ESLTag.objects.filter(pk__in=tag_ids).values_list('id', 'last_successful_gateway_id', 'gateway_id')
+    for tag_id, last_gw, assigned_gw in rows:
+        if last_gw in online_by_id:
+            gateway_pk = online_by_id[last_gw].pk
+        elif assigned_gw in online_pks:
+            gateway_pk = assigned_gw
+        else:
+            gateway_pk = fallback.pk
+        by_gateway.setdefault(gateway_pk, []).append(tag_id)
+
+    pk_to_estation = {gw.pk: gw.estation_id for gw in online}
+    for gateway_pk, ids in by_gateway.items():
+        ESLTag.objects.filter(pk__in=ids).update(gateway_id=gateway_pk)
+        delivery_queue.enqueue(pk_to_estation[gateway_pk], ids, priority=priority)
+
+    return {pk_to_estation[pk] for pk in by_gateway}
+
+
+def deliver_next_batch(gateway_id, flow_controlled=False, block_seconds=0):
+    """
+    DELIVERY STEP
+    -------------
+    Sends the next batch of queued tags for a gateway in one message.
+    Returns the number of queue entries handled, or None if the queue is
+    still empty after waiting up to 'block_seconds'.
+    With flow control, returns 0 when the gateway's window is full.
+    """
+    from .retries import process_tag_failures
+
+    gateway = Gateway.objects.filter(estation_id=gateway_id).first()
+    if not gateway:
+        return None
+
+    max_tags = get_batch_size()
+    if flow_controlled:
+        max_tags = min(max_tags, flow_control.available_slots(gateway_id))
+        if max_tags <= 0:
+            return 0
+
+    encoding = gateway.get_payload_encoding()
+    items, missing_image_ids, unchanged_ids, consumed = claim_batch(
+        gateway_id, max_tags, settings.ESL_MAX_PAYLOAD_BYTES, encoding, block_seconds=block_seconds
+    )
+    if not consumed:
+        return None
+
+    if missing_image_ids:
+        logger.error(f"{len(missing_image_ids)} tags in queue for {gateway_id} have no image.")
+        ESLTag.objects.filter(pk__in=missing_image_ids).update(sync_state='GEN_FAILED')
+
+    if unchanged_ids:
+        # The glass already shows these exact images: nothing to transmit
+        logger.info(f"{len(unchanged_ids)} tags for {gateway_id} already display their image. Skipping push.")
+        ESLTag.objects.filter(pk__in=unchanged_ids).update(sync_state='SUCCESS', retry_count=0, retry_due_at=None)
+
+    if not items:
+        return consumed
+
+    try:
+        # REAL-TIME CONNECTIVITY VERIFICATION
+        # If the gateway went offline since the tags were queued, trigger a failure/retry
+        from .gateway_telemetry import apply
+        apply([gateway])
+        if not gateway.is_currently_online():
+            logger.warning(f"Gateway {gateway_id} is OFFLINE. Aborting push for {len(items)} tags.")
+            process_tag_failures((item.tag.pk, "Gateway Offline during delivery") for item in items)
+            return consumed
+
+        logger.info(f"Pushing {len(items)} tags to {gateway_id} | Tokens: {[item.token for item in items]}")
+        success = mqtt_service.publish_tag_batch(
+            gateway_id,
+            [(item.tag.tag_mac.upper(), item.image_bytes, item.token) for item in items],
+            encoding=encoding
+        )
+
+        if success:
+            now = timezone.now()
+            for item in items:
+                item.tag.sync_state = 'PUSHED'
+                item.tag.last_image_task_token = item.token
+                item.tag.last_pushed_at = now
+                item.tag.pushed_image_hash = item.image_hash
+            ESLTag.objects.bulk_update(
+                [item.tag for item in items],
+                ['sync_state', 'last_image_task_token', 'last_pushed_at', 'pushed_image_hash']
+            )
+            # The MQTT worker checks the results against these tokens from memory
+            hardware_registry.announce(tags=[
+                (item.tag.store_id, item.tag.tag_mac, item.tag.pk, item.token, item.tag.retry_count) for item in items
+            ])
+        else:
+            logger.warning(f"MQTT Publish failed for {len(items)} tags on {gateway_id}")
+            process_tag_failures((item.tag.pk, "MQTT Publish Failed") for item in items)
+    except Exception as e:
+        logger.exception(f"Error delivering batch to gateway {gateway_id}: {str(e)}")
+        process_tag_failures((item.tag.pk, f"Queue Error: {str(e)}") for item in items)
+
+    return consumed
@@ -0,0 +1,175 @@
+import asyncio
+import logging
+import signal
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from django import db
+from django.conf import settings
+from .models import Gateway, GlobalSetting
+from .mqtt_client import mqtt_service
+from .delivery import deliver_next_batch
+from . import delivery_queue, flow_control
+
+"""
+DELIVERY DAEMON: ALL GATEWAY QUEUES IN ONE EVENT LOOP
+-----------------------------------------------------
+In the default 'celery' delivery mode every gateway with queued tags
+occupies a Celery worker slot for up to 45 seconds, mostly sleeping
+between messages. With 40 busy gateways the worker pool is exhausted and
+rendering waits.
+
+With ESL_DELIVERY_MODE = 'daemon', 'manage.py delivery_worker' drives the
+queues instead:
+- One asyncio coroutine per gateway sends a batch, then waits the send
+  delay with 'await asyncio.sleep()', which costs nothing while waiting.
+- Database and publish work runs on a small thread pool, so the loop
+  never blocks.
+- One persistent MQTT connection is shared by all gateways.
+- An idle gateway wakes up as soon as something calls
+  trigger_gateway_processing() (a Redis pub/sub message), and re-checks
+  its queue every few seconds in case a wake-up was missed.
+
+SHARDING: with '--shards N', a daemon only serves gateways whose
+crc32(estation_id) % N equals its '--shard'. Run N daemons (0..N-1) to
+spread gateways over processes or hosts.
+"""
+
+logger = logging.getLogger(__name__)
+
+# How often the daemon looks for new/removed gateways and reloads settings
+GATEWAY_REFRESH_SECONDS = 30
+
+# Fallback re-check for idle gateways (wake-ups are best effort)
+IDLE_RECHECK_SECONDS = 5
+
+# Threads for database and publish work (shared by all gateways)
+DB_THREADS = 8
+
+
+def gateway_shard(gateway_id, shards):
+    """Shard number of a gateway (stable across processes and restarts)."""
+    return zlib.crc32(gateway_id.upper().encode()) % shards
+
+
+def _call_db(fn, *args, **kwargs):
+    """Runs in the thread pool. Drops stale connections like a request would."""
+    db.close_old_connections()
+    return fn(*args, **kwargs)
+
+
+class DeliveryDaemon:
+    """Delivers the queues of every gateway in this shard from one event loop."""
+
+    def __init__(self, shard=0, shards=1):
+        if shards < 1 or not 0 <= shard < shards:
+            raise ValueError(f"Invalid shard {shard} of {shards}")
+        self.shard = shard
+        self.shards = shards
+        self.wake_events = {}
+        self.runners = {}
+        self.flow_controlled = False
+        self.delay_seconds = 0.5
+        self.stopping = None
+        self.executor = ThreadPoolExecutor(max_workers=DB_THREADS, thread_name_prefix='delivery')
+
+    def owns(self, gateway_id):
+        return gateway_shard(gateway_id, self.shards) == self.shard
+
+    async def db(self, fn, *args, **kwargs):
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor, lambda: _call_db(fn, *args, **kwargs)
+        )
+
+    def wake(self, gateway_id):
+        event = self.wake_events.get(gateway_id.upper())
+        if event:
+            event.set()
+
+    def _load_settings(self):
+        delay_ms = int(GlobalSetting.objects.filter(key='ESL_SEND_DELAY_MS').values_list('value', flat=True).first() or 500)
+        return flow_control.is_enabled(), max(0.1, delay_ms / 1000.0)
+
+    def _load_gateway_ids(self):
+        return [gw_id.upper() for gw_id in Gateway.objects.values_list('estation_id', flat=True) if self.owns(gw_id)]
+
+    async def refresh(self):
+        """Reloads pacing settings and starts/stops gateway coroutines."""
+        self.flow_controlled, self.delay_seconds = await self.db(self._load_settings)
+        gateway_ids = set(await self.db(self._load_gateway_ids))
+
+        for gateway_id in gateway_ids - set(self.runners):
+            self.wake_events[gateway_id] = asyncio.Event()
+            self.runners[gateway_id] = asyncio.create_task(self.run_gateway(gateway_id))
+        for gateway_id in set(self.runners) - gateway_ids:
+            self.runners.pop(gateway_id).cancel()
+            self.wake_events.pop(gateway_id, None)
+
+    async def run_gateway(self, gateway_id):
+        """Send loop of one gateway: batch, paced wait, repeat; idle until woken."""
+        wake = self.wake_events[gateway_id]
+        while not self.stopping.is_set():
+            wake.clear()
+            try:
+                handled = await self.db(deliver_next_batch, gateway_id, flow_controlled=self.flow_controlled)
+            except Exception:
+                logger.exception(f"Delivery daemon: error delivering to {gateway_id}")
+                handled = None
+
+            if handled:
+                # PACING: with flow control results clock the sends, otherwise a fixed delay
+                if not self.flow_controlled:
+                    await asyncio.sleep(self.delay_seconds)
+                continue
+
+            # Queue empty (None) or window full (0): wait for a wake-up
+            try:
+                await asyncio.wait_for(wake.wait(), IDLE_RECHECK_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+
+    async def listen_for_wakeups(self):
+        """Subscribes to trigger_gateway_processing() notifications."""
+        import redis.asyncio as aioredis
+
+        while not self.stopping.is_set():
+            try:
+                client = aioredis.Redis.from_url(settings.REDIS_URL)
+                async with client.pubsub() as pubsub:
+                    await pubsub.subscribe(delivery_queue.WAKE_CHANNEL)
+                    async for message in pubsub.listen():
+                        if message.get('type') == 'message':
+                            self.wake(message['data'].decode())
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Delivery daemon: wake-up listener failed, reconnecting")
+                await asyncio.sleep(IDLE_RECHECK_SECONDS)
+
+    async def run(self):
+        self.stopping = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, self.stopping.set)
+            except (NotImplementedError, RuntimeError):
+                pass  # Not available on Windows / outside the main thread
+
+        # A single persistent connection for every gateway of this shard
+        await self.db(mqtt_service.connect, subscribe=False)
+        listener = asyncio.create_task(self.listen_for_wakeups())
+        logger.info(f"Delivery daemon started (shard {self.shard}/{self.shards})")
+
+        try:
+            while not self.stopping.is_set():
+                await self.refresh()
+                try:
+                    await asyncio.wait_for(self.stopping.wait(), GATEWAY_REFRESH_SECONDS)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            listener.cancel()
+            for runner in self.runners.values():
+                runner.cancel()
+            await asyncio.gather(listener, *self.runners.values(), return_exceptions=True)
+            self.executor.shutdown(wait=True)
+            logger.info(f"Delivery daemon stopped (shard {self.shard}/{self.shards})")
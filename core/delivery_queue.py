@@ -0,0 +1,119 @@
+import time
+import logging
+from django.conf import settings
+
+"""
+DELIVERY QUEUES: ONE REDIS SORTED SET PER GATEWAY
+-------------------------------------------------
+Which tag a gateway sends next used to be decided by a row-locking query
+on the ESL tag table (IMAGE_READY, oldest first) for every single tag.
+
+Each gateway now has an explicit queue: a Redis sorted set of tag IDs
+('esl_dq:<estation_id>'). The score encodes a priority lane and the time
+the tag was queued, so the lowest score is always the next tag to send:
+
+    score = lane * 10^13 + enqueue time (ms)
+
+Lanes, most urgent first:
+- interactive: a person is waiting for this tag (manual sync, pairing).
+- price:       price/product changes (imports, product edits, retries).
+- template:    template switches.
+- bulk:        store-wide refreshes.
+
+Urgent price changes therefore overtake a 20,000-tag store refresh that
+is already queued. Popping is atomic (ZPOPMIN/BZPOPMIN), so two delivery
+loops can never take the same tag, and an idle loop sleeps in a blocking
+pop instead of polling the database. Re-queuing a tag keeps its better
+(lower) score.
+
+The database remains the source of truth: delivery re-checks that a
+popped tag is still IMAGE_READY for that gateway, and the minute health
+check re-queues any IMAGE_READY tag that is missing from its queue.
+"""
+
+logger = logging.getLogger(__name__)
+
+PRIORITY_INTERACTIVE = 'interactive'
+PRIORITY_PRICE = 'price'
+PRIORITY_TEMPLATE = 'template'
+PRIORITY_BULK = 'bulk'
+
+PRIORITY_LANES = {
+    PRIORITY_INTERACTIVE: 0,
+    PRIORITY_PRICE: 1,
+    PRIORITY_TEMPLATE: 2,
+    PRIORITY_BULK: 3,
+}
+
+LANE_WIDTH = 10 ** 13  # Larger than any millisecond timestamp
+
+# How long an idle delivery loop waits for new tags before it exits
+QUEUE_IDLE_WAIT_SECONDS = 2
+
+# Pub/sub channel that wakes idle gateways in the delivery daemon
+WAKE_CHANNEL = 'esl_dq_wake'
+
+
+_client = None
+
+
+def get_redis():
+    """Shared Redis client for the delivery queues (the test runner swaps in core.testing.LocalRedis)."""
+    global _client
+    if _client is None:
+        import redis
+        _client = redis.Redis.from_url(settings.REDIS_URL)
+    return _client
+
+
+def queue_key(gateway_id):
+    return f"esl_dq:{gateway_id.upper()}"
+
+
+def make_score(priority, now_ms=None):
+    lane = PRIORITY_LANES.get(priority, PRIORITY_LANES[PRIORITY_PRICE])
+    return lane * LANE_WIDTH + (now_ms if now_ms is not None else int(time.time() * 1000))
+
+
+def enqueue(gateway_id, tag_ids, priority=PRIORITY_PRICE):
+    """Adds tags to a gateway's queue (an already queued tag keeps its better score)."""
+    if not tag_ids:
+        return
+    score = make_score(priority)
+    get_redis().zadd(queue_key(gateway_id), {str(tid): score for tid in tag_ids}, lt=True)
+
+
+def requeue(gateway_id, scored_ids):
+    """Puts popped (tag_id, score) pairs back with their original scores."""
+    if scored_ids:
+        get_redis().zadd(queue_key(gateway_id), {str(tid): score for tid, score in scored_ids}, lt=True)
+
+
+def pop(gateway_id, count, block_seconds=0):
+    """
+    Atomically takes up to 'count' tags (most urgent first).
+    Returns a list of (tag_id, score). With 'block_seconds', waits that
+    long for the first tag if the queue is empty.
+    """
+    if count <= 0:
+        return []
+    client = get_redis()
+    key = queue_key(gateway_id)
+
+    items = client.zpopmin(key, count)
+    if not items and block_seconds:
+        first = client.bzpopmin(key, timeout=block_seconds)
+        if first:
+            items = [(first[1], first[2])]
+            if count > 1:
+                items += client.zpopmin(key, count - 1)
+    return [(int(member), score) for member, score in items]
+
+
+def queue_length(gateway_id):
+    return get_redis().zcard(queue_key(gateway_id))
+
+
+def notify(gateway_id):
+    """Wakes the delivery daemon's loop for this gateway (see core/delivery_daemon.py)."""
+    get_redis().publish(WAKE_CHANNEL, gateway_id.upper())
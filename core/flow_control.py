@@ -0,0 +1,150 @@
+import time
+import logging
+from django.core.cache import cache
+from django.utils import timezone
+from .models import ESLTag, GlobalSetting
+
+"""
+FLOW CONTROL: ACK-CLOCKED DELIVERY WINDOW PER GATEWAY
+-----------------------------------------------------
+A fixed 'ESL_SEND_DELAY_MS' between messages is either too slow for an
+idle gateway or too fast for a busy one. With flow control enabled
+(GlobalSetting 'ESL_FLOW_CONTROL' = 1), each gateway instead gets a
+congestion window: the number of tags that may be PUSHED (sent but not
+yet confirmed by a /result) at the same time.
+
+The window follows the AIMD rule known from TCP:
+- Slow start: every confirmed tag grows the window by one (doubling per
+  round trip) until the first congestion signal.
+- Additive increase: afterwards it grows by about one tag per round trip.
+- Multiplicative decrease: Busy (7) / MaxLimit (8) message codes and
+  tags that time out without a result halve the window.
+- While the gateway reports a backlog ('tags_queued_count' in heartbeats)
+  at least as large as the window, the window is held instead of grown.
+
+The delivery loop sends until the window is full and then stops; the
+next /result frees slots and triggers the loop again immediately
+(see MQTTService.handle_result), so sending is clocked by acknowledgements
+rather than a timer.
+
+The window lives in the shared cache. Updates are read-modify-write
+without a lock: they almost all come from the single MQTT worker, and a
+lost update only nudges the window by one step.
+"""
+
+logger = logging.getLogger(__name__)
+
+# Message codes that mean "slow down" (see Gateway.MESSAGE_CODES)
+CONGESTION_CODES = {7, 8}
+
+INITIAL_WINDOW = 2
+MIN_WINDOW = 1
+
+# Tags without a result after this long no longer count as in flight
+# (check_gateways_status_task retries them and reports a timeout).
+ACK_TIMEOUT_SECONDS = 60
+
+# Several Busy results from one burst count as a single congestion event
+DECREASE_HOLDOFF_SECONDS = 5
+
+FLOW_STATE_TIMEOUT = 60 * 60 * 24
+
+
+def is_enabled():
+    value = GlobalSetting.objects.filter(key='ESL_FLOW_CONTROL').values_list('value', flat=True).first()
+    return str(value or '0').strip().lower() in ('1', 'true', 'yes', 'on')
+
+
+def get_max_window():
+    value = GlobalSetting.objects.filter(key='ESL_FLOW_MAX_WINDOW').values_list('value', flat=True).first()
+    return max(MIN_WINDOW, int(value or 64))
+
+
+class FlowWindow:
+    """Congestion window state of one gateway (stored in the cache as a tuple)."""
+    __slots__ = ('gateway_id', 'cwnd', 'ssthresh', 'last_decrease', 'queued')
+
+    def __init__(self, gateway_id, cwnd=INITIAL_WINDOW, ssthresh=None, last_decrease=0.0, queued=0):
+        self.gateway_id = gateway_id
+        self.cwnd = cwnd
+        self.ssthresh = ssthresh
+        self.last_decrease = last_decrease
+        self.queued = queued
+
+    @staticmethod
+    def _key(gateway_id):
+        return f"esl_flow_{gateway_id.upper()}"
+
+    @classmethod
+    def load(cls, gateway_id):
+        state = cache.get(cls._key(gateway_id))
+        return cls(gateway_id, *state) if state else cls(gateway_id)
+
+    def save(self):
+        cache.set(self._key(self.gateway_id), (self.cwnd, self.ssthresh, self.last_decrease, self.queued), FLOW_STATE_TIMEOUT)
+
+    @property
+    def size(self):
+        return max(MIN_WINDOW, int(self.cwnd))
+
+    def on_ack(self, confirmed, max_window):
+        """Grow the window for 'confirmed' successful results."""
+        if confirmed <= 0 or self.queued >= self.size:
+            return
+        for _ in range(confirmed):
+            if self.ssthresh is None or self.cwnd < self.ssthresh:
+                self.cwnd += 1                 # Slow start
+            else:
+                self.cwnd += 1.0 / self.cwnd   # Additive increase
+        self.cwnd = min(self.cwnd, max_window)
+
+    def on_congestion(self):
+        """Halve the window (at most once per hold-off period). Returns True if it shrank."""
+        now = time.time()
+        if now - self.last_decrease < DECREASE_HOLDOFF_SECONDS:
+            return False
+        self.ssthresh = max(MIN_WINDOW, self.cwnd / 2)
+        self.cwnd = self.ssthresh
+        self.last_decrease = now
+        return True
+
+
+def count_in_flight(gateway_id):
+    """Tags pushed to the gateway that are still waiting for their result."""
+    cutoff = timezone.now() - timezone.timedelta(seconds=ACK_TIMEOUT_SECONDS)
+    return ESLTag.objects.filter(
+        gateway__estation_id=gateway_id, sync_state='PUSHED', last_pushed_at__gte=cutoff
+    ).count()
+
+
+def available_slots(gateway_id):
+    """How many more tags may be sent to the gateway right now."""
+    return max(0, FlowWindow.load(gateway_id).size - count_in_flight(gateway_id))
+
+
+def record_results(gateway_id, confirmed, message_code=None):
+    """Called for each /result message: grow on success, shrink on Busy/MaxLimit."""
+    window = FlowWindow.load(gateway_id)
+    if message_code in CONGESTION_CODES:
+        if window.on_congestion():
+            logger.info(f"Flow control {gateway_id}: congestion (code {message_code}), window -> {window.size}")
+    else:
+        window.on_ack(confirmed, get_max_window())
+    window.save()
+
+
+def record_heartbeat(gateway_id, queued, message_code=None):
+    """Called for each heartbeat: remember the reported backlog, shrink on Busy/MaxLimit."""
+    window = FlowWindow.load(gateway_id)
+    window.queued = queued or 0
+    if message_code in CONGESTION_CODES and window.on_congestion():
+        logger.info(f"Flow control {gateway_id}: gateway reports code {message_code}, window -> {window.size}")
+    window.save()
+
+
+def record_timeouts(gateway_id, count):
+    """Called when pushed tags expired without a result."""
+    window = FlowWindow.load(gateway_id)
+    if window.on_congestion():
+        logger.info(f"Flow control {gateway_id}: {count} result timeouts, window -> {window.size}")
+    window.save()
@@ -0,0 +1,140 @@
+import string
+import logging
+from PIL import ImageFont
+
+"""
+FONT METRICS ENGINE: ARITHMETIC TEXT MEASUREMENT
+------------------------------------------------
+Fitting text on a label used to mean asking FreeType to lay out the
+string again for every candidate font size ('textbbox'). A single V1
+render did this dozens of times for the name, price, supplier and SKU.
+
+This module precomputes, for every bundled font at every pixel size:
+- Advance widths and ink bounding boxes for each printable glyph.
+- Kerning adjustments for the (few) glyph pairs the font actually kerns.
+- Ascent/descent.
+
+Text boxes are then computed by simple addition. The results match
+Pillow's 'textbbox((0, 0), ...)' pixel-for-pixel (basic layout), so
+templates can use them as a drop-in replacement.
+"""
+
+logger = logging.getLogger(__name__)
+
+# Glyphs covered by the tables: printable ASCII (' ' to '~').
+# Text containing anything else falls back to FreeType measurement.
+GLYPHS = string.printable[:95]
+
+# Size range precomputed at warm-up (matches the templates' auto-fit range).
+MIN_SIZE = 8
+MAX_SIZE = 96
+
+# Pair tables are discovered once per font at a large reference size.
+# A pair that doesn't kern in font units doesn't kern at any pixel size.
+_KERN_REFERENCE_SIZE = 1000
+
+_KERNED_PAIRS = {}   # font_path -> tuple of glyph pairs with non-zero kerning
+_METRICS_CACHE = {}  # (font_path, size) -> FontMetrics
+
+
+class FontMetrics:
+    """
+    GLYPH TABLES FOR ONE FONT AT ONE PIXEL SIZE
+    -------------------------------------------
+    Built once per (font file, size) and kept for the life of the process.
+    """
+    __slots__ = ('size', 'advances', 'bboxes', 'kerning', 'ascent', 'descent')
+
+    def __init__(self, font):
+        self.size = font.size
+        self.advances = {c: font.getlength(c) for c in GLYPHS}
+        self.bboxes = {c: font.getbbox(c) for c in GLYPHS}
+        self.kerning = {
+            pair: font.getlength(pair) - self.advances[pair[0]] - self.advances[pair[1]]
+            for pair in _get_kerned_pairs(font.path)
+        }
+        self.ascent, self.descent = font.getmetrics()
+
+    def covers(self, text):
+        advances = self.advances
+        return all(c in advances for c in text)
+
+    def bbox(self, text):
+        """
+        Equivalent of 'textbbox((0, 0), text, font)' computed from the tables.
+        Callers must check covers(text) first.
+        """
+        if not text:
+            return (0, 0, 0, 0)
+
+        advances, bboxes, kerning = self.advances, self.bboxes, self.kerning
+        pen_x = 0.0
+        prev = None
+        x0 = x1 = y0 = y1 = None
+        for c in text:
+            if prev is not None:
+                pen_x += kerning.get(prev + c, 0.0)
+            left, top, right, bottom = bboxes[c]
+            if x0 is None:
+                x0, x1, y0, y1 = pen_x + left, pen_x + right, top, bottom
+            else:
+                x1 = max(x1, pen_x + right)
+                y0 = min(y0, top)
+                y1 = max(y1, bottom)
+            pen_x += advances[c]
+            prev = c
+
+        return (round(x0), y0, round(x1), y1)
+
+    def text_size(self, text):
+        x0, y0, x1, y1 = self.bbox(text)
+        return x1 - x0, y1 - y0
+
+
+def _get_kerned_pairs(font_path):
+    pairs = _KERNED_PAIRS.get(font_path)
+    if pairs is None:
+        ref = ImageFont.truetype(font_path, _KERN_REFERENCE_SIZE)
+        advances = {c: ref.getlength(c) for c in GLYPHS}
+        pairs = tuple(
+            a + b for a in GLYPHS for b in GLYPHS
+            if abs(ref.getlength(a + b) - advances[a] - advances[b]) > 1e-6
+        )
+        _KERNED_PAIRS[font_path] = pairs
+    return pairs
+
+
+def get_font_metrics(font):
+    """
+    Returns the FontMetrics for a loaded TrueType font, building the
+    tables on first use. Returns None for fonts without a file path
+    (e.g. Pillow's built-in default bitmap font).
+    """
+    font_path = getattr(font, 'path', None)
+    if not font_path:
+        return None
+
+    key = (font_path, font.size)
+    metrics = _METRICS_CACHE.get(key)
+    if metrics is None:
+        metrics = _METRICS_CACHE[key] = FontMetrics(font)
+    return metrics
+
+
+def precompute_font_metrics(font_paths, sizes=range(MIN_SIZE, MAX_SIZE + 1)):
+    """
+    WARM-UP: Builds the metric tables for every font across the size range
+    so that no FreeType layout happens while rendering labels.
+    """
+    count = 0
+    for font_path in font_paths:
+        for size in sizes:
+            if (font_path, size) in _METRICS_CACHE:
+                continue
+            try:
+                _METRICS_CACHE[(font_path, size)] = FontMetrics(ImageFont.truetype(font_path, size))
+                count += 1
+            except Exception:
+                logger.exception(f"Failed to precompute metrics for {font_path} @ {size}px")
+                break
+    return count
@@ -0,0 +1,173 @@
+import time
+import logging
+from datetime import datetime, timezone as dt_timezone
+from django.db.models.functions import Upper
+from .models import Gateway
+from . import delivery_queue
+
+"""
+WRITE-BEHIND GATEWAY TELEMETRY
+------------------------------
+Every gateway sends a heartbeat every 15 seconds, and each one used to be
+a row UPDATE on the gateway table. Almost all of them only move
+'last_heartbeat'/'last_seen' forward and repeat the same queue counts.
+
+Volatile telemetry now lives in one Redis hash per gateway
+('gw_tele:<estation_id>'):
+- timestamps: last_heartbeat, last_successful_heartbeat, last_seen
+- counters: tags_queued_count, tags_comm_count, last_error_code
+
+A heartbeat only goes to the database when something durable changes:
+the gateway's state (ONLINE <-> ERROR, or back from OFFLINE), its error,
+or its firmware versions, or when no hash exists yet. All other
+heartbeats only update the hash and mark the gateway dirty.
+'flush()' writes the dirty gateways with one bulk UPDATE every
+'GATEWAY_TELEMETRY_FLUSH_SECONDS' (flush_gateway_telemetry_task), and
+right before the minute status check decides who is OFFLINE.
+
+Readers that judge connectivity (Gateway.get_real_time_status()) first
+overlay the hashes on their rows with apply(), which loads any number of
+gateways in one round trip.
+When the status check marks a gateway OFFLINE its hash is dropped, so the
+next heartbeat takes the database path and is seen as a reconnect.
+"""
+
+logger = logging.getLogger(__name__)
+
+DIRTY_KEY = "gw_tele_dirty"
+
+# Hashes of gateways that stop reporting expire on their own
+TELEMETRY_TTL = 15 * 60
+
+TIMESTAMP_FIELDS = ('last_heartbeat', 'last_successful_heartbeat', 'last_seen')
+COUNTER_FIELDS = ('tags_queued_count', 'tags_comm_count', 'last_error_code')
+VOLATILE_FIELDS = TIMESTAMP_FIELDS + COUNTER_FIELDS
+
+# Kept in the hash to recognise heartbeats that change durable state
+STATE_FIELDS = ('is_online', 'ap_version', 'module_version')
+
+
+def telemetry_key(estation_id):
+    return f"gw_tele:{estation_id.strip().upper()}"
+
+
+def _encode(value):
+    if value is None:
+        return ''
+    if isinstance(value, datetime):
+        return repr(value.timestamp())
+    return value
+
+
+def _decode(field, raw):
+    value = raw.decode() if isinstance(raw, bytes) else raw
+    if value == '':
+        return None
+    if field in TIMESTAMP_FIELDS:
+        return datetime.fromtimestamp(float(value), tz=dt_timezone.utc)
+    if field in COUNTER_FIELDS:
+        return int(value)
+    return value
+
+
+def load(estation_ids):
+    """Telemetry hashes of several gateways in one round trip, keyed by upper-case ID."""
+    ids = list(dict.fromkeys(e.strip().upper() for e in estation_ids if e))
+    if not ids:
+        return {}
+    pipe = delivery_queue.get_redis().pipeline(transaction=False)
+    for estation_id in ids:
+        pipe.hgetall(telemetry_key(estation_id))
+    loaded = {}
+    for estation_id, raw in zip(ids, pipe.execute()):
+        if raw:
+            data = loaded[estation_id] = {}
+            for key, value in raw.items():
+                field = key.decode() if isinstance(key, bytes) else key
+                data[field] = _decode(field, value)
+    return loaded
+
+
+def apply(gateways):
+    """Overlays live telemetry on Gateway instances (when newer than the row)."""
+    gateways = [gw for gw in gateways if gw.estation_id]
+    live = load(gw.estation_id for gw in gateways)
+    for gw in gateways:
+        data = live.get(gw.estation_id.strip().upper())
+        if not data or not data.get('last_heartbeat'):
+            continue
+        if gw.last_heartbeat and gw.last_heartbeat >= data['last_heartbeat']:
+            continue
+        for field in VOLATILE_FIELDS:
+            if field in data:
+                setattr(gw, field, data[field])
+    return gateways
+
+
+def split(heartbeats):
+    """
+    Sorts parsed heartbeats ({upper_id: (estation_id, update_data)}) into
+    (volatile, durable): volatile ones only refresh telemetry, durable ones
+    change state and must be written to the database.
+    """
+    live = load(heartbeats)
+    volatile, durable = {}, {}
+    for upper_id, (estation_id, update_data) in heartbeats.items():
+        known = live.get(upper_id)
+        unchanged = known is not None and all(
+            field not in update_data or known.get(field) == _decode(field, str(_encode(update_data[field])))
+            for field in STATE_FIELDS
+        )
+        # An error that changes kind is a durable change too
+        if unchanged and update_data.get('is_online') == 'ERROR':
+            unchanged = known.get('last_error_code') == update_data.get('last_error_code')
+        (volatile if unchanged else durable)[upper_id] = (estation_id, update_data)
+    return volatile, durable
+
+
+def record(heartbeats, dirty=True):
+    """Stores telemetry (and state) of parsed heartbeats; 'dirty' ones are flushed later."""
+    if not heartbeats:
+        return
+    client = delivery_queue.get_redis()
+    pipe = client.pipeline(transaction=False)
+    now = time.time()
+    for upper_id, (estation_id, update_data) in heartbeats.items():
+        mapping = {f: _encode(update_data[f]) for f in VOLATILE_FIELDS + STATE_FIELDS if f in update_data}
+        pipe.hset(telemetry_key(upper_id), mapping=mapping)
+        pipe.expire(telemetry_key(upper_id), TELEMETRY_TTL)
+    if dirty:
+        pipe.zadd(DIRTY_KEY, {upper_id: now for upper_id in heartbeats})
+    pipe.execute()
+
+
+def forget(estation_ids):
+    """Drops telemetry hashes (the next heartbeat of these gateways is written through)."""
+    keys = [telemetry_key(e) for e in estation_ids if e]
+    if keys:
+        delivery_queue.get_redis().delete(*keys)
+
+
+def flush(limit=10000):
+    """Writes the telemetry of dirty gateways with one bulk UPDATE. Returns the number written."""
+    popped = delivery_queue.get_redis().zpopmin(DIRTY_KEY, limit)
+    if not popped:
+        return 0
+    ids = [member.decode() if isinstance(member, bytes) else member for member, _ in popped]
+    live = load(ids)
+
+    gateways = []
+    for gw in Gateway.objects.annotate(upper_estation_id=Upper('estation_id')).filter(upper_estation_id__in=list(live)):
+        data = live[gw.upper_estation_id]
+        if gw.last_heartbeat and data.get('last_heartbeat') and gw.last_heartbeat >= data['last_heartbeat']:
+            continue
+        for field in VOLATILE_FIELDS:
+            if field in data:
+                setattr(gw, field, data[field])
+        gateways.append(gw)
+
+    if gateways:
+        Gateway.objects.bulk_update(gateways, list(VOLATILE_FIELDS))
+    logger.debug(f"Gateway telemetry: {len(gateways)} gateways flushed")
+    return len(gateways)
+
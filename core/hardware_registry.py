@@ -0,0 +1,230 @@
+import time
+import logging
+import threading
+import msgpack
+from django.db.models.functions import Upper
+from .models import ESLTag, Gateway
+from . import delivery_queue
+
+"""
+RESIDENT HARDWARE REGISTRY (MQTT WORKER)
+----------------------------------------
+Verifying a /result message only needs three facts: which store the
+gateway belongs to, which tag a MAC is in that store, and which token
+that tag was last sent. Each result batch used to look those up with a
+gateway query and a tag query that built full ESLTag instances.
+
+The MQTT worker now keeps them in memory:
+- gateways: upper-case estation_id -> GatewayRecord(pk, store_id, estation_id)
+- tags:     store_id -> {normalized MAC: TagRecord(tag_id, token, retry_count)}
+
+Records use __slots__, so a store of 20,000 tags costs a few MB. A store
+is loaded with one query the first time one of its gateways reports a
+result, and reloaded after 'STORE_MAX_AGE' seconds as a safety net.
+
+COHERENCE: the processes that change tokens announce it on the Redis
+channel 'REGISTRY_CHANNEL' (see announce()):
+- delivery announces the exact token of every tag it pushes,
+- rendering drops tags that get a new token (a late result for the
+  previous push must not confirm the new image),
+- saving a gateway, or moving a tag to another MAC or store, drops it.
+The worker applies announcements as they arrive and empties the registry
+whenever its subscription (re)connects, since messages may have been
+missed. Announcements can also arrive late: delivery announces after
+publishing, so a fast gateway's result may come first. A result whose
+MAC is unknown or whose token doesn't match is therefore re-read from
+the database (see refresh()) before it is rejected. Processes without
+a registry (anything but the MQTT worker) look results up in the
+database.
+"""
+
+logger = logging.getLogger(__name__)
+
+REGISTRY_CHANNEL = 'esl_registry'
+
+# Stores are reloaded from the database after this many seconds
+STORE_MAX_AGE = 600
+
+
+class GatewayRecord:
+    __slots__ = ('pk', 'store_id', 'estation_id')
+
+    def __init__(self, pk, store_id, estation_id):
+        self.pk = pk
+        self.store_id = store_id
+        self.estation_id = estation_id
+
+
+class TagRecord:
+    __slots__ = ('tag_id', 'token', 'retry_count')
+
+    def __init__(self, tag_id, token, retry_count):
+        self.tag_id = tag_id
+        self.token = token
+        self.retry_count = retry_count
+
+
+def load_gateways(estation_ids):
+    """Gateway records by upper-case ID (one query)."""
+    ids = {e.strip().upper() for e in estation_ids if e}
+    if not ids:
+        return {}
+    rows = Gateway.objects.annotate(upper_estation_id=Upper('estation_id')).filter(
+        upper_estation_id__in=ids
+    ).values_list('upper_estation_id', 'pk', 'store_id', 'estation_id')
+    return {upper_id: GatewayRecord(pk, store_id, estation_id) for upper_id, pk, store_id, estation_id in rows}
+
+
+def load_tags(store_ids, macs=None):
+    """Tag records keyed by (store_id, MAC), optionally only for 'macs' (one query)."""
+    from .utils import normalize_mac
+
+    queryset = ESLTag.objects.filter(store_id__in=list(store_ids))
+    if macs is not None:
+        queryset = queryset.filter(tag_mac__in=list(macs))
+    return {
+        (store_id, normalize_mac(mac)): TagRecord(tag_id, token, retry_count)
+        for tag_id, store_id, mac, token, retry_count in queryset.values_list(
+            'id', 'store_id', 'tag_mac', 'last_image_task_token', 'retry_count'
+        )
+    }
+
+
+def announce(tags=(), dropped=(), gateways=()):
+    """
+    Tells the MQTT worker's registry about token changes:
+    'tags' is a list of (store_id, tag_mac, tag_id, token, retry_count) just
+    pushed, 'dropped' tag IDs whose token changed, 'gateways' estation IDs
+    that were edited. Never raises: results that don't match a stale record
+are re-read from the database by the worker.
+    """
+    message = {}
+    if tags:
+        message['tags'] = [list(t) for t in tags]
+    if dropped:
+        message['drop'] = list(dropped)
+    if gateways:
+        message['gateways'] = [e for e in gateways if e]
+    if not message:
+        return
+    try:
+        delivery_queue.get_redis().publish(REGISTRY_CHANNEL, msgpack.packb(message, use_bin_type=True))
+    except Exception:
+        logger.exception("Hardware registry: announcement failed")
+
+
+class HardwareRegistry:
+    """In-memory gateway and tag records of the MQTT worker (see module docstring)."""
+
+    def __init__(self, max_age=STORE_MAX_AGE):
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        with self._lock:
+            self.gateways = {}
+            # store_id -> {MAC: TagRecord}; a reload swaps in a whole store
+            self.stores = {}
+            self._loaded_at = {}
+            self._tag_keys = {}
+
+    def gateways_by_id(self, estation_ids):
+        """Like load_gateways(), but only gateways not seen before are queried."""
+        ids = {e.strip().upper() for e in estation_ids if e}
+        missing = ids - set(self.gateways)
+        if missing:
+            loaded = load_gateways(missing)
+            with self._lock:
+                self.gateways.update(loaded)
+        return {upper_id: self.gateways[upper_id] for upper_id in ids if upper_id in self.gateways}
+
+    def tag_lookup(self, store_ids):
+        """
+        Returns a (store_id, MAC) -> TagRecord function, after (re)loading
+        stores seen for the first time or more than 'max_age' seconds ago.
+        """
+        now = time.monotonic()
+        stale = [
+            s for s in store_ids
+            if s is not None and (s not in self._loaded_at or now - self._loaded_at[s] >= self.max_age)
+        ]
+        if stale:
+            loaded = {store_id: {} for store_id in stale}
+            for (store_id, mac), record in load_tags(stale).items():
+                loaded[store_id][mac] = record
+            with self._lock:
+                for store_id, records in loaded.items():
+                    self.stores[store_id] = records
+                    self._loaded_at[store_id] = now
+                    for mac, record in records.items():
+                        self._tag_keys[record.tag_id] = (store_id, mac)
+            logger.debug(f"Hardware registry: {sum(map(len, loaded.values()))} tags of {len(stale)} stores loaded")
+
+        stores = self.stores
+        return lambda store_id, mac: stores.get(store_id, {}).get(mac)
+
+    def refresh(self, keys):
+        """
+        Re-reads the (store_id, MAC) tags in 'keys' from the database (one
+        query) and updates their records. Tags that are gone are dropped.
+        """
+        if not keys:
+            return
+        loaded = load_tags({store_id for store_id, _ in keys}, {mac for _, mac in keys})
+        with self._lock:
+            for store_id, mac in keys:
+                record = loaded.get((store_id, mac))
+                if record is not None:
+                    self.stores.setdefault(store_id, {})
+                    self._set(store_id, mac, record)
+                else:
+                    current = self.stores.get(store_id, {}).get(mac)
+                    if current is not None:
+                        self._drop(current.tag_id)
+        logger.debug(f"Hardware registry: {len(keys)} tags re-read after a mismatch")
+
+    def _set(self, store_id, mac, record):
+        old_key = self._tag_keys.get(record.tag_id)
+        if old_key is not None and old_key != (store_id, mac):
+            self.stores.get(old_key[0], {}).pop(old_key[1], None)
+        self.stores[store_id][mac] = record
+        self._tag_keys[record.tag_id] = (store_id, mac)
+
+    def _drop(self, tag_id):
+        key = self._tag_keys.pop(tag_id, None)
+        if key is not None:
+            self.stores.get(key[0], {}).pop(key[1], None)
+
+    def apply(self, message):
+        """Applies one announcement (see announce())."""
+        from .utils import normalize_mac
+
+        with self._lock:
+            for tag_id in message.get('drop', ()):
+                self._drop(tag_id)
+            for store_id, mac, tag_id, token, retry_count in message.get('tags', ()):
+                # Stores not loaded yet will read the current token from the database
+                if store_id in self.stores:
+                    self._set(store_id, normalize_mac(mac), TagRecord(tag_id, token, retry_count))
+            for estation_id in message.get('gateways', ()):
+                self.gateways.pop(estation_id.strip().upper(), None)
+
+    def listen(self, stopping):
+        """Applies announcements until 'stopping' is set (runs in its own thread)."""
+        while not stopping.is_set():
+            try:
+                pubsub = delivery_queue.get_redis().pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(REGISTRY_CHANNEL)
+                # Anything announced before this point may have been missed
+                self.clear()
+                logger.info("Hardware registry: listening for announcements")
+                while not stopping.is_set():
+                    message = pubsub.get_message(timeout=1.0)
+                    if message and message.get('type') == 'message':
+                        self.apply(msgpack.unpackb(message['data'], raw=False))
+                pubsub.close()
+            except Exception:
+                logger.exception("Hardware registry: listener failed, reconnecting")
+                self.clear()
+                stopping.wait(5)
@@ -0,0 +1,166 @@
+import time
+import queue
+import logging
+import threading
+import zlib
+from django import db
+from django.conf import settings
+from django.core.cache import cache
+
+"""
+MQTT INGESTION: OFF THE NETWORK THREAD, IN MICRO-BATCHES
+--------------------------------------------------------
+paho calls on_message() from its network loop thread. Decoding, writing
+the audit row and log line, and running the handlers (several ORM queries
+each) used to happen right there, so a slow database stalled the socket
+and the broker started dropping QoS 0 traffic.
+
+In the MQTT worker, on_message() now only puts the raw message on a
+bounded in-process queue and returns. A small pool of ingestion threads
+does the rest:
+- Each worker owns one queue. Messages are routed by
+  crc32(estation_id), so the messages of one gateway are always handled
+  in order by the same worker.
+- A worker collects everything that arrives within a short window
+  ('MQTT_INGEST_BATCH_WINDOW_MS', up to 'MQTT_INGEST_MAX_BATCH' messages)
+  and hands the batch to mqtt_service.process_messages(). That handler
+  writes one bulk_create for the audit rows, one bulk gateway update for
+  all heartbeats, and one tag lookup for all results.
+- When a queue is full the message is dropped and counted, like the
+  broker would have done, but the network thread never blocks.
+
+METRICS: queue depth, lag (time from receipt to processing), batch sizes
+and drops are published to the shared cache every few seconds (see
+get_metrics()), so the admin dashboard can show them from another process.
+"""
+
+logger = logging.getLogger(__name__)
+
+METRICS_CACHE_KEY = "mqtt_ingest_metrics"
+METRICS_PUBLISH_SECONDS = 5
+
+
+def get_metrics():
+    """Last published ingestion metrics (None if no MQTT worker is running)."""
+    return cache.get(METRICS_CACHE_KEY)
+
+
+class IngestionPipeline:
+    """Bounded queues and worker threads that feed 'handler' with message batches."""
+
+    def __init__(self, handler, workers=None, max_queue=None, window_ms=None, max_batch=None):
+        self.handler = handler
+        self.workers = max(1, workers or settings.MQTT_INGEST_WORKERS)
+        self.window = (window_ms if window_ms is not None else settings.MQTT_INGEST_BATCH_WINDOW_MS) / 1000.0
+        self.max_batch = max_batch or settings.MQTT_INGEST_MAX_BATCH
+        per_worker = max(1, (max_queue or settings.MQTT_INGEST_QUEUE_SIZE) // self.workers)
+        self.queues = [queue.Queue(maxsize=per_worker) for _ in range(self.workers)]
+        self.threads = []
+        self.stopping = threading.Event()
+
+        self._lock = threading.Lock()
+        self.received = 0
+        self.processed = 0
+        self.dropped = 0
+        self.batches = 0
+        self.last_batch_size = 0
+        self.last_lag_ms = 0.0
+        self.max_lag_ms = 0.0
+        self._last_publish = 0.0
+
+    def start(self):
+        for index, q in enumerate(self.queues):
+            thread = threading.Thread(target=self._run, args=(q,), name=f"mqtt-ingest-{index}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        logger.info(f"MQTT ingestion started: {self.workers} workers, {self.window * 1000:.0f} ms batch window")
+
+    def stop(self, timeout=5):
+        self.stopping.set()
+        for thread in self.threads:
+            thread.join(timeout)
+        self.threads = []
+
+    def submit(self, topic, payload):
+        """Called from the network thread: never blocks. Returns False if the message was dropped."""
+        parts = topic.split('/')
+        key = parts[2].upper() if len(parts) > 2 else topic
+        q = self.queues[zlib.crc32(key.encode()) % self.workers]
+        try:
+            q.put_nowait((topic, payload, time.monotonic()))
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+                dropped = self.dropped
+            if dropped == 1 or dropped % 1000 == 0:
+                logger.warning(f"MQTT ingestion queue full: {dropped} messages dropped so far")
+            return False
+        with self._lock:
+            self.received += 1
+        return True
+
+    def _collect(self, q):
+        """Waits for one message, then gathers what arrives within the batch window."""
+        try:
+            batch = [q.get(timeout=1)]
+        except queue.Empty:
+            return []
+        deadline = time.monotonic() + self.window
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(q.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self, q):
+        while not self.stopping.is_set():
+            batch = self._collect(q)
+            if not batch:
+                continue
+            db.close_old_connections()
+            try:
+                self.handler(batch)
+            except Exception:
+                logger.exception(f"MQTT ingestion: batch of {len(batch)} messages failed")
+            self._record(batch)
+
+    def _record(self, batch):
+        lag_ms = (time.monotonic() - batch[0][2]) * 1000
+        with self._lock:
+            self.processed += len(batch)
+            self.batches += 1
+            self.last_batch_size = len(batch)
+            self.last_lag_ms = lag_ms
+            self.max_lag_ms = max(self.max_lag_ms, lag_ms)
+            publish = time.monotonic() - self._last_publish >= METRICS_PUBLISH_SECONDS
+            if publish:
+                self._last_publish = time.monotonic()
+        if publish:
+            try:
+                cache.set(METRICS_CACHE_KEY, self.metrics(), METRICS_PUBLISH_SECONDS * 6)
+            except Exception:
+                logger.exception("MQTT ingestion: could not publish metrics")
+
+    def metrics(self):
+        """Point-in-time counters (lag of the oldest message in the last batch)."""
+        with self._lock:
+            metrics = {
+                'queue_depth': sum(q.qsize() for q in self.queues),
+                'queue_capacity': sum(q.maxsize for q in self.queues),
+                'workers': self.workers,
+                'received': self.received,
+                'processed': self.processed,
+                'dropped': self.dropped,
+                'batches': self.batches,
+                'last_batch_size': self.last_batch_size,
+                'last_lag_ms': round(self.last_lag_ms, 1),
+                'max_lag_ms': round(self.max_lag_ms, 1),
+                'updated_at': time.time(),
+            }
+            # Peak lag is reported per publish interval
+            self.max_lag_ms = self.last_lag_ms
+        return metrics
@@ -0,0 +1,151 @@
+import collections
+import functools
+
+"""
+LAYOUT COMPILER: PRECOMPUTED TEMPLATE GEOMETRY
+----------------------------------------------
+The geometry of a label (split points, zones, barcode position, price
+limits, colours) depends only on the panel size, its color scheme and the
+template, never on the product. It used to be recalculated for every tag.
+
+'compile_layout()' computes it once per (width, height, color_scheme,
+template_id) and returns an immutable plan that lives for the life of
+the process. The drawing code in utils.py only fills the product's text
+into the precomputed boxes.
+
+Colours that change for promotional products are stored as a pair
+'(regular, promo)' and picked with 'plan.field[is_promo]'.
+
+Adding a template means adding a plan type and a compiler here, plus its
+base/price drawing functions in utils.TEMPLATE_LAYERS.
+"""
+
+# Padding and barcode quiet zone shared by all templates (see LayoutEngine)
+SAFE_PAD = 8
+QUIET_ZONE_PX = 10
+
+WHITE = (255, 255, 255)
+BLACK = (0, 0, 0)
+RED = (255, 0, 0)
+YELLOW = (255, 255, 0)
+
+V1Layout = collections.namedtuple('V1Layout', [
+    'width', 'height', 'safe_pad', 'quiet_zone',
+    'split_x', 'left_zone_w', 'price_zone_w',
+    'left_bg', 'price_bg', 'price_color', 'promo_icon',  # (regular, promo)
+    'barcode_h', 'barcode_y', 'sku_anchor',
+    'name_y', 'name_max_h',
+    'supplier_anchor', 'supplier_max_w',
+    'price_max_w', 'price_max_h', 'price_initial_size', 'price_y',
+])
+
+V2Layout = collections.namedtuple('V2Layout', [
+    'width', 'height',
+    'bg',  # (regular, promo)
+    'header_h', 'name_anchor',
+    'price_anchor', 'price_max_w', 'price_max_h', 'price_color',
+    'sku_anchor', 'special_anchor',
+])
+
+V3Layout = collections.namedtuple('V3Layout', [
+    'width', 'height', 'safe_pad', 'quiet_zone',
+    'split_x', 'left_zone_w', 'price_zone_w',
+    'right_bg', 'price_y',  # (regular, promo)
+    'barcode_h', 'barcode_y', 'sku_anchor',
+    'name_max_h',
+    'promo_icon', 'promo_color',
+    'price_x', 'price_max_w', 'price_max_h', 'price_color',
+])
+
+
+def _compile_v1(width, height, color_scheme):
+    is_color = 'R' in color_scheme or 'Y' in color_scheme
+
+    if is_color:
+        price_bg = (RED, RED) # Red/Yellow tags use a bright price box
+        price_color = (WHITE, WHITE)
+    else:
+        price_bg = (WHITE, BLACK)
+        price_color = (BLACK, WHITE)
+
+    split_x = int(width * 0.62)
+    left_zone_w = split_x - (SAFE_PAD * 2)
+    barcode_h = int(height * 0.25)
+    barcode_y = height - barcode_h - 15
+    name_y = 4
+
+    return V1Layout(
+        width=width, height=height, safe_pad=SAFE_PAD, quiet_zone=QUIET_ZONE_PX,
+        split_x=split_x, left_zone_w=left_zone_w, price_zone_w=width - split_x,
+        left_bg=(WHITE, YELLOW if 'Y' in color_scheme else WHITE),
+        price_bg=price_bg,
+        price_color=price_color,
+        # White icon on a dark (red or black) price box
+        promo_icon=tuple("white" if bg in (RED, BLACK) else "black" for bg in price_bg),
+        barcode_h=barcode_h, barcode_y=barcode_y,
+        sku_anchor=(SAFE_PAD + (left_zone_w // 2), height - 2),
+        # Name block ends 8px above the barcode
+        name_y=name_y, name_max_h=barcode_y - name_y - 8,
+        supplier_anchor=(split_x + (width - split_x) // 2, height - 8),
+        supplier_max_w=(width - split_x) - SAFE_PAD,
+        price_max_w=(width - split_x) - SAFE_PAD,
+        price_max_h=height * 0.60,
+        price_initial_size=int(height * 0.65),
+        price_y=height // 2,
+    )
+
+
+def _compile_v2(width, height, color_scheme):
+    return V2Layout(
+        width=width, height=height,
+        bg=(WHITE, YELLOW if 'Y' in color_scheme else WHITE),
+        header_h=25, name_anchor=(width // 2, 12),
+        price_anchor=(width // 2, height // 2 + 5),
+        price_max_w=width - 20, price_max_h=height - 60,
+        price_color=RED if 'R' in color_scheme else BLACK,
+        sku_anchor=(width - 5, height - 5),
+        special_anchor=(5, height - 5),
+    )
+
+
+def _compile_v3(width, height, color_scheme):
+    is_color = 'R' in color_scheme or 'Y' in color_scheme
+
+    split_x = int(width * 0.45)
+    left_zone_w = split_x - (SAFE_PAD * 2)
+    barcode_h = int(height * 0.18)
+    barcode_y = height - barcode_h - 22 # Lifted up to give SKU label room
+
+    return V3Layout(
+        width=width, height=height, safe_pad=SAFE_PAD, quiet_zone=QUIET_ZONE_PX,
+        split_x=split_x, left_zone_w=left_zone_w, price_zone_w=width - split_x,
+        right_bg=(WHITE, YELLOW if 'Y' in color_scheme else WHITE),
+        # Centred for regular tags, lowered under the promo banner otherwise
+        price_y=(height // 2, height - 35),
+        barcode_h=barcode_h, barcode_y=barcode_y,
+        sku_anchor=(SAFE_PAD + (left_zone_w // 2), height - 2),
+        # Name block ends 12px above the barcode
+        name_max_h=barcode_y - 12,
+        promo_icon="red" if is_color else "black",
+        promo_color=RED if is_color else BLACK,
+        price_x=split_x + (width - split_x) // 2,
+        price_max_w=(width - split_x) - 10, price_max_h=height // 2,
+        price_color=RED if is_color else BLACK,
+    )
+
+
+LAYOUT_COMPILERS = {
+    1: _compile_v1,
+    2: _compile_v2,
+    3: _compile_v3,
+}
+
+
+@functools.lru_cache(maxsize=256)
+def compile_layout(width, height, color_scheme, template_id):
+    """
+    Returns the immutable layout plan for a panel and template.
+    Unknown template IDs use the standard V1 layout.
+    """
+    compiler = LAYOUT_COMPILERS.get(template_id, _compile_v1)
+    return compiler(width, height, (color_scheme or "BW").upper())
@@ -0,0 +1,46 @@
+import asyncio
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+"""
+MANAGEMENT COMMAND: DELIVERY WORKER
+-----------------------------------
+Long-running process that sends queued tag images to the gateways from a
+single asyncio event loop (see core/delivery_daemon.py). Used when
+ESL_DELIVERY_MODE = 'daemon'; Celery workers then only render.
+
+Large installations can run several instances, each serving a share of
+the gateways.
+
+USAGE: python manage.py delivery_worker
+       python manage.py delivery_worker --shard 0 --shards 3  (plus shards 1 and 2)
+"""
+
+class Command(BaseCommand):
+    help = 'Runs the asyncio delivery daemon for gateway queues'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--shard', type=int, default=0, help='Shard served by this process (0-based)')
+        parser.add_argument('--shards', type=int, default=1, help='Total number of delivery worker processes')
+
+    def handle(self, *args, **options):
+        from core.delivery_daemon import DeliveryDaemon
+
+        try:
+            daemon = DeliveryDaemon(shard=options['shard'], shards=options['shards'])
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        if settings.ESL_DELIVERY_MODE != 'daemon':
+            self.stdout.write(self.style.WARNING(
+                "ESL_DELIVERY_MODE is not 'daemon': Celery queue loops will also deliver."
+            ))
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Starting delivery worker (shard {options['shard']} of {options['shards']}) "
+            f"via {settings.MQTT_SERVER}:{settings.MQTT_PORT}..."
+        ))
+        try:
+            asyncio.run(daemon.run())
+        except KeyboardInterrupt:
+            self.stdout.write(self.style.WARNING("Stopping delivery worker..."))
@@ -11,21 +11,37 @@ This is a standalone process that runs continuously in the background.
 It connects to the MQTT broker and listens for messages from the
 physical hardware (heartbeats, update results, etc.).
 
+Messages are handled by a pool of ingestion threads in micro-batches,
+off the MQTT network thread (see core/ingestion.py). Results are checked
+against a resident registry of gateways and tag tokens
+(see core/hardware_registry.py).
+
 In production, this is usually managed by a process supervisor
 like Systemd, Docker, or Supervisord.
 
 USAGE: python manage.py mqtt_worker
+       python manage.py mqtt_worker --ingest-workers 8
 """
 
 class Command(BaseCommand):
     help = 'Runs the MQTT listener for D21 eStation Gateways'
 
+    def add_arguments(self, parser):
+        parser.add_argument('--ingest-workers', type=int, default=None,
+                            help='Ingestion threads (default: MQTT_INGEST_WORKERS)')
+
     def handle(self, *args, **options):
         self.stdout.write(self.style.SUCCESS(
             f"Starting eStation MQTT Worker on {settings.MQTT_SERVER}:{settings.MQTT_PORT}..."
         ))
         
         try:
+            # Start the ingestion threads before any message can arrive
+            mqtt_service.start_ingestion(workers=options['ingest_workers'])
+
+            # Gateways and tag tokens in memory, kept current by announcements
+            mqtt_service.start_registry()
+
             # Connect to the broker and subscribe to topics
             mqtt_service.connect(subscribe=True)
 
@@ -38,6 +54,8 @@ class Command(BaseCommand):
         except KeyboardInterrupt:
             # Graceful shutdown when user presses Ctrl+C
             self.stdout.write(self.style.WARNING("Stopping MQTT Worker..."))
+            mqtt_service.stop_ingestion()
+            mqtt_service.stop_registry()
         except Exception as e:
             # Log any fatal crashes
             logging.getLogger(__name__).exception("MQTT Worker encountered a fatal error")
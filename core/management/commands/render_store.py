@@ -0,0 +1,48 @@
+from django.core.management.base import BaseCommand, CommandError
+from core.models import Store
+
+"""
+MANAGEMENT COMMAND: RENDER STORE
+--------------------------------
+Re-renders every paired tag of a store on a local process pool (the
+'render farm', see core/render_farm.py) and queues the images for
+delivery. Use it after template changes or a full catalogue import.
+
+USAGE: python manage.py render_store <store_id> [--workers 8] [--chunk-size 500]
+       python manage.py render_store <store_id> --background  (runs on a Celery worker)
+"""
+
+class Command(BaseCommand):
+    help = 'Re-renders all tag images of a store on a process pool'
+
+    def add_arguments(self, parser):
+        parser.add_argument('store_id', type=int)
+        parser.add_argument('--workers', type=int, default=None, help='Render processes (default: one per CPU core)')
+        parser.add_argument('--chunk-size', type=int, default=None, help='Tags claimed and written back per chunk')
+        parser.add_argument('--no-dispatch', action='store_true', help='Render only; do not queue the images for delivery')
+        parser.add_argument('--background', action='store_true', help='Run as a Celery task instead of in this process')
+
+    def handle(self, *args, **options):
+        from core.render_farm import render_store, RENDER_FARM_CHUNK_SIZE
+        from core.tasks import render_store_task
+
+        store = Store.objects.filter(pk=options['store_id']).first()
+        if not store:
+            raise CommandError(f"Store {options['store_id']} does not exist")
+
+        if options['background']:
+            result = render_store_task.delay(store.pk, workers=options['workers'])
+            self.stdout.write(self.style.SUCCESS(f"Render farm queued for {store.name} (Task: {result.id})"))
+            return
+
+        self.stdout.write(f"Rendering all tags of {store.name}...")
+        summary = render_store(
+            store.pk,
+            workers=options['workers'],
+            chunk_size=options['chunk_size'] or RENDER_FARM_CHUNK_SIZE,
+            dispatch=not options['no_dispatch'],
+        )
+        self.stdout.write(self.style.SUCCESS(
+            f"Rendered {summary['tags']} tags: {summary['renders']} renders, "
+            f"{summary['cache_hits']} cache hits in {summary['seconds']}s"
+        ))
@@ -165,6 +165,10 @@ class Command(BaseCommand):
             {'key': 'OFFLINE_TIMEOUT_MULTIPLIER', 'value': '4', 'description': 'Multiply heartbeat interval by this to determine offline status'},
             {'key': 'LOG_RETENTION_DAYS', 'value': '15', 'description': 'Number of days to keep MQTT communication logs'},
             {'key': 'ESL_SEND_DELAY_MS', 'value': '500', 'description': 'Delay in milliseconds between sending individual tags to a gateway'},
+            {'key': 'ESL_TASK_BATCH_SIZE', 'value': '1', 'description': 'Maximum tags sent to a gateway in one taskESL message (1 = one tag per message)'},
+            {'key': 'ESL_FLOW_CONTROL', 'value': '0', 'description': 'Pace delivery with an adaptive per-gateway window driven by /result acknowledgements (1 = on) instead of ESL_SEND_DELAY_MS'},
+            {'key': 'ESL_FLOW_MAX_WINDOW', 'value': '64', 'description': 'Maximum tags in flight per gateway when ESL_FLOW_CONTROL is on'},
+            {'key': 'RENDER_FARM_MIN_TAGS', 'value': '500', 'description': 'Store refreshes with at least this many tags use the process-pool render farm'},
             {'key': 'DEFAULT_GATEWAY_SERVER', 'value': '192.168.1.92:9081', 'description': 'Default server address (IP:Port) for hardware configuration'},
         ]
         for s in settings_to_seed:
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.14 on 2026-10-17 02:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0047_normalize_existing_macs'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='esltag',
+            name='render_hash',
+            field=models.CharField(blank=True, max_length=40, null=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.14 on 2026-10-17 02:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0048_esltag_render_hash'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='gateway',
+            name='payload_encoding',
+            field=models.CharField(choices=[('AUTO', 'Auto (by firmware version)'), ('BASE64', 'Base64 text (legacy)'), ('BINARY', 'Raw binary'), ('GZIP', 'Gzip-compressed binary')], default='AUTO', max_length=10, verbose_name='Image Payload Encoding'),
+        ),
+    ]
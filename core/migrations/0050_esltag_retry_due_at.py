@@ -0,0 +1,18 @@
+# Generated by Django 5.1.14 on 2026-10-17 03:06
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0049_gateway_payload_encoding'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='esltag',
+            name='retry_due_at',
+            field=models.DateTimeField(blank=True, db_index=True, null=True, verbose_name='Retry Due At'),
+        ),
+    ]
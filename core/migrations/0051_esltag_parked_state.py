@@ -0,0 +1,18 @@
+# Generated by Django 5.1.14 on 2026-10-17 03:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0050_esltag_retry_due_at'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='esltag',
+            name='sync_state',
+            field=models.CharField(choices=[('IDLE', 'No Pending Tasks'), ('PROCESSING', 'Generating Image...'), ('IMAGE_READY', 'Image Prepared'), ('PUSHED', 'Sent to Gateway'), ('RETRY_WAITING', 'Waiting for Retry'), ('PARKED', 'Waiting for Gateway'), ('SUCCESS', 'Update Confirmed'), ('GEN_FAILED', 'Image Generation Failed'), ('PUSH_FAILED', 'Gateway Delivery Failed'), ('FAILED', 'General Failure')], default='IDLE', max_length=20),
+        ),
+    ]
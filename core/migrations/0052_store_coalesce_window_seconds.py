@@ -0,0 +1,18 @@
+# Generated by Django 5.1.14 on 2026-10-17 03:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0051_esltag_parked_state'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='store',
+            name='coalesce_window_seconds',
+            field=models.PositiveIntegerField(default=10, help_text='Settle time for label edits before rendering (0 = render immediately)'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.1.14 on 2026-10-17 03:14
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0052_store_coalesce_window_seconds'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='esltag',
+            name='displayed_image_hash',
+            field=models.CharField(blank=True, max_length=40, null=True),
+        ),
+        migrations.AddField(
+            model_name='esltag',
+            name='pushed_image_hash',
+            field=models.CharField(blank=True, max_length=40, null=True),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 5.1.14 on 2026-10-17 03:23
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0053_esltag_image_hashes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TagBatteryDaily',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('min_level', models.SmallIntegerField(verbose_name='Lowest Battery %')),
+                ('max_level', models.SmallIntegerField(verbose_name='Highest Battery %')),
+                ('tag', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='battery_history', to='core.esltag')),
+            ],
+            options={
+                'verbose_name': 'Tag Battery Day',
+                'verbose_name_plural': 'Tag Battery History',
+                'ordering': ['-day'],
+                'unique_together': {('tag', 'day')},
+            },
+        ),
+    ]
@@ -177,6 +177,10 @@ class Store(AuditModel):
     name = models.CharField(max_length=255)
     location_code = models.CharField(max_length=50) 
     is_active = models.BooleanField(default=True)
+    # Edits to the store's labels within this window are rendered once (see core/coalesce.py)
+    coalesce_window_seconds = models.PositiveIntegerField(
+        default=10, help_text="Settle time for label edits before rendering (0 = render immediately)"
+    )
 
     def __str__(self):
         return f"{self.company.name} - {self.name}"
@@ -256,6 +260,16 @@ class Gateway(AuditModel):
     heartbeat_interval = models.IntegerField(null=True, blank=True, verbose_name="Heartbeat Interval (sec)")
     is_encrypt_enabled = models.BooleanField(default=True, verbose_name="Encryption Enabled")
 
+    # taskESL image encoding. 'AUTO' negotiates from the reported ap_version
+    # (see settings.ESL_PAYLOAD_MIN_AP_VERSION) and falls back to Base64.
+    PAYLOAD_ENCODING_CHOICES = [
+        ('AUTO', 'Auto (by firmware version)'),
+        ('BASE64', 'Base64 text (legacy)'),
+        ('BINARY', 'Raw binary'),
+        ('GZIP', 'Gzip-compressed binary'),
+    ]
+    payload_encoding = models.CharField(max_length=10, choices=PAYLOAD_ENCODING_CHOICES, default='AUTO', verbose_name="Image Payload Encoding")
+
     # Status & Error tracking
     tags_queued_count = models.IntegerField(default=0, verbose_name="Tags Queued")
     tags_comm_count = models.IntegerField(default=0, verbose_name="Tags in Communication")
@@ -297,6 +311,9 @@ class Gateway(AuditModel):
         REAL-TIME STATUS CALCULATION
         ----------------------------
         Returns a tuple of (status_code, status_label, color)
+        Judged from the instance's fields: callers load the live heartbeat
+        telemetry first with gateway_telemetry.apply(), one Redis round
+        trip for any number of gateways (see core/gateway_telemetry.py).
         """
         interval = self.heartbeat_interval or 15
         timeout_seconds = interval * 4
@@ -312,11 +329,42 @@ class Gateway(AuditModel):
 
         return ('ONLINE', f"Online ({label})", '#059669') # Green
 
+    def get_payload_encoding(self):
+        """
+        PAYLOAD NEGOTIATION
+        -------------------
+        Returns the taskESL image encoding to use for this gateway:
+        an explicit choice wins, otherwise the most compact encoding whose
+        minimum firmware version the gateway reports. Unknown or older
+        firmware keeps the legacy Base64 format.
+        """
+        if self.payload_encoding and self.payload_encoding != 'AUTO':
+            return self.payload_encoding
+
+        from .utils import parse_version
+        reported = parse_version(self.ap_version)
+        if reported:
+            for encoding in ('GZIP', 'BINARY'):
+                minimum = parse_version(settings.ESL_PAYLOAD_MIN_AP_VERSION.get(encoding))
+                if minimum and reported >= minimum:
+                    return encoding
+        return 'BASE64'
+
     def is_currently_online(self):
         """Helper for simple boolean checks, keeps compatibility with older logic."""
         status, _, _ = self.get_real_time_status()
         return status != 'OFFLINE'
 
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        # Saved by hand (admin, registration): the next heartbeat is written through
+        if self.estation_id:
+            from .gateway_telemetry import forget
+            from .hardware_registry import announce
+            forget([self.estation_id])
+            # The MQTT worker reloads the gateway (its store may have changed)
+            announce(gateways=[self.estation_id])
+
     def __str__(self):
         name_str = f" - {self.name}" if self.name else ""
         return f"{self.estation_id or 'No ID'}{name_str} ({self.store.name if self.store else 'No Store'})"
@@ -429,6 +477,7 @@ class ESLTag(AuditModel):
         ('IMAGE_READY', 'Image Prepared'),
         ('PUSHED', 'Sent to Gateway'),
         ('RETRY_WAITING', 'Waiting for Retry'),
+        ('PARKED', 'Waiting for Gateway'),
         ('SUCCESS', 'Update Confirmed'),
         ('GEN_FAILED', 'Image Generation Failed'),
         ('PUSH_FAILED', 'Gateway Delivery Failed'),
@@ -461,6 +510,8 @@ class ESLTag(AuditModel):
         blank=True
     )
     last_image_gen_success = models.DateTimeField(null=True, blank=True)
+    # Hash of the render inputs behind 'tag_image' (see utils.get_render_hash)
+    render_hash = models.CharField(max_length=40, null=True, blank=True)
     sync_state = models.CharField(max_length=20, choices=SYNC_STATES, default='IDLE')
 
     # Background Task Tracking (for Celery)
@@ -468,6 +519,12 @@ class ESLTag(AuditModel):
     last_image_task_token = models.IntegerField(null=True, blank=True)
     last_pushed_at = models.DateTimeField(null=True, blank=True, verbose_name="Last Pushed to Gateway")
     retry_count = models.IntegerField(default=0)
+    # When a RETRY_WAITING tag is due again (swept by sweep_due_retries_task)
+    retry_due_at = models.DateTimeField(null=True, blank=True, db_index=True, verbose_name="Retry Due At")
+    # SHA-1 of the image bytes last sent, and of the image the tag confirmed (what is on the glass).
+    # Delivery skips images identical to the displayed one (see core/delivery.py).
+    pushed_image_hash = models.CharField(max_length=40, null=True, blank=True)
+    displayed_image_hash = models.CharField(max_length=40, null=True, blank=True)
 
     # Hardware Status (Telemetery)
     battery_level = models.IntegerField(default=100)
@@ -490,6 +547,8 @@ class ESLTag(AuditModel):
             'paired_product_id': self.__dict__.get('paired_product_id'),
             'template_id': self.__dict__.get('template_id'),
             'hardware_spec_id': self.__dict__.get('hardware_spec_id'),
+            'tag_mac': self.__dict__.get('tag_mac'),
+            'store_id': self.__dict__.get('store_id'),
         }
 
     def clean(self):
@@ -533,12 +592,20 @@ class ESLTag(AuditModel):
             # Reset image and status if product is removed
             if self._original_data['paired_product_id'] and not self.paired_product_id:
                 self.tag_image = None
+                self.render_hash = None
                 self.sync_state = 'IDLE'
                 self.last_image_gen_success = None
 
+        # A tag under a new MAC or store is looked up again by the MQTT worker
+        moved = bool(self.pk) and (self._original_data['tag_mac'] != self.tag_mac or
+                                   self._original_data['store_id'] != self.store_id)
+
         # Run full_clean() manually as Django models don't call it automatically on save()
         self.full_clean()
         super().save(*args, **kwargs)
+        if moved:
+            from .hardware_registry import announce
+            announce(dropped=[self.pk])
         # Performance: Refresh snapshot after save to allow multi-save cycles in one process
         self._set_original_data()
 
@@ -552,6 +619,30 @@ class ESLTag(AuditModel):
         verbose_name_plural = "ESL Tags"
 
 
+class TagBatteryDaily(models.Model):
+    """
+    BATTERY HISTORY (DOWNSAMPLED)
+    -----------------------------
+    One row per tag and day with the lowest and highest battery level
+    reported that day. Tags report their battery in every gateway heartbeat;
+    keeping only the daily range gives a compact trend for spotting
+    draining tags without a row per sample (see core/battery_history.py).
+    """
+    tag = models.ForeignKey(ESLTag, on_delete=models.CASCADE, related_name='battery_history')
+    day = models.DateField()
+    min_level = models.SmallIntegerField(verbose_name="Lowest Battery %")
+    max_level = models.SmallIntegerField(verbose_name="Highest Battery %")
+
+    class Meta:
+        unique_together = ('tag', 'day')
+        verbose_name = "Tag Battery Day"
+        verbose_name_plural = "Tag Battery History"
+        ordering = ['-day']
+
+    def __str__(self):
+        return f"{self.tag_id} | {self.day} | {self.min_level}-{self.max_level}%"
+
+
 class MQTTMessage(models.Model):
     """
     COMMUNICATION LOG (EVENT LOG)
@@ -6,10 +6,16 @@ import os
 import random
 import gzip
 import io
+import time
+import threading
 from datetime import datetime, timedelta
 from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, When, Value, F
+from django.db.models.functions import Upper
 from django.utils import timezone
 from .models import ESLTag, Gateway, Store, GlobalSetting, MQTTMessage
+from . import flow_control, battery_history, hardware_registry, protocol
 
 """
 MQTT COMMUNICATION ENGINE: THE SYSTEM BACKBONE
@@ -21,6 +27,13 @@ PROTOCOL DETAILS:
 - Port: 9081 (standard for D21 eStations)
 - Serialization: MessagePack (msgpack).
 - Format: Supports both legacy Dictionary and new Hardware List formats.
+  Each payload is decoded once, per topic, into a small struct that the
+  handlers and the audit log share (see core/protocol.py).
+
+INGESTION: In the MQTT worker, incoming messages are queued and handled
+in micro-batches by ingestion threads (see core/ingestion.py and
+process_messages()), so the network thread never waits for the database.
+Elsewhere, or before start_ingestion(), messages are handled inline.
 """
 
 logger = logging.getLogger(__name__)
@@ -50,6 +63,8 @@ class ESLMqttClient:
             # Use default protocol (v3.1.1) for maximum hardware compatibility
             self.client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
             self.should_subscribe = False
+            self.ingestion = None
+            self.registry = None
 
             # Register callbacks (Event Handlers)
             self.client.on_connect = self.on_connect
@@ -88,6 +103,34 @@ class ESLMqttClient:
         except Exception:
             logger.exception("MQTT Connection Failed")
 
+    def start_ingestion(self, **options):
+        """Moves message handling off the network thread (see core/ingestion.py)."""
+        from .ingestion import IngestionPipeline
+        if self.ingestion is None:
+            self.ingestion = IngestionPipeline(self.process_messages, **options)
+            self.ingestion.start()
+        return self.ingestion
+
+    def stop_ingestion(self):
+        if self.ingestion is not None:
+            self.ingestion.stop()
+            self.ingestion = None
+
+    def start_registry(self):
+        """Keeps gateways and tag tokens in memory for result checks (see core/hardware_registry.py)."""
+        if self.registry is None:
+            self.registry = hardware_registry.HardwareRegistry()
+            self._registry_stopping = threading.Event()
+            threading.Thread(
+                target=self.registry.listen, args=(self._registry_stopping,), name="hardware-registry", daemon=True
+            ).start()
+        return self.registry
+
+    def stop_registry(self):
+        if self.registry is not None:
+            self._registry_stopping.set()
+            self.registry = None
+
     def on_connect(self, client, userdata, flags, rc, properties=None):
         """
         EVENT: CONNECTED
@@ -119,52 +162,73 @@ class ESLMqttClient:
         EVENT: MESSAGE RECEIVED
         -----------------------
         The central traffic controller for all incoming MQTT data.
+        Runs on paho's network thread: with ingestion started, the message
+        is only queued here and handled by process_messages() in a batch.
         """
         try:
             # Diagnostic log for tracking all incoming data
             logger.debug(f"MQTT Data received on {msg.topic}: {msg.payload[:100]!r}...")
 
-            # Topic format is usually: /estation/<estation_id>/<command>
-            topic_parts = msg.topic.split('/')
-            if len(topic_parts) < 3: return
-            estation_id = topic_parts[2]
+            if self.ingestion is not None:
+                self.ingestion.submit(msg.topic, msg.payload)
+            else:
+                self.process_messages([(msg.topic, msg.payload, time.monotonic())])
+        except Exception:
+            logger.exception(f"Error processing MQTT message on topic {msg.topic}")
 
-            # DATA UNPACKING (De-serialization)
+    def process_messages(self, messages):
+        """
+        BATCH HANDLER
+        -------------
+        Handles a list of (topic, payload, received_at) in one go:
+        one bulk insert for the audit log, one bulk update for all
+        heartbeats, one tag lookup for all results. Messages of a gateway
+        keep their order within each kind.
+        """
+        # DATA UNPACKING: each packet is decoded once (see core/protocol.py)
+        packets = []
+        for topic, payload, _ in messages:
             try:
-                # Use raw=False to ensure strings are correctly decoded from bytes
-                data = msgpack.unpackb(msg.payload, raw=False)
-            except Exception:
-                try:
-                    data = json.loads(msg.payload.decode())
-                except Exception:
-                    logger.error(f"Failed to unpack MQTT payload on {msg.topic}")
-                    return
-
-            # Log every message to the DB for auditing
-            self._log_mqtt_message("received", estation_id, msg.topic, data)
-
-            # Route to specific business logic handlers
-            if msg.topic.endswith("/result"):
-                self.handle_result(estation_id, data)
-            elif msg.topic.endswith("/heartbeat"):
-                self.handle_heartbeat(estation_id, data)
-
+                packet = protocol.decode(topic, payload)
+            except ValueError:
+                logger.error(f"Failed to unpack MQTT payload on {topic}")
+                continue
+            if packet is not None:
+                packets.append(packet)
+
+        if not packets:
+            return
+
+        # Log every message to the DB for auditing (one INSERT for the batch)
+        self._write_log_entries("received", [
+            self._build_log_entry("received", p.estation_id, p.topic, p.data, message=p.message) for p in packets
+        ])
+
+        # Route to specific business logic handlers, grouped by kind.
+        # Registrations first, so heartbeats and results can find new gateways.
+        infors, heartbeats, tag_lists, results = [], [], {}, []
+        for packet in packets:
+            estation_id, message = packet.estation_id, packet.message
+            if packet.kind == 'result':
+                results.append((estation_id, message))
+            elif packet.kind == 'heartbeat':
+                heartbeats.append((estation_id, message))
                 # Hardware can send a list of tags inside the heartbeat
-                tags = []
-                if isinstance(data, list) and len(data) > 8:
-                    tags = data[8]
-                elif isinstance(data, dict):
-                    tags = data.get('Tags', [])
-
-                if tags:
-                    self._process_tags(estation_id, tags)
-
-            elif msg.topic.endswith("/tagheartbeat"):
-                self.handle_tag_heartbeat(estation_id, data)
-            elif msg.topic.endswith("/infor"):
-                self.handle_infor(estation_id, data)
-        except Exception:
-            logger.exception(f"Error processing MQTT message on topic {msg.topic}")
+                if message is not None and message.tags:
+                    tag_lists.setdefault(estation_id, []).extend(message.tags)
+            elif packet.kind == 'tagheartbeat':
+                tag_lists.setdefault(estation_id, []).extend(message or [])
+            elif packet.kind == 'infor':
+                infors.append((estation_id, message))
+
+        for estation_id, infor in infors:
+            self._register_gateway(estation_id, infor)
+        if heartbeats:
+            self.handle_heartbeats(heartbeats)
+        for estation_id, reports in tag_lists.items():
+            self._process_tag_reports(estation_id, reports)
+        if results:
+            self.handle_results(results)
 
     def _calculate_battery_percentage(self, voltage_raw):
         """
@@ -191,128 +255,185 @@ class ESLMqttClient:
         Triggered when a Gateway reports back after trying to update a tag.
         Supports both single-tag and multi-tag result formats.
         """
-        try:
-            tag_results = []
-
-            # 1. Identify format and normalize to a list of tag result objects
-            if isinstance(data, list):
-                # New Multi-tag format: [Port, WaitCount, SendCount, MessageCode, [TagResult1, ...]]
-                if len(data) >= 5 and isinstance(data[4], list):
-                    for tr in data[4]:
-                        if isinstance(tr, list) and len(tr) >= 6:
-                            tag_results.append({
-                                'tag_mac': tr[0],
-                                'battery_raw': tr[2],
-                                'status_code': tr[4],
-                                'token': tr[5]
-                            })
-                # Legacy/Single-tag format: [TagID, RfPower, Battery, Version, Status, Token, ...]
-                else:
-                    # Handle nested list wrapper if present
-                    if len(data) == 1 and isinstance(data[0], list):
-                        data = data[0]
-
-                    if len(data) >= 6:
-                        tag_results.append({
-                            'tag_mac': data[0],
-                            'battery_raw': data[2],
-                            'status_code': data[4],
-                            'token': data[5]
-                        })
-            elif isinstance(data, dict):
-                tag_results.append({
-                    'tag_mac': data.get('TagId'),
-                    'battery_raw': data.get('Battery'),
-                    'status_code': data.get('Status'),
-                    'token': data.get('Token')
-                })
+        self.handle_results([(estation_id, protocol.decode_result(data))])
 
-            if not tag_results:
-                return
+    @staticmethod
+    def _gateways_by_id(estation_ids, queryset=None):
+        """Case-insensitive lookup of several gateways in one query, keyed by upper-case ID."""
+        queryset = Gateway.objects.all() if queryset is None else queryset
+        ids = {e.strip().upper() for e in estation_ids}
+        return {gw.upper_estation_id: gw for gw in queryset.annotate(upper_estation_id=Upper('estation_id')).filter(upper_estation_id__in=ids)}
 
-            # 2. Identify which gateway sent this
-            gateway = Gateway.objects.filter(estation_id__iexact=estation_id.strip()).first()
-            if not gateway:
-                logger.error(f"Received result from unknown gateway {estation_id}")
+    def handle_results(self, messages):
+        """
+        Result handling for a batch of (estation_id, protocol.Result) messages.
+        Tokens are checked against the resident registry in the MQTT
+        worker (core/hardware_registry.py), or one query per batch
+        elsewhere. Outcomes are written with one UPDATE for successes and
+        one for failures, which go through the retry policy together.
+        """
+        try:
+            # 1. Results that report at least one tag (decoded by core/protocol.py)
+            parsed = [
+                (estation_id, result.tags, result.message_code)
+                for estation_id, result in messages if result is not None and result.tags
+            ]
+            if not parsed:
                 return
 
+            # 2. Identify which gateways sent these (from memory in the MQTT worker)
+            estation_ids = [estation_id for estation_id, _, _ in parsed]
+            if self.registry is not None:
+                gateways = self.registry.gateways_by_id(estation_ids)
+            else:
+                gateways = hardware_registry.load_gateways(estation_ids)
+
             # 3. Process each tag result
             from .utils import normalize_mac
 
-            # Pre-fetch tags for efficiency (Bulk Lookup - now O(1) via index)
-            macs_to_find = [normalize_mac(r['tag_mac']) for r in tag_results if r.get('tag_mac')]
-            tags_map = {}
-            if macs_to_find:
-                db_tags = ESLTag.objects.filter(store=gateway.store, tag_mac__in=macs_to_find)
-                for t in db_tags:
-                    tags_map[t.tag_mac] = t
-
-            tags_to_bulk_update = []
+            # Tag ID and expected token per (store, MAC): resident registry or one query per batch
+            store_ids = {gw.store_id for gw in gateways.values()}
+            if self.registry is not None:
+                find_tag = self.registry.tag_lookup(store_ids)
+            else:
+                macs_to_find = {normalize_mac(r.tag_mac) for _, results, _ in parsed for r in results if r.tag_mac}
+                tags_map = hardware_registry.load_tags(store_ids, macs_to_find) if macs_to_find and store_ids else {}
+                find_tag = lambda store_id, mac: tags_map.get((store_id, mac))
+
+            if self.registry is not None:
+                # A result can beat the announcement of its push, or the announcement was
+                # lost: re-read unknown tags and mismatched tokens before rejecting them
+                unverified = set()
+                for estation_id, tag_results, _ in parsed:
+                    gateway = gateways.get(estation_id.strip().upper())
+                    if not gateway: continue
+                    for res in tag_results:
+                        if not res.tag_mac or res.token is None: continue
+                        key = (gateway.store_id, normalize_mac(res.tag_mac))
+                        tag = find_tag(*key)
+                        if tag is None or (res.token & 0x3FFF) != ((tag.token or 0) & 0x3FFF):
+                            unverified.add(key)
+                self.registry.refresh(unverified)
+
+            # Outcomes per tag ID; written with one UPDATE each for successes and failures
+            confirmed, batteries = {}, {}
+            failures = []
+            # Per gateway: [gateway, confirmed, latest message code]
+            confirmed_by_gateway = {}
             now = timezone.now()
 
-            for res in tag_results:
-                try:
-                    tag_mac = res.get('tag_mac')
-                    if not tag_mac: continue
-
-                    clean_mac = normalize_mac(tag_mac)
-                    tag = tags_map.get(clean_mac)
-
-                    if not tag:
-                        logger.warning(f"Result for unknown tag {tag_mac} in store {gateway.store}")
-                        continue
-
-                    # Verify Token
-                    received_token = res.get('token')
-                    if received_token is None:
-                        logger.warning(f"Tag {tag_mac} result has no token.")
-                        continue
-
-                    received_token_id = received_token & 0x3FFF
-                    expected_token_id = (tag.last_image_task_token or 0) & 0x3FFF
-
-                    if received_token_id == expected_token_id:
-                        status_code = res.get('status_code')
-                        is_success = (status_code == 1 or status_code == 128)
-
-                        # Check if this is the latest retry (for log clarity)
-                        received_retry_count = (received_token >> 14) & 0x03
-
-                        battery_pct = self._calculate_battery_percentage(res.get('battery_raw'))
-
-
-                        tag.updated_at = now
-                        if battery_pct is not None:
-                            tag.battery_level = battery_pct
-
-                        if is_success:
-                            tag.sync_state = 'SUCCESS'
-                            tag.last_successful_gateway_id = estation_id
-                            tag.retry_count = 0
-                            tags_to_bulk_update.append(tag)
-                            logger.info(f"Tag {tag_mac} sync: SUCCESS (Retry: {received_retry_count}, Batt: {battery_pct}%)")
+            for estation_id, tag_results, message_code in parsed:
+                gateway = gateways.get(estation_id.strip().upper())
+                if not gateway:
+                    logger.error(f"Received result from unknown gateway {estation_id}")
+                    continue
+
+                stats = confirmed_by_gateway.setdefault(gateway.pk, [gateway, 0, None])
+                if message_code is not None:
+                    stats[2] = message_code
+                for res in tag_results:
+                    try:
+                        tag_mac = res.tag_mac
+                        if not tag_mac: continue
+
+                        clean_mac = normalize_mac(tag_mac)
+                        tag = find_tag(gateway.store_id, clean_mac)
+
+                        if not tag:
+                            logger.warning(f"Result for unknown tag {tag_mac} in store {gateway.store_id}")
+                            continue
+
+                        # Verify Token
+                        received_token = res.token
+                        if received_token is None:
+                            logger.warning(f"Tag {tag_mac} result has no token.")
+                            continue
+
+                        received_token_id = received_token & 0x3FFF
+                        expected_token_id = (tag.token or 0) & 0x3FFF
+
+                        if received_token_id == expected_token_id:
+                            status_code = res.status_code
+                            is_success = res.is_success
+
+                            # Check if this is the latest retry (for log clarity)
+                            received_retry_count = (received_token >> 14) & 0x03
+
+                            battery_pct = self._calculate_battery_percentage(res.battery_raw)
+                            if battery_pct is not None:
+                                batteries[tag.tag_id] = battery_pct
+
+                            if is_success:
+                                confirmed[tag.tag_id] = estation_id
+                                stats[1] += 1
+                                logger.info(f"Tag {tag_mac} sync: SUCCESS (Retry: {received_retry_count}, Batt: {battery_pct}%)")
+                            else:
+                                # Failures are handled together after the loop (core/retries.py)
+                                failures.append((tag.tag_id, f"Hardware Status Code: {status_code}"))
+                                logger.warning(f"Tag {tag_mac} sync: FAILED (Retry: {received_retry_count}, Code: {status_code})")
                         else:
-                            # Use direct update for failures to ensure consistent DB state before task dispatch
-                            tag.save(update_fields=['battery_level', 'updated_at'] if battery_pct is not None else ['updated_at'])
-
-
-                            from .tasks import handle_tag_failure_task
-                            handle_tag_failure_task.delay(tag.id, reason=f"Hardware Status Code: {status_code}")
-                            logger.warning(f"Tag {tag_mac} sync: FAILED (Retry: {received_retry_count}, Code: {status_code})")
-                    else:
-                        logger.warning(f"Token mismatch {tag_mac}: Exp {expected_token_id}, Got {received_token_id}")
-                except Exception as e:
-                    logger.error(f"Error processing single tag result {res.get('tag_mac')}: {str(e)}")
-
-            if tags_to_bulk_update:
-                ESLTag.objects.bulk_update(
-                    tags_to_bulk_update,
-                    ['sync_state', 'last_successful_gateway_id', 'retry_count', 'battery_level', 'updated_at']
+                            logger.warning(f"Token mismatch {tag_mac}: Exp {expected_token_id}, Got {received_token_id}")
+                    except Exception as e:
+                        logger.error(f"Error processing single tag result {res.tag_mac}: {str(e)}")
+
+
+            if confirmed:
+                # The confirmed image is now what the tag displays
+                ESLTag.objects.filter(pk__in=list(confirmed)).update(
+                    sync_state='SUCCESS',
+                    displayed_image_hash=F('pushed_image_hash'),
+                    last_successful_gateway_id=self._value_per_tag('last_successful_gateway_id', confirmed),
+                    retry_count=0,
+                    updated_at=now,
+                    **self._battery_update(batteries, confirmed)
                 )
 
+            if failures:
+                # Write telemetry first so the DB state is consistent before retries are scheduled
+                failed_ids = {tag_id for tag_id, _ in failures}
+                ESLTag.objects.filter(pk__in=list(failed_ids)).update(updated_at=now, **self._battery_update(batteries, failed_ids))
+                from .retries import process_tag_failures
+                process_tag_failures(failures)
+
+            # 4. FLOW CONTROL: Results free slots in the gateway's window,
+            # so the next batch is sent right away instead of on a timer.
+            for gateway, confirmed, message_code in confirmed_by_gateway.values():
+                flow_control.record_results(gateway.estation_id, confirmed, message_code)
+            if flow_control.is_enabled():
+                from .tasks import trigger_gateway_processing
+                for gateway, _, _ in confirmed_by_gateway.values():
+                    if ESLTag.objects.filter(gateway_id=gateway.pk, sync_state='IMAGE_READY').exists():
+                        trigger_gateway_processing(gateway.estation_id)
+
         except Exception:
             logger.exception("Error handling MQTT result message")
 
+    @staticmethod
+    def _value_per_tag(field, values):
+        """CASE expression giving each tag its value from {tag_id: value}, one WHEN per distinct value."""
+        by_value = {}
+        for tag_id, value in values.items():
+            by_value.setdefault(value, []).append(tag_id)
+        return Case(*[When(pk__in=ids, then=Value(value)) for value, ids in by_value.items()], default=F(field))
+
+    @classmethod
+    def _battery_update(cls, batteries, tag_ids):
+        """UPDATE kwargs for the reported battery levels of 'tag_ids' (12.5% steps, so few WHENs)."""
+        levels = {tag_id: batteries[tag_id] for tag_id in tag_ids if tag_id in batteries}
+        return {'battery_level': cls._value_per_tag('battery_level', levels)} if levels else {}
+
+    # Heartbeat message codes that put a gateway in the ERROR state
+    HEARTBEAT_ERROR_CODES = {
+        5: "ModError: Abnormality of the communication module",
+        6: "AppError: Abnormality of the main program",
+        7: "Busy: The device is busy",
+        8: "MaxLimit: Data queue limit reached",
+        9: "InvalidTaskESL: Incorrect ESL task data",
+        10: "InvalidTaskDSL: Incorrect DSL task data",
+        11: "InvalidConfig: Incorrect configuration data",
+        12: "InvalidOTA: Incorrect OTA data"
+    }
+
     def handle_heartbeat(self, estation_id, data):
         """
         GATEWAY TELEMETRY (Heartbeat)
@@ -320,65 +441,108 @@ class ESLMqttClient:
         Updates the Gateway record with its current status.
         Supports 9-element list format.
         """
+        self.handle_heartbeats([(estation_id, protocol.decode_heartbeat(data))])
+
+    def _parse_heartbeat(self, estation_id, heartbeat):
+        """Returns (estation_id, update_data) for a protocol.Heartbeat, or None if malformed."""
+        if heartbeat is None:
+            logger.warning(f"Heartbeat for {estation_id} is malformed")
+            return None
+
+        now = timezone.now()
+        update_data = {
+            'last_heartbeat': now,
+            'last_successful_heartbeat': now,
+            'is_online': 'ONLINE',
+            'last_seen': now,
+            'ap_version': heartbeat.ap_version,
+            'module_version': heartbeat.module_version,
+            'tags_queued_count': heartbeat.queued,
+            'tags_comm_count': heartbeat.comm,
+        }
+
+        # The legacy dictionary format has no AP ID or message code
+        if not heartbeat.legacy:
+            # If AP ID is provided and not empty, use it as estation_id
+            if heartbeat.ap_id:
+                estation_id = heartbeat.ap_id
+
+            msg_code = heartbeat.msg_code
+            update_data['last_error_code'] = msg_code
+            if msg_code in self.HEARTBEAT_ERROR_CODES:
+                update_data['is_online'] = 'ERROR'
+                update_data['last_error_message'] = self.HEARTBEAT_ERROR_CODES[msg_code]
+                update_data['last_error_timestamp'] = now
+            elif msg_code in [1, 2, 3, 4]:
+                update_data['is_online'] = 'ONLINE'
+                update_data['last_error_message'] = None
+        return estation_id.strip(), update_data
+
+    def handle_heartbeats(self, messages):
+        """
+        Heartbeat handling for a batch of (estation_id, protocol.Heartbeat) messages.
+        The latest heartbeat per gateway wins. Heartbeats that change
+        nothing durable only refresh the gateway's telemetry in Redis
+        (core/gateway_telemetry.py, flushed to the database in bulk).
+        The others are written through: all their gateways are locked,
+        read and written back with one bulk update. A gateway that was
+        OFFLINE under the lock is a reconnect, seen by exactly one batch
+        even if several workers or processes receive heartbeats at once.
+        """
+        latest = {}
+        for estation_id, heartbeat in messages:
+            try:
+                parsed = self._parse_heartbeat(estation_id, heartbeat)
+            except Exception:
+                logger.exception(f"Error handling heartbeat for gateway {estation_id}")
+                continue
+            if parsed:
+                latest[parsed[0].upper()] = parsed
+        if not latest:
+            return
+
         try:
-            # Message Code mapping
-            ERROR_CODES = {
-                5: "ModError: Abnormality of the communication module",
-                6: "AppError: Abnormality of the main program",
-                7: "Busy: The device is busy",
-                8: "MaxLimit: Data queue limit reached",
-                9: "InvalidTaskESL: Incorrect ESL task data",
-                10: "InvalidTaskDSL: Incorrect DSL task data",
-                11: "InvalidConfig: Incorrect configuration data",
-                12: "InvalidOTA: Incorrect OTA data"
-            }
+            from . import gateway_telemetry
 
-            update_data = {
-                'last_heartbeat': timezone.now(),
-                'last_successful_heartbeat': timezone.now(),
-                'is_online': 'ONLINE',
-                'last_seen': timezone.now()
-            }
+            # WRITE-BEHIND: Only state changes (and unknown gateways) reach the database now
+            volatile, durable = gateway_telemetry.split(latest)
+            gateway_telemetry.record(volatile)
 
-            if isinstance(data, list):
-                # 9-element list format: [AP ID, ConfigVer, BaseVer, BlueVer, MsgCode, MsgExt, Queued, Comm, Tags]
-                if len(data) >= 8:
-                    # If AP ID is provided and not empty, use it as estation_id
-                    if data[0] and str(data[0]).strip():
-                        estation_id = str(data[0]).strip()
-
-                    msg_code = data[4]
-                    update_data.update({
-                        'ap_version': data[2],
-                        'module_version': data[3],
-                        'tags_queued_count': data[6],
-                        'tags_comm_count': data[7],
-                        'last_error_code': msg_code,
-                    })
-
-                    if msg_code in ERROR_CODES:
-                        update_data['is_online'] = 'ERROR'
-                        update_data['last_error_message'] = ERROR_CODES[msg_code]
-                        update_data['last_error_timestamp'] = timezone.now()
-                    elif msg_code in [1, 2, 3, 4]:
-                        update_data['is_online'] = 'ONLINE'
-                        update_data['last_error_message'] = None
-                else:
-                    logger.warning(f"Heartbeat for {estation_id} has unexpected length: {len(data)}")
-                    return
-            else:
-                # Fallback to dictionary if needed, but primarily expecting list
-                update_data.update({
-                    'ap_version': data.get('ApVersion'),
-                    'module_version': data.get('ModVersion'),
-                    'tags_queued_count': data.get('Queued', 0),
-                    'tags_comm_count': data.get('Comm', 0),
-                })
+            if durable:
+                self._write_heartbeats(durable)
 
-            # Trigger the update (case-insensitive lookup)
-            Gateway.objects.filter(estation_id__iexact=estation_id.strip()).update(**update_data)
+            # Backlog and Busy/MaxLimit codes feed the delivery window
+            for estation_id, update_data in latest.values():
+                flow_control.record_heartbeat(estation_id, update_data.get('tags_queued_count'), update_data.get('last_error_code'))
         except Exception:
-            logger.exception(f"Error handling heartbeat for gateway {estation_id}")
+            logger.exception(f"Error handling heartbeats for gateways {', '.join(latest)}")
+
+    def _write_heartbeats(self, heartbeats):
+        """Writes heartbeats through to the gateway table and detects reconnects."""
+        from . import gateway_telemetry
+
+        # Trigger the update (case-insensitive lookup)
+        with transaction.atomic():
+            gateways = self._gateways_by_id(heartbeats, Gateway.objects.select_for_update())
+            reconnected = [gw for gw in gateways.values() if gw.is_online == 'OFFLINE']
+
+            fields = set()
+            for upper_id, gateway in gateways.items():
+                update_data = heartbeats[upper_id][1]
+                for field, value in update_data.items():
+                    setattr(gateway, field, value)
+                fields.update(update_data)
+            if gateways:
+                Gateway.objects.bulk_update(gateways.values(), sorted(fields))
+
+        # Written through: the hash starts from the row's new state
+        gateway_telemetry.record({upper_id: heartbeats[upper_id] for upper_id in gateways}, dirty=False)
+
+        if reconnected:
+            from .tasks import on_gateway_reconnected
+            for gateway in reconnected:
+                logger.info(f"Gateway {gateway.estation_id} is back ONLINE")
+                on_gateway_reconnected(gateway.store_id)
 
     def handle_infor(self, estation_id, data):
         """
@@ -386,75 +550,61 @@ class ESLMqttClient:
         -------------------------
         Supports 17-element list format.
         """
+        self._register_gateway(estation_id, protocol.decode_infor(data))
+
+    def _register_gateway(self, estation_id, infor):
+        """Creates or updates the gateway described by a protocol.Infor."""
         try:
+            if infor is None:
+                logger.warning(f"Infor for {estation_id} is malformed")
+                return
+
             # Normalize ID for robust lookup
-            clean_id = estation_id.strip()
+            clean_id = infor.ap_id or estation_id.strip()
+            mac = infor.mac
+            if not mac: return
 
             update_data = {
                 'estation_id': clean_id,
                 'is_online': 'ONLINE',
                 'last_heartbeat': timezone.now(),
                 'last_seen': timezone.now(),
-                'last_error_message': None
+                'last_error_message': None,
+                'alias': infor.alias,
+                'gateway_ip': infor.ip, # Gateway IP assigned by router
+                'gateway_mac': mac,
+                'ap_type': infor.ap_type,
+                'ap_version': infor.ap_version,
+                'module_version': infor.module_version,
+                'disk_size': infor.disk_size,
+                'free_space': infor.free_space,
+                'heartbeat_interval': infor.heartbeat_interval,
             }
 
-            if isinstance(data, list):
-                # 17-element format: [ID, Nickname, LocalIP, MAC, ApType, MainVer, ModVer, Disk, Available, ServerIP, ConnParam, AutoIP, FixedIP, Mask, Gateway, ??, Heartbeat]
-                if len(data) >= 17:
-                    # Update estation_id if present in index 0
-                    if data[0] and str(data[0]).strip():
-                        clean_id = str(data[0]).strip()
-                        update_data['estation_id'] = clean_id
-
-                    mac = data[3]
-                    update_data.update({
-                        'alias': data[1],
-                        'gateway_ip': data[2], # Gateway IP assigned by router
-                        'gateway_mac': mac,
-                        'ap_type': data[4],
-                        'ap_version': data[5],
-                        'module_version': data[6],
-                        'disk_size': data[7],
-                        'free_space': data[8],
-                        'netmask': data[13],
-                        'network_gateway': data[14],
-                        'heartbeat_interval': int(data[16]) if data[16] else 15,
-                        'is_auto_ip': data[11], # Always True per user requirement
-                    })
-
-                    server = data[9]
-                    if server:
-                        if ':' in server:
-                            parts = server.split(':', 1)
-                            update_data['app_server_ip'] = parts[0]
-                            try:
-                                update_data['app_server_port'] = int(parts[1])
-                            except (ValueError, TypeError): pass
-                        else:
-                            update_data['app_server_ip'] = server
-
-                    conn_param = data[10]
-                    if isinstance(conn_param, list) and len(conn_param) >= 2:
-                        update_data['username'] = conn_param[0]
-                        update_data['password'] = conn_param[1]
-                else:
-                    logger.warning(f"Infor for {estation_id} has unexpected length: {len(data)}")
-                    return
-            else:
-                mac = data.get('MAC')
-                if not mac: return
+            # Network settings are only part of the 17-element format
+            if not infor.legacy:
                 update_data.update({
-                    'alias': data.get('Alias'),
-                    'gateway_ip': data.get('IP'),
-                    'gateway_mac': mac,
-                    'ap_type': data.get('ApType'),
-                    'ap_version': data.get('ApVersion'),
-                    'module_version': data.get('ModVersion'),
-                    'disk_size': data.get('DiskSize'),
-                    'free_space': data.get('FreeSpace'),
-                    'heartbeat_interval': data.get('Heartbeat'),
+                    'netmask': infor.netmask,
+                    'network_gateway': infor.network_gateway,
+                    'is_auto_ip': infor.auto_ip, # Always True per user requirement
                 })
 
+                server = infor.server
+                if server:
+                    if ':' in server:
+                        parts = server.split(':', 1)
+                        update_data['app_server_ip'] = parts[0]
+                        try:
+                            update_data['app_server_port'] = int(parts[1])
+                        except (ValueError, TypeError): pass
+                    else:
+                        update_data['app_server_ip'] = server
+
+                conn_param = infor.conn_param
+                if isinstance(conn_param, list) and len(conn_param) >= 2:
+                    update_data['username'] = conn_param[0]
+                    update_data['password'] = conn_param[1]
+
             # Register or Get existing
             # We check both MAC and ID (case-insensitive) to prevent IntegrityErrors
             from django.db.models import Q
@@ -462,6 +612,7 @@ class ESLMqttClient:
             # Look for any record that might conflict with this hardware's MAC or reported ID
             conflicts = Gateway.objects.filter(Q(gateway_mac=mac) | Q(estation_id__iexact=clean_id))
             gateway = conflicts.first()
+            reconnected_store_id = gateway.store_id if gateway and gateway.is_online == 'OFFLINE' else None
 
             if not gateway:
                 store = Store.objects.filter(name='Admin Store').first() or Store.objects.first()
@@ -481,6 +632,14 @@ class ESLMqttClient:
                 Gateway.objects.filter(pk=gateway.pk).update(**update_data)
 
             logger.info(f"Gateway {mac} (ID:{clean_id}) updated via /infor")
+
+            # The row was written directly: the next heartbeat starts fresh telemetry
+            from .gateway_telemetry import forget
+            forget([clean_id])
+
+            if reconnected_store_id:
+                from .tasks import on_gateway_reconnected
+                on_gateway_reconnected(reconnected_store_id)
         except Exception:
             logger.exception(f"Error handling infor for gateway {estation_id}")
 
@@ -491,16 +650,22 @@ class ESLMqttClient:
         Ensures compatibility with existing tests and simplifies the entry point
         for processing tag lists from MQTT messages.
         """
-        tags = data if isinstance(data, list) else data.get('Tags', [])
-        self._process_tags(estation_id, tags)
+        self._process_tag_reports(estation_id, protocol.decode_tag_heartbeat(data))
 
     def _process_tags(self, estation_id, tags_list):
+        """Processes a raw tag list ([[TagID, Rf, Battery, ...], ...] or dicts)."""
+        self._process_tag_reports(estation_id, protocol.decode_tags(tags_list))
+
+    def _process_tag_reports(self, estation_id, reports):
         """
         TAG AUTO-DISCOVERY & TELEMETRY ENGINE
         -------------------------------------
+        Creates unknown tags and writes only the tags whose gateway or
+        battery level changed. Every battery sample goes to the daily
+        min/max history (see core/battery_history.py).
         """
         try:
-            if not tags_list: return
+            if not reports: return
 
             gateway = Gateway.objects.filter(estation_id__iexact=estation_id.strip()).select_related('store').first()
             if not gateway: return
@@ -509,21 +674,16 @@ class ESLMqttClient:
             normalized_macs = []
             tag_data_map = {}
 
-            for tag_entry in tags_list:
-                if isinstance(tag_entry, list):
-                    raw_mac = tag_entry[0]
-                    battery = tag_entry[2]
-                else:
-                    raw_mac = tag_entry.get('TagId')
-                    battery = tag_entry.get('Battery')
-
-                if raw_mac:
-                    clean_mac = normalize_mac(raw_mac)
+            for report in reports:
+                if report.mac:
+                    clean_mac = normalize_mac(report.mac)
                     normalized_macs.append(clean_mac)
-                    tag_data_map[clean_mac] = {'battery': battery, 'original_mac': raw_mac}
+                    tag_data_map[clean_mac] = {'battery': report.battery, 'original_mac': report.mac}
 
-            # Flexible database matching (now O(1) via index)
-            existing_tags_list = ESLTag.objects.filter(store=gateway.store, tag_mac__in=normalized_macs)
+            # Flexible database matching (now O(1) via index); only the telemetry columns are needed
+            existing_tags_list = ESLTag.objects.filter(store=gateway.store, tag_mac__in=normalized_macs).only(
+                'id', 'tag_mac', 'store_id', 'last_successful_gateway_id', 'battery_level'
+            )
 
             existing_tags = {t.tag_mac: t for t in existing_tags_list}
 
@@ -531,6 +691,7 @@ class ESLMqttClient:
             default_hw = None
             tags_to_update = {}
             tags_to_create = {}
+            battery_samples = {}
             now = timezone.now()
             default_hw_queried = False
 
@@ -539,12 +700,24 @@ class ESLMqttClient:
                 battery_pct = self._calculate_battery_percentage(metadata['battery'])
 
                 if tag:
-                    tag.last_successful_gateway_id = estation_id
                     if battery_pct is not None:
+                        battery_samples[tag.pk] = battery_pct
+
+                    # DELTA ONLY: most heartbeats repeat what the row already says.
+                    # Levels come in 12.5% steps, so a changed value means a new bucket.
+                    changed = False
+                    if tag.last_successful_gateway_id != estation_id:
+                        tag.last_successful_gateway_id = estation_id
+                        changed = True
+                    if battery_pct is not None and tag.battery_level != battery_pct:
                         tag.battery_level = battery_pct
-                    tag.updated_at = now
-                    if not tag.store: tag.store = gateway.store
-                    tags_to_update[clean_mac] = tag
+                        changed = True
+                    if not tag.store_id:
+                        tag.store = gateway.store
+                        changed = True
+                    if changed:
+                        tag.updated_at = now
+                        tags_to_update[clean_mac] = tag
                 else:
                     if default_hw is None and not default_hw_queried:
                         default_hw = TagHardware.objects.first()
@@ -570,15 +743,48 @@ class ESLMqttClient:
             if tags_to_create:
                 ESLTag.objects.bulk_create(tags_to_create.values())
                 logger.info(f"Gateway {estation_id} discovered {len(tags_to_create)} new tags")
+                for clean_mac, tag in tags_to_create.items():
+                    battery_pct = self._calculate_battery_percentage(tag_data_map[clean_mac]['battery'])
+                    if tag.pk and battery_pct is not None:
+                        battery_samples[tag.pk] = battery_pct
+
+            battery_history.record_samples(battery_samples)
 
         except Exception:
             logger.exception(f"Error processing tag list for gateway {estation_id}")
 
-    def publish_tag_update(self, gateway_id, tag_mac, image_bytes, token):
+    def publish_tag_update(self, gateway_id, tag_mac, image_bytes, token, encoding='BASE64'):
         """
         COMMAND: UPDATE TAG IMAGE (taskESL)
         ----------------------------------
         Sends a BMP image to a physical tag. Matches user sandbox script.
+
+        'encoding' (see Gateway.get_payload_encoding) controls the image field:
+        - BASE64: Base64 text (legacy, works with every firmware).
+        - BINARY: Raw BMP bytes as a msgpack bin (saves the 33% Base64 overhead).
+        - GZIP:   Gzip-compressed BMP bytes as a msgpack bin.
+        """
+        return self.publish_tag_batch(gateway_id, [(tag_mac, image_bytes, token)], encoding=encoding)
+
+    @staticmethod
+    def build_task_params(tag_mac, image_data, token):
+        """
+        taskESL Parameters: [TagId, Pattern, PageIndex, R, G, B, Times, Token, OldKey, NewKey, Image]
+        Pattern=0, PageIndex=0, R=True, G=False, B=False, Times=0
+        'image_data' must already be encoded (see encode_image_payload).
+        """
+        # Clean Tag MAC (Remove colons and UPPERCASE to match hardware expectation)
+        # STRIP WHITESPACE to prevent incorrect ID lengths
+        from .utils import normalize_mac
+        return [normalize_mac(tag_mac), 0, 0, True, False, False, 0, token, "", "", image_data]
+
+    def publish_tag_batch(self, gateway_id, tasks, encoding='BASE64'):
+        """
+        COMMAND: UPDATE SEVERAL TAGS IN ONE MESSAGE (taskESL)
+        -----------------------------------------------------
+        'tasks' is a list of (tag_mac, image_bytes, token). The hardware
+        accepts a list of task parameter lists per message ([[p1], [p2], ...])
+        and reports one result per tag, so a batch costs one publish.
         """
         try:
             # AUTO-CONNECT: Ensure we are connected before publishing
@@ -598,42 +804,47 @@ class ESLMqttClient:
                 logger.error("MQTT client not connected — cannot publish")
                 return False
 
-            import base64
-            # 0. Clean Tag MAC (Remove colons and UPPERCASE to match hardware expectation)
-            # STRIP WHITESPACE to prevent incorrect ID lengths
-            from .utils import normalize_mac
-            clean_mac = normalize_mac(tag_mac)
-
-            # 1. Base64 encode the BMP image
-            image_b64 = base64.b64encode(image_bytes).decode('utf-8')
+            # 1. Encode each BMP image for this gateway and build its task parameters
+            task_list = [
+                self.build_task_params(tag_mac, self.encode_image_payload(image_bytes, encoding), token)
+                for tag_mac, image_bytes, token in tasks
+            ]
 
-            # 2. taskESL Parameters: [TagId, Pattern, PageIndex, R, G, B, Times, Token, OldKey, NewKey, ImageB64]
-            # Pattern=0, PageIndex=0, R=True, G=False, B=False, Times=0
-            task_params = [clean_mac, 0, 0, True, False, False, 0, token, "", "", image_b64]
+            # 2. Wrap in a list as expected by hardware: [[params], ...]
+            # use_bin_type=True is required for the hardware to process the image payload correctly
+            payload = msgpack.packb(task_list, use_bin_type=True)
 
-            # 3. Wrap in a list as expected by hardware: [[params]]
-            # use_bin_type=True is required for the hardware to process the Base64 image payload correctly
-            payload = msgpack.packb([task_params], use_bin_type=True)
-
-            # 4. Use confirmed topic: /estation/{id}/taskESL (Ensuring uppercase ID)
+            # 3. Use confirmed topic: /estation/{id}/taskESL (Ensuring uppercase ID)
             topic = f"/estation/{gateway_id.upper()}/taskESL"
 
             # Use QoS 0 for maximum compatibility
             result = self.client.publish(topic, payload, qos=0)
 
-            # Log the full payload for debugging
-            self._log_mqtt_message("sent", gateway_id, topic, task_params)
+            # Log the full payload for debugging (single tasks keep the legacy log format)
+            self._log_mqtt_message("sent", gateway_id, topic, task_list[0] if len(task_list) == 1 else task_list)
 
+            macs = ", ".join(params[0] for params in task_list)
             if result.rc == mqtt.MQTT_ERR_SUCCESS:
-                logger.debug(f"Published taskESL update for {clean_mac} to gateway {gateway_id}. B64: {image_b64[:50]}...")
+                logger.debug(f"Published taskESL update for {macs} to gateway {gateway_id}. {encoding}: {len(payload)} bytes")
                 return True
             else:
-                logger.error(f"Failed to publish MQTT message for {tag_mac}: RC {result.rc}")
+                logger.error(f"Failed to publish MQTT message for {macs}: RC {result.rc}")
                 return False
         except Exception:
-            logger.exception(f"Exception during MQTT publish for tag {tag_mac}")
+            logger.exception(f"Exception during MQTT publish for gateway {gateway_id}")
             return False
 
+    @staticmethod
+    def encode_image_payload(image_bytes, encoding='BASE64'):
+        """Encodes BMP bytes for the taskESL image field (see publish_tag_update)."""
+        if encoding == 'BINARY':
+            return bytes(image_bytes)
+        if encoding == 'GZIP':
+            return gzip.compress(image_bytes, compresslevel=6)
+
+        import base64
+        return base64.b64encode(image_bytes).decode('utf-8')
+
     def publish_config(self, gateway_id, alias, server, encrypt, heartbeat, auto_ip=True, local_ip="", subnet="", gateway="", username="test", password="123456"):
         """
         COMMAND: CONFIGURE GATEWAY
@@ -710,19 +921,33 @@ class ESLMqttClient:
         -------------
         Optimized: Successful heartbeats are sampled (10%) to reduce DB volume.
         """
+        self._write_log_entries(direction, [self._build_log_entry(direction, estation_id, topic, data, force_success)])
+
+    def _build_log_entry(self, direction, estation_id, topic, data, force_success=None, message=None):
+        """
+        Builds the (unsaved) MQTTMessage for one message, or None if it is not logged.
+        'message' is the decoded struct (core/protocol.py); received results and
+        heartbeats are decoded here only when the caller has none.
+        """
         try:
+            kind = topic.rsplit('/', 1)[-1]
+            if message is None and direction == "received" and kind in ('result', 'heartbeat'):
+                message = protocol.DECODERS[kind](data)
+
             # PERFORMANCE: Sample successful heartbeats to reduce DB noise
-            if topic.endswith("/heartbeat") and force_success is not False:
+            if kind == "heartbeat" and force_success is not False:
                 # Always log errors (MsgCode > 4)
-                is_error = False
-                if isinstance(data, list) and len(data) >= 5:
-                    is_error = data[4] > 4
+                is_error = message is not None and message.is_error
 
                 if not is_error and random.random() > 0.1:
-                    return
+                    return None
 
             # Security: Sanitize sensitive credentials before logging
-            data = self._sanitize_data(data)
+            if kind == "taskESL" and data and isinstance(data[0], list):
+                # A batch: the positional rules apply to each task's parameters, not the list
+                data = [self._sanitize_data(params) for params in data]
+            else:
+                data = self._sanitize_data(data)
 
             json_data = json.dumps(data, cls=BytesEncoder)
 
@@ -730,34 +955,30 @@ class ESLMqttClient:
                 is_success = force_success
             else:
                 is_success = True
-                if direction == "received" and topic.endswith("/result"):
-                    # Extract all status codes from the payload (supports single and multi-tag)
-                    status_codes = []
-                    if isinstance(data, list):
-                        # Multi-tag format: [Port, Wait, Send, Msg, [Tags]]
-                        if len(data) >= 5 and isinstance(data[4], list):
-                            status_codes = [tr[4] for tr in data[4] if isinstance(tr, list) and len(tr) >= 5]
-                        else:
-                            # Single-tag format: [TagID, Rf, Batt, Ver, Status, ...]
-                            d = data[0] if len(data) == 1 and isinstance(data[0], list) else data
-                            if isinstance(d, list) and len(d) >= 5:
-                                status_codes = [d[4]]
-                    elif isinstance(data, dict):
-                        status_codes = [data.get('Status')]
-
-                    if status_codes:
-                        # Message is successful ONLY if all tags succeeded (1 and 128 are SUCCESS)
-                        is_success = all(s == 1 or s == 128 for s in status_codes)
-
-            MQTTMessage.objects.create(
+                if direction == "received" and kind == "result" and message is not None:
+                    # Message is successful ONLY if all tags succeeded (1 and 128 are SUCCESS)
+                    is_success = message.all_succeeded
+
+            return MQTTMessage(
                 direction=direction,
                 estation_id=estation_id,
                 topic=topic,
                 data=json_data,
                 is_success=is_success
             )
+        except Exception:
+            logger.exception("Failed to log MQTT message")
+            return None
+
+    def _write_log_entries(self, direction, entries):
+        """Saves audit entries with one INSERT and appends them to the daily log file."""
+        entries = [e for e in entries if e is not None]
+        if not entries:
+            return
+        try:
+            MQTTMessage.objects.bulk_create(entries)
 
-            log_dir = os.path.join(settings.BASE_DIR, 'logs', 'mqtt', direction)
+            log_dir = os.path.join(settings.LOGS_DIR, 'mqtt', direction)
             os.makedirs(log_dir, exist_ok=True)
 
             filename = f"{datetime.now().strftime('%Y-%m-%d')}.log"
@@ -765,7 +986,7 @@ class ESLMqttClient:
 
             with open(filepath, 'a') as f:
                 timestamp = datetime.now().isoformat()
-                f.write(f"[{timestamp}] ID:{estation_id} TOPIC:{topic} DATA:{json_data}\n")
+                f.writelines(f"[{timestamp}] ID:{e.estation_id} TOPIC:{e.topic} DATA:{e.data}\n" for e in entries)
 
         except Exception:
             logger.exception("Failed to log MQTT message")
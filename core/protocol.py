@@ -0,0 +1,272 @@
+import json
+import logging
+import msgpack
+
+"""
+D21 ESTATION PROTOCOL: DECODED ONCE PER PACKET
+----------------------------------------------
+Gateways publish on '/estation/<estation_id>/<kind>'. Each payload used to
+be unpacked with msgpack, retried as JSON on any error, and then picked
+apart by position several times: by its handler ('len(data) >= 8',
+'data[4]'...), by the tag list code, and again by the audit log to decide
+sampling and success.
+
+Each kind now has one decoder that turns the unpacked payload into a small
+'__slots__' struct:
+
+    /result        -> Result(message_code, tags=[TagResult, ...])
+    /heartbeat     -> Heartbeat(ap_id, versions, msg_code, counts, tags)
+    /tagheartbeat  -> [TagReport, ...]
+    /infor         -> Infor(ap_id, alias, network and firmware fields)
+
+decode() builds a Packet holding the raw data (for the audit log) and the
+struct (None when the payload is malformed). The handlers in mqtt_client
+and the audit log both read the struct, so a packet is parsed exactly once.
+
+Payloads are MessagePack. Legacy firmware sends every decoded kind
+(result, heartbeat, tagheartbeat, infor) as a JSON dictionary ('TagId',
+'ApVersion', 'MAC' keys), so those kinds, listed in JSON_KINDS, fall back
+to JSON. Any other kind that isn't MessagePack is rejected.
+"""
+
+logger = logging.getLogger(__name__)
+
+# Kinds whose legacy firmware may send JSON instead of MessagePack (all decoded kinds)
+JSON_KINDS = frozenset({'result', 'heartbeat', 'tagheartbeat', 'infor'})
+
+# Tag status codes that mean the image was shown
+SUCCESS_CODES = (1, 128)
+
+# Heartbeat message codes above this are errors (always logged)
+MAX_OK_HEARTBEAT_CODE = 4
+
+
+class TagReport:
+    """One tag heard by a gateway (heartbeat tag lists): [TagID, RfPower, Battery, ...]."""
+    __slots__ = ('mac', 'battery')
+
+    def __init__(self, mac, battery):
+        self.mac = mac
+        self.battery = battery
+
+
+class TagResult:
+    """Outcome of one taskESL for one tag: [TagID, RfPower, Battery, Version, Status, Token, ...]."""
+    __slots__ = ('tag_mac', 'battery_raw', 'status_code', 'token')
+
+    def __init__(self, tag_mac, battery_raw, status_code, token):
+        self.tag_mac = tag_mac
+        self.battery_raw = battery_raw
+        self.status_code = status_code
+        self.token = token
+
+    @property
+    def is_success(self):
+        return self.status_code in SUCCESS_CODES
+
+
+class Result:
+    """A /result message: one or more TagResults and the gateway's message code."""
+    __slots__ = ('message_code', 'tags')
+
+    def __init__(self, message_code, tags):
+        self.message_code = message_code
+        self.tags = tags
+
+    @property
+    def all_succeeded(self):
+        return all(tag.is_success for tag in self.tags)
+
+
+class Heartbeat:
+    """
+    A /heartbeat message. 'legacy' marks the dictionary format, which has
+    no message code and only reports versions and queue counts.
+    """
+    __slots__ = ('ap_id', 'ap_version', 'module_version', 'msg_code', 'queued', 'comm', 'tags', 'legacy')
+
+    def __init__(self, ap_id, ap_version, module_version, msg_code, queued, comm, tags, legacy=False):
+        self.ap_id = ap_id
+        self.ap_version = ap_version
+        self.module_version = module_version
+        self.msg_code = msg_code
+        self.queued = queued
+        self.comm = comm
+        self.tags = tags
+        self.legacy = legacy
+
+    @property
+    def is_error(self):
+        return isinstance(self.msg_code, int) and self.msg_code > MAX_OK_HEARTBEAT_CODE
+
+
+class Infor:
+    """
+    A /infor (registration) message. Fields the legacy dictionary format
+    doesn't have are None and 'legacy' is set.
+    """
+    __slots__ = (
+        'ap_id', 'alias', 'ip', 'mac', 'ap_type', 'ap_version', 'module_version', 'disk_size', 'free_space',
+        'server', 'conn_param', 'auto_ip', 'netmask', 'network_gateway', 'heartbeat_interval', 'legacy',
+    )
+
+    def __init__(self, **fields):
+        for name in self.__slots__:
+            setattr(self, name, fields.get(name))
+        self.legacy = bool(fields.get('legacy'))
+
+
+class Packet:
+    """One received message: its topic, the raw data for the audit log and the decoded struct."""
+    __slots__ = ('topic', 'estation_id', 'kind', 'data', 'message')
+
+    def __init__(self, topic, estation_id, kind, data, message):
+        self.topic = topic
+        self.estation_id = estation_id
+        self.kind = kind
+        self.data = data
+        self.message = message
+
+
+def _ap_id(value):
+    """The AP ID a gateway reports about itself, if any."""
+    return str(value).strip() if value and str(value).strip() else None
+
+
+def _interval(value, default=15):
+    """Heartbeat interval in seconds (the default when missing or not a number)."""
+    try:
+        return int(value) if value else default
+    except (ValueError, TypeError):
+        return default
+
+
+def decode_tags(entries):
+    """Tag list entries ([TagID, Rf, Battery, ...] or {'TagId', 'Battery'}) -> [TagReport]."""
+    reports = []
+    for entry in entries or ():
+        if isinstance(entry, list):
+            if len(entry) >= 3:
+                reports.append(TagReport(entry[0], entry[2]))
+        elif isinstance(entry, dict):
+            reports.append(TagReport(entry.get('TagId'), entry.get('Battery')))
+    return reports
+
+
+def decode_result(data):
+    """
+    Multi-tag format: [Port, WaitCount, SendCount, MessageCode, [TagResult1, ...]]
+    Legacy single tag: [TagID, RfPower, Battery, Version, Status, Token, ...]
+    (optionally wrapped in a list) or {'TagId', 'Battery', 'Status', 'Token'}.
+    """
+    if isinstance(data, list):
+        if len(data) >= 5 and isinstance(data[4], list):
+            return Result(data[3], [
+                TagResult(tr[0], tr[2], tr[4], tr[5]) for tr in data[4] if isinstance(tr, list) and len(tr) >= 6
+            ])
+        if len(data) == 1 and isinstance(data[0], list):
+            data = data[0]
+        if len(data) >= 6:
+            return Result(None, [TagResult(data[0], data[2], data[4], data[5])])
+        return Result(None, [])
+    if isinstance(data, dict):
+        return Result(None, [TagResult(data.get('TagId'), data.get('Battery'), data.get('Status'), data.get('Token'))])
+    return None
+
+
+def decode_heartbeat(data):
+    """
+    9-element list: [AP ID, ConfigVer, BaseVer, BlueVer, MsgCode, MsgExt, Queued, Comm, Tags]
+    (the tag list is optional), or the legacy dictionary. None if malformed.
+    """
+    if isinstance(data, list):
+        if len(data) < 8:
+            return None
+        return Heartbeat(
+            _ap_id(data[0]), data[2], data[3], data[4], data[6], data[7],
+            decode_tags(data[8]) if len(data) > 8 and isinstance(data[8], list) else []
+        )
+    if isinstance(data, dict):
+        return Heartbeat(
+            None, data.get('ApVersion'), data.get('ModVersion'), None,
+            data.get('Queued', 0), data.get('Comm', 0), decode_tags(data.get('Tags')), legacy=True
+        )
+    return None
+
+
+def decode_tag_heartbeat(data):
+    """A tag list, or {'Tags': [...]}."""
+    if isinstance(data, dict):
+        data = data.get('Tags')
+    return decode_tags(data) if isinstance(data, list) else []
+
+
+def decode_infor(data):
+    """
+    17-element list: [ID, Nickname, LocalIP, MAC, ApType, MainVer, ModVer, Disk, Available,
+    ServerIP, ConnParam, AutoIP, FixedIP, Mask, Gateway, ??, Heartbeat]
+    or the legacy dictionary. None if malformed.
+    """
+    if isinstance(data, list):
+        if len(data) < 17:
+            return None
+        return Infor(
+            ap_id=_ap_id(data[0]), alias=data[1], ip=data[2], mac=data[3], ap_type=data[4],
+            ap_version=data[5], module_version=data[6], disk_size=data[7], free_space=data[8],
+            server=data[9], conn_param=data[10], auto_ip=data[11], netmask=data[13],
+            network_gateway=data[14], heartbeat_interval=_interval(data[16]),
+        )
+    if isinstance(data, dict):
+        return Infor(
+            alias=data.get('Alias'), ip=data.get('IP'), mac=data.get('MAC'), ap_type=data.get('ApType'),
+            ap_version=data.get('ApVersion'), module_version=data.get('ModVersion'),
+            disk_size=data.get('DiskSize'), free_space=data.get('FreeSpace'),
+            heartbeat_interval=data.get('Heartbeat'), legacy=True,
+        )
+    return None
+
+
+DECODERS = {
+    'result': decode_result,
+    'heartbeat': decode_heartbeat,
+    'tagheartbeat': decode_tag_heartbeat,
+    'infor': decode_infor,
+}
+
+
+def unpack(kind, payload):
+    """Raw payload -> Python data. Raises ValueError if it can't be unpacked."""
+    try:
+        # raw=False decodes strings from bytes
+        return msgpack.unpackb(payload, raw=False)
+    except Exception:
+        if kind not in JSON_KINDS:
+            raise ValueError(f"Not MessagePack: {kind} payload")
+    try:
+        return json.loads(payload)
+    except Exception:
+        raise ValueError(f"Neither MessagePack nor JSON: {kind} payload")
+
+
+def decode(topic, payload):
+    """
+    Topic and payload -> Packet, or None if the topic is not an eStation
+    topic. Raises ValueError if the payload can't be unpacked (callers
+    catch it). Kinds without a decoder keep only their raw data
+    (message=None).
+    """
+    # Topic format is usually: /estation/<estation_id>/<kind>
+    parts = topic.split('/')
+    if len(parts) < 3:
+        return None
+    kind = parts[-1]
+    data = unpack(kind, payload)
+    message = None
+    decoder = DECODERS.get(kind)
+    if decoder:
+        try:
+            message = decoder(data)
+        except Exception:
+            # Still audit-logged; the handler reports the malformed message
+            logger.exception(f"Failed to decode {kind} message on {topic}")
+    return Packet(topic, parts[2], kind, data, message)
@@ -0,0 +1,125 @@
+import os
+import time
+import logging
+import threading
+from django.conf import settings
+from PIL import Image
+from .font_metrics import MIN_SIZE, MAX_SIZE, precompute_font_metrics
+
+"""
+RENDER ASSET REGISTRY: FONTS, ICONS & CONSTANT MEASUREMENTS
+-----------------------------------------------------------
+Templates used to touch the disk on every label: checking that a font
+file exists, opening the pricetag PNG, resizing it with LANCZOS and
+measuring the constant "SALE!" text again.
+
+This registry resolves those assets once per process and keeps them:
+- Font file paths per font type (checked for existence once).
+- Source icons, converted to RGBA once.
+- Resized icons per (color, height), shared by every tag spec since the
+  promo banner is drawn at a fixed size.
+- Sizes of constant strings per (text, font type, size).
+
+'warm()' loads everything up-front. It runs in every Celery worker process
+right after the fork (see 'worker_process_init' in tasks.py), so the first
+label a worker renders is as fast as the thousandth.
+"""
+
+logger = logging.getLogger(__name__)
+
+FONT_DIR = os.path.join(settings.BASE_DIR, 'core', 'static', 'fonts')
+ICON_DIR = os.path.join(settings.BASE_DIR, 'core', 'static', 'core', 'img', 'templates')
+
+FONT_FILES = {
+    'bold': 'ArialBold.ttf',                 # Classic look
+    'condensed': 'Roboto_Condensed-Bold.ttf', # Fits more text
+}
+
+ICON_COLORS = ('black', 'red', 'white', 'yellow')
+
+# Font sizes of the "SALE!" promo banners (V1, V3)
+SALE_TEXT = "SALE!"
+SALE_BANNER_SIZES = (26, 38)
+
+
+class RenderAssetRegistry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._font_paths = {}
+        self._icons = {}
+        self._scaled_icons = {}
+        self._text_sizes = {}
+        self.warmed = False
+
+    def font_path(self, font_type):
+        """Absolute path of the font file for a type, or None if missing."""
+        try:
+            return self._font_paths[font_type]
+        except KeyError:
+            pass
+        fname = FONT_FILES['condensed'] if font_type == "condensed" else FONT_FILES['bold']
+        path = os.path.join(FONT_DIR, fname)
+        self._font_paths[font_type] = path if os.path.exists(path) else None
+        return self._font_paths[font_type]
+
+    def icon(self, color):
+        """Source pricetag icon (RGBA) for a color, or None if missing."""
+        if color not in self._icons:
+            path = os.path.join(ICON_DIR, f'pricetag-{color}.png')
+            with self._lock:
+                if color not in self._icons:
+                    self._icons[color] = Image.open(path).convert("RGBA") if os.path.exists(path) else None
+        return self._icons[color]
+
+    def scaled_icon(self, color, height):
+        """Pricetag icon resized (LANCZOS) to a height, keeping its aspect ratio."""
+        key = (color, height)
+        icon = self._scaled_icons.get(key)
+        if icon is None and key not in self._scaled_icons:
+            source = self.icon(color)
+            if source is not None:
+                width = int(source.width * (height / source.height))
+                icon = source.resize((width, height), Image.Resampling.LANCZOS)
+            self._scaled_icons[key] = icon
+        return icon
+
+    def text_size(self, text, size, font_type="bold"):
+        """Cached (width, height) of a constant string."""
+        key = (text, size, font_type)
+        result = self._text_sizes.get(key)
+        if result is None:
+            from .utils import LayoutEngine, get_font_by_type
+            result = self._text_sizes[key] = LayoutEngine.get_text_size(text, get_font_by_type(size, font_type))
+        return result
+
+    def sale_banner(self, color, size):
+        """
+        Returns (icon, sale_w) for a promo banner drawn at a font size:
+        the resized icon (or None) and the width of the "SALE!" text.
+        """
+        sale_w, sale_h = self.text_size(SALE_TEXT, size)
+        return self.scaled_icon(color, int(sale_h * 1.2)), sale_w
+
+    def warm(self):
+        """
+        WARM-UP: Loads fonts and their metric tables for the whole auto-fit
+        size range, plus every icon variant used by the promo banners.
+        """
+        from .utils import get_font_by_type
+
+        started = time.monotonic()
+        font_paths = [p for p in (self.font_path(t) for t in FONT_FILES) if p]
+        for font_type in FONT_FILES:
+            for size in range(MIN_SIZE, MAX_SIZE + 1):
+                get_font_by_type(size, font_type)
+        precompute_font_metrics(font_paths)
+
+        for color in ICON_COLORS:
+            for size in SALE_BANNER_SIZES:
+                self.sale_banner(color, size)
+
+        self.warmed = True
+        logger.info(f"Render assets warmed in {time.monotonic() - started:.2f}s")
+
+
+assets = RenderAssetRegistry()
@@ -0,0 +1,188 @@
+import os
+import time
+import random
+import logging
+from billiard.pool import Pool
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.db import transaction
+from django.utils import timezone
+from .models import ESLTag
+from .delivery import assign_gateways
+from .admission import admit
+from . import hardware_registry
+from .utils import (
+    RENDER_INPUT_VALUES, RENDER_CACHE_TIMEOUT, get_render_inputs_from_values,
+    hash_render_inputs, render_label_image, encode_bmp,
+)
+
+"""
+RENDER FARM: STORE-WIDE REFRESHES ON A PROCESS POOL
+---------------------------------------------------
+A store refresh through the normal pipeline costs one Celery task per
+tag: a broker round-trip, a random 'thundering herd' sleep, a lock in the
+cache and three single-row UPDATEs, for every one of 20,000 tags.
+
+The render farm does the same work in bulk:
+1. Tag IDs for the store are loaded once, then processed in chunks.
+2. Each chunk is claimed with one UPDATE and its render inputs are read
+   with one '.values()' query (no model instances, no per-tag queries).
+3. Identical labels are rendered once; labels already in the render cache
+   are not rendered at all.
+4. The remaining renders are spread over a pool of worker processes
+   (one per CPU core by default) whose fonts and icons are preloaded.
+5. Results are written back with a single bulk_update per chunk and
+   handed to the gateways in bulk.
+
+Throughput is then limited by CPU cores, not by task dispatch.
+Entry points: 'render_store_task' (Celery) and 'manage.py render_store'.
+
+The pool comes from billiard (Celery's fork of multiprocessing), not
+concurrent.futures: Celery's prefork workers are daemonic processes, and
+only billiard lets a daemonic process start children of its own.
+"""
+
+logger = logging.getLogger(__name__)
+
+RENDER_FARM_CHUNK_SIZE = 500
+
+
+def _init_pool_worker():
+    """Pool initializer: preload fonts, metric tables and icons once per process."""
+    from .render_assets import assets
+    try:
+        assets.warm()
+    except Exception:
+        logger.exception("Render farm worker warm-up failed; assets will load on demand")
+
+
+def _render_job(inputs):
+    """Runs in a pool process. Returns BMP bytes, or None if the render failed."""
+    try:
+        return encode_bmp(render_label_image(inputs))
+    except Exception:
+        logger.exception(f"Render farm job failed for SKU {inputs.get('sku')}")
+        return None
+
+
+def _claim_tags(tag_ids):
+    """
+    Moves the idle tags of a chunk to PROCESSING and returns their IDs.
+    Tags already mid-pipeline are left to the task that owns them.
+    """
+    with transaction.atomic():
+        claimable = list(ESLTag.objects.select_for_update(skip_locked=True).filter(
+            pk__in=tag_ids
+        ).exclude(sync_state__in=['PROCESSING', 'IMAGE_READY']).values_list('id', flat=True))
+        ESLTag.objects.filter(pk__in=claimable).update(sync_state='PROCESSING', retry_count=0)
+    return claimable
+
+
+def _render_chunk(pool, tag_ids, task_id):
+    """Renders one claimed chunk. Returns (ready_ids, unique_renders, cache_hits)."""
+    rows = list(ESLTag.objects.filter(pk__in=tag_ids).values(
+        'id', 'tag_mac', 'render_hash', 'tag_image', *RENDER_INPUT_VALUES
+    ))
+
+    unpaired_ids = [r['id'] for r in rows if r['paired_product_id'] is None]
+    if unpaired_ids:
+        ESLTag.objects.filter(pk__in=unpaired_ids).update(sync_state='IDLE')
+
+    # 1. DEDUPLICATE: one render per distinct label
+    jobs = {}
+    for row in rows:
+        if row['paired_product_id'] is None: continue
+        inputs = get_render_inputs_from_values(row)
+        row['render_hash'], row['old_hash'] = hash_render_inputs(inputs), row['render_hash']
+        jobs.setdefault(row['render_hash'], inputs)
+
+    # 2. RENDER CACHE: skip labels rendered before
+    cached = cache.get_many([f"esl_render_{h}" for h in jobs])
+    bmps = {h: cached[f"esl_render_{h}"] for h in jobs if f"esl_render_{h}" in cached}
+    misses = [h for h in jobs if h not in bmps]
+
+    # 3. RENDER the rest across the pool
+    for render_hash, bmp in zip(misses, pool.map(_render_job, [jobs[h] for h in misses], chunksize=8)):
+        if bmp is not None:
+            bmps[render_hash] = bmp
+    cache.set_many({f"esl_render_{h}": bmps[h] for h in misses if h in bmps}, RENDER_CACHE_TIMEOUT)
+
+    # 4. WRITE BACK in bulk
+    now = timezone.now()
+    updated, failed_ids = [], []
+    for row in rows:
+        if row['paired_product_id'] is None: continue
+        bmp = bmps.get(row['render_hash'])
+        if bmp is None:
+            failed_ids.append(row['id'])
+            continue
+
+        tag = ESLTag(pk=row['id'], tag_mac=row['tag_mac'], tag_image=row['tag_image'])
+        if row['old_hash'] != row['render_hash'] or not (tag.tag_image and tag.tag_image.storage.exists(tag.tag_image.name)):
+            filename = f"{row['tag_mac'].replace(':', '')}_{int(time.time())}.bmp"
+            tag.tag_image.save(filename, ContentFile(bmp), save=False)
+        tag.render_hash = row['render_hash']
+        tag.sync_state = 'IMAGE_READY'
+        tag.last_image_gen_success = now
+        tag.last_image_task_id = task_id
+        tag.last_image_task_token = random.randint(0, 16383)
+        updated.append(tag)
+
+    if failed_ids:
+        ESLTag.objects.filter(pk__in=failed_ids).update(sync_state='GEN_FAILED')
+    ESLTag.objects.bulk_update(
+        updated,
+        ['tag_image', 'render_hash', 'sync_state', 'last_image_gen_success', 'last_image_task_id', 'last_image_task_token'],
+        batch_size=RENDER_FARM_CHUNK_SIZE
+    )
+    # New tokens: results of earlier pushes no longer count
+    hardware_registry.announce(dropped=[t.pk for t in updated])
+    return [t.pk for t in updated], len(misses), len(jobs) - len(misses)
+
+
+def render_store(store_id, workers=None, chunk_size=RENDER_FARM_CHUNK_SIZE, dispatch=True, task_id=None):
+    """
+    Re-renders every paired tag of a store on a process pool.
+    Returns a summary dict (tags, renders, cache_hits, seconds).
+    """
+    from .tasks import trigger_gateway_processing
+
+    started = time.monotonic()
+    workers = workers or settings.RENDER_FARM_WORKERS or os.cpu_count() or 1
+
+    tag_ids = list(ESLTag.objects.filter(
+        store_id=store_id, paired_product__isnull=False, hardware_spec__isnull=False
+    ).order_by('paired_product_id', 'hardware_spec_id', 'template_id').values_list('id', flat=True))
+
+    # Admission control: an offline store is parked as a whole and rendered on reconnect
+    if dispatch:
+        tag_ids = admit([(tag_id, store_id) for tag_id in tag_ids])
+
+    summary = {'tags': 0, 'renders': 0, 'cache_hits': 0}
+    with Pool(processes=workers, initializer=_init_pool_worker) as pool:
+        for i in range(0, len(tag_ids), chunk_size):
+            claimed = _claim_tags(tag_ids[i:i + chunk_size])
+            if not claimed: continue
+            try:
+                ready_ids, renders, hits = _render_chunk(pool, claimed, task_id)
+            except Exception:
+                logger.exception(f"Render farm chunk failed for store {store_id}")
+                ESLTag.objects.filter(pk__in=claimed, sync_state='PROCESSING').update(sync_state='FAILED')
+                continue
+
+            summary['tags'] += len(ready_ids)
+            summary['renders'] += renders
+            summary['cache_hits'] += hits
+
+            # Delivery of this chunk starts while the next one renders
+            if dispatch and ready_ids:
+                for gateway_id in assign_gateways(ready_ids, store_id):
+                    trigger_gateway_processing(gateway_id)
+
+    summary['seconds'] = round(time.monotonic() - started, 1)
+    logger.info(
+        f"Render farm: store {store_id} -> {summary['tags']} tags, {summary['renders']} renders, "
+        f"{summary['cache_hits']} cache hits in {summary['seconds']}s on {workers} processes"
+    )
+    return summary
@@ -0,0 +1,189 @@
+import logging
+from django.db import transaction
+from django.db.models import Case, When, Value, F
+from django.utils import timezone
+from .models import ESLTag, MQTTMessage
+
+"""
+BULK FAILURE HANDLING AND RETRY SCHEDULING
+------------------------------------------
+Failed deliveries used to be handled one Celery task per tag: a lookup,
+a lock in the cache, an UPDATE and a retry task with its own countdown.
+After a gateway outage that meant thousands of tasks and tens of
+thousands of queries, and thousands of ETA tasks parked in worker memory
+(re-delivered whenever a worker restarted).
+
+'process_tag_failures()' takes a whole list of (tag_id, reason) pairs:
+1. The affected rows are locked and read in one query.
+2. One UPDATE moves them to RETRY_WAITING (retry_count + 1) with a due
+   time ('retry_due_at': now + 5m, 15m or 30m) or, after the last retry,
+   to PUSH_FAILED.
+
+Nothing is scheduled in Celery. 'sweep_due_retries()' runs every minute
+(sweep_due_retries_task), picks up the due tags through the index on
+'retry_due_at' and re-renders them in batches (see trigger_bulk_sync).
+Retries therefore survive restarts, and can be cancelled or moved with a
+plain UPDATE (see cancel_retries / reschedule_retries).
+
+Duplicate reports are harmless: tags already in SUCCESS, RETRY_WAITING
+or PUSH_FAILED are skipped by the UPDATE itself, so no per-tag lock is
+needed.
+
+RECONNECT CATCH-UP: tags of a store whose gateways are all offline are
+PARKED instead of failed (before rendering, see core/admission.py, or at
+dispatch). When a gateway of the store comes back (OFFLINE -> ONLINE in
+a heartbeat or /infor message), 'release_store_backlog()' releases the
+parked tags and then the store's waiting retries, 'RELEASE_BATCH' per
+minute: the first batch of parked tags is rendered right away, later
+parked tags wait in the retry index (RETRY_WAITING with a due time) and
+waiting retries are moved forward. A short network blip therefore costs
+minutes instead of a 30-minute backoff, without a burst of renders for a
+store that was offline for hours.
+"""
+
+logger = logging.getLogger(__name__)
+
+# Backoff per retry attempt: 5m, 15m, 30m
+RETRY_DELAYS = [300, 900, 1800]
+MAX_RETRIES = len(RETRY_DELAYS)
+
+# Tags in these states are not (or no longer) waiting for a delivery
+SKIP_STATES = ['SUCCESS', 'RETRY_WAITING', 'PUSH_FAILED']
+
+# Most retries started per sweep (the rest follow on the next tick)
+RETRY_SWEEP_BATCH = 5000
+
+# Retries of a reconnected store started per minute (rate limit)
+RELEASE_BATCH = 500
+
+
+def process_tag_failures(failures):
+    """
+    Applies the retry policy to many failed tags at once.
+    'failures' is an iterable of (tag_id, reason); the first reason per
+    tag is kept for logging. Returns (retried, failed) counts.
+    """
+    reasons = {}
+    for tag_id, reason in failures:
+        reasons.setdefault(tag_id, reason)
+    if not reasons:
+        return 0, 0
+
+    now = timezone.now()
+    with transaction.atomic():
+        rows = list(ESLTag.objects.select_for_update().filter(
+            pk__in=list(reasons)
+        ).exclude(sync_state__in=SKIP_STATES).values_list('id', 'retry_count', 'tag_mac', 'gateway__estation_id'))
+        if not rows:
+            return 0, 0
+
+        # The due time depends on the attempt the tag is entering
+        due_at = Case(
+            *[When(retry_count=attempt, then=Value(now + timezone.timedelta(seconds=delay)))
+              for attempt, delay in enumerate(RETRY_DELAYS)],
+            default=Value(None)
+        )
+        ESLTag.objects.filter(pk__in=[r[0] for r in rows]).update(
+            sync_state=Case(When(retry_count__lt=MAX_RETRIES, then=Value('RETRY_WAITING')), default=Value('PUSH_FAILED')),
+            retry_due_at=due_at,
+            retry_count=Case(When(retry_count__lt=MAX_RETRIES, then=F('retry_count') + 1), default=F('retry_count')),
+        )
+
+        # AUDIT: Synthetic log entries make 'stuck' tags visible in the MQTT logs
+        MQTTMessage.objects.bulk_create([
+            MQTTMessage(
+                direction='received',
+                estation_id=gw_id,
+                topic=f"/estation/{gw_id}/timeout",
+                data=f"TIMEOUT FAILURE: No response from tag {mac} after 60 seconds.",
+                is_success=False
+            )
+            for tag_id, _, mac, gw_id in rows if gw_id and reasons[tag_id] == "Timeout"
+        ])
+
+    retried = 0
+    for tag_id, retry_count, mac, _ in rows:
+        if retry_count < MAX_RETRIES:
+            retried += 1
+        else:
+            logger.warning(f"Max retries reached for tag {mac} (Final failure: {reasons[tag_id]})")
+
+    failed = len(rows) - retried
+    logger.info(f"Failure handling: {retried} tags waiting for retry, {failed} failed permanently")
+    return retried, failed
+
+
+def sweep_due_retries(limit=RETRY_SWEEP_BATCH):
+    """
+    Starts every retry that is due. Returns the number of tags re-rendered.
+    Retry counters and tokens are kept (trigger_bulk_sync with is_retry).
+    """
+    from .utils import trigger_bulk_sync
+
+    now = timezone.now()
+
+    # HOUSEKEEPING: tags refreshed or delivered in the meantime drop out of the index
+    ESLTag.objects.filter(retry_due_at__lte=now).exclude(sync_state='RETRY_WAITING').update(retry_due_at=None)
+
+    due_ids = list(ESLTag.objects.filter(
+        retry_due_at__lte=now, sync_state='RETRY_WAITING'
+    ).order_by('retry_due_at').values_list('id', flat=True)[:limit])
+    if not due_ids:
+        return 0
+
+    # CLAIM: clearing the due time takes the tags out of the next sweep
+    ESLTag.objects.filter(pk__in=due_ids, sync_state='RETRY_WAITING').update(retry_due_at=None)
+    trigger_bulk_sync(due_ids, is_retry=True)
+    logger.info(f"Retry sweep: {len(due_ids)} tags due")
+    return len(due_ids)
+
+
+def reschedule_retries(tag_ids, due_at):
+    """Moves the retries of waiting tags to 'due_at' (e.g. now, after fixing a gateway)."""
+    return ESLTag.objects.filter(pk__in=tag_ids, sync_state='RETRY_WAITING').update(retry_due_at=due_at)
+
+
+def cancel_retries(tag_ids):
+    """Gives up on waiting tags: they become PUSH_FAILED and are not retried."""
+    return ESLTag.objects.filter(pk__in=tag_ids, sync_state='RETRY_WAITING').update(
+        sync_state='PUSH_FAILED', retry_due_at=None
+    )
+
+
+def release_store_backlog(store_id):
+    """
+    Releases a store's PARKED tags and moves its waiting retries forward,
+    'RELEASE_BATCH' per minute (parked tags first). Returns (released, rescheduled).
+    """
+    from .utils import trigger_bulk_sync
+    from .tasks import sweep_due_retries_task
+
+    parked_ids = list(ESLTag.objects.filter(store_id=store_id, sync_state='PARKED').values_list('id', flat=True))
+    waiting_ids = list(ESLTag.objects.filter(
+        store_id=store_id, sync_state='RETRY_WAITING'
+    ).order_by('retry_due_at').values_list('id', flat=True))
+
+    backlog = parked_ids + waiting_ids
+    now = timezone.now()
+    for i in range(0, len(backlog), RELEASE_BATCH):
+        chunk = backlog[i:i + RELEASE_BATCH]
+        parked, waiting = chunk[:max(0, len(parked_ids) - i)], chunk[max(0, len(parked_ids) - i):]
+        due_at = now + timezone.timedelta(minutes=i // RELEASE_BATCH)
+
+        if parked and i == 0:
+            # PARKED: rendered now, with the content current at this moment
+            # (unchanged labels come straight from the render cache)
+            trigger_bulk_sync(parked)
+        elif parked:
+            # Later batches are rendered by the retry sweep when due
+            ESLTag.objects.filter(pk__in=parked, sync_state='PARKED').update(sync_state='RETRY_WAITING', retry_due_at=due_at)
+        if waiting:
+            # Never postpone a retry that was already due earlier
+            ESLTag.objects.filter(
+                pk__in=waiting, sync_state='RETRY_WAITING', retry_due_at__gt=due_at
+            ).update(retry_due_at=due_at)
+    if waiting_ids:
+        sweep_due_retries_task.delay()
+
+    logger.info(f"Store {store_id} reconnected: {len(parked_ids)} parked tags released, {len(waiting_ids)} retries brought forward")
+    return len(parked_ids), len(waiting_ids)
@@ -2,7 +2,6 @@ from django.db.models.signals import post_save
 from django.dispatch import receiver
 from django.db import transaction
 from .models import Product, ESLTag
-from django.core.cache import cache
 
 """
 DJANGO SIGNALS: THE EVENT SYSTEM
@@ -17,7 +16,9 @@ Scenario:
 - User saves a new PRICE for a Product in the Admin.
 - Django fires a 'post_save' signal.
 - The 'update_tags_on_product_change' receiver catches it.
-- It finds all ESL Tags linked to that product and queues a Celery task.
+- It finds all ESL Tags linked to that product and marks them dirty.
+- Once the store's settle window closes, the tags are rendered once with
+  the latest data (see core/coalesce.py).
 - The physical price tag updates automatically!
 """
 
@@ -33,16 +34,15 @@ def update_tags_on_product_change(sender, instance, **kwargs):
     if not getattr(instance, '_needs_refresh', True):
         return
 
-    from .utils import trigger_bulk_sync
+    from .coalesce import mark_dirty
     
     # 1. Look up all Tags currently displaying this product
     tag_ids = list(instance.esl_tags.values_list('id', flat=True))
 
     if tag_ids:
-        # Performance: Use trigger_bulk_sync to batch dispatch tasks in one transaction hook.
-        # This also removes the O(N) cache.add (Redis) overhead from the signal handler.
+        # Performance: Repeated saves within the store's settle window render only once.
         transaction.on_commit(
-            lambda: trigger_bulk_sync(tag_ids)
+            lambda: mark_dirty(instance.store_id, tag_ids)
         )
 
 @receiver(post_save, sender=ESLTag)
@@ -58,14 +58,11 @@ def trigger_image_update_on_tag_save(sender, instance, **kwargs):
     if not getattr(instance, '_needs_refresh', True):
         return
 
-    # 1. Debouncing: Prevents triggering multiple tasks for the same tag in rapid succession
-    debounce_key = f"signal_debounce_{instance.id}"
-    if not cache.add(debounce_key, "locked", timeout=5):
-        return
-
-    # 2. Trigger Task if the tag has enough info to render
+    # Coalescing: saves in rapid succession are rendered once (see core/coalesce.py)
     if instance.paired_product and instance.hardware_spec:
-        from core.tasks import update_tag_image_task
+        from .coalesce import mark_dirty
+        from core.delivery_queue import PRIORITY_INTERACTIVE
+        # Someone is pairing/editing this tag right now: front of the delivery queue
         transaction.on_commit(
-            lambda: update_tag_image_task.delay(instance.id)
+            lambda: mark_dirty(instance.store_id, [instance.id], priority=PRIORITY_INTERACTIVE)
         )
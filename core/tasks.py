@@ -1,16 +1,23 @@
-import io
 import os
 import time
 import random
 import logging
 import sys
 from celery import shared_task
+from celery.signals import worker_process_init
+from django.conf import settings
 from django.utils import timezone
 from django.core.files.base import ContentFile
 from django.core.cache import cache
 from .models import ESLTag, Store, Gateway, GlobalSetting, MQTTMessage
-from .utils import generate_esl_image, trigger_bulk_sync
+from .utils import render_tag_bmp, trigger_bulk_sync
 from .mqtt_client import mqtt_service
+from .render_assets import assets
+from .delivery import deliver_next_batch
+from .retries import process_tag_failures, sweep_due_retries, release_store_backlog
+from .admission import admit, forget_store
+from .coalesce import flush_due
+from . import flow_control, delivery_queue, gateway_telemetry, battery_history, hardware_registry
 
 """
 CELERY BACKGROUND TASKS
@@ -28,18 +35,43 @@ Why use Celery?
 
 logger = logging.getLogger(__name__)
 
+@worker_process_init.connect
+def warm_render_assets(**kwargs):
+    """
+    Preloads fonts, metric tables and icons in each forked worker process
+    so that its first label render doesn't pay the loading cost.
+    """
+    try:
+        assets.warm()
+    except Exception:
+        logger.exception("Render asset warm-up failed; assets will load on demand")
+
+def _write_tag_image(tag, bmp_bytes, render_hash):
+    """
+    Writes the rendered BMP to Django's storage system for a tag.
+    Skipped when the file on disk already holds this exact render.
+    """
+    already_on_disk = (
+        render_hash and tag.render_hash == render_hash and
+        tag.tag_image and tag.tag_image.storage.exists(tag.tag_image.name)
+    )
+    if not already_on_disk:
+        filename = f"{tag.tag_mac.replace(':', '')}_{int(time.time())}.bmp"
+        tag.tag_image.save(filename, ContentFile(bmp_bytes), save=False)
+
 @shared_task(bind=True, name="core.tasks.update_tag_image_task")
-def update_tag_image_task(self, tag_id, is_retry=False):
+def update_tag_image_task(self, tag_id, is_retry=False, priority=delivery_queue.PRIORITY_PRICE, force=False):
     """
     STAGE 1: IMAGE GENERATION
     -------------------------
     This task creates the physical BMP file that will be displayed on the tag.
+    With 'force' the image is sent even if the tag already displays it.
     """
     # 0. SYSTEM RETRY CHECK:
     # If this is an automatic system retry (backoff), we only proceed if
     # the tag hasn't already succeeded or been manually refreshed in between.
     if is_retry:
-        tag_status = ESLTag.objects.filter(pk=tag_id).values_list('sync_state', flat=True).first()
+        tag_status, store_id = ESLTag.objects.filter(pk=tag_id).values_list('sync_state', 'store_id').first() or (None, None)
         if tag_status != 'RETRY_WAITING':
             logger.info(f"Tag {tag_id} no longer in RETRY_WAITING (is: {tag_status}). Aborting retry task.")
             return "Retry aborted: Status changed"
@@ -53,11 +85,16 @@ def update_tag_image_task(self, tag_id, is_retry=False):
         # We allow overriding PUSHED (sent to gateway) or RETRY_WAITING (backoff) states
         # if a user manually triggers a refresh.
         if not is_retry:
-            tag_status = ESLTag.objects.filter(pk=tag_id).values_list('sync_state', flat=True).first()
+            tag_status, store_id = ESLTag.objects.filter(pk=tag_id).values_list('sync_state', 'store_id').first() or (None, None)
             if tag_status in ['PROCESSING', 'IMAGE_READY']:
                 logger.info(f"Tag {tag_id} is currently being processed ({tag_status}). Skipping redundant refresh.")
                 return "Skipped: Already processing"
 
+        # ADMISSION CONTROL: Don't render for a store that can't receive it right now.
+        # The tag is PARKED and rendered with its latest content on reconnect.
+        if not admit([(tag_id, store_id)]):
+            return "Deferred: All store gateways offline"
+
         # DISTRIBUTED LOCKING
         lock_id = f"lock-tag-gen-{tag_id}"
         if not cache.add(lock_id, self.request.id, 30):
@@ -69,7 +106,10 @@ def update_tag_image_task(self, tag_id, is_retry=False):
         # Reset retry count and generate a base token if this is a fresh update
         if not is_retry:
             base_token = random.randint(0, 16383)
-            ESLTag.objects.filter(pk=tag_id).update(retry_count=0, last_image_task_token=base_token, sync_state='PROCESSING')
+            reset = {'displayed_image_hash': None} if force else {}
+            ESLTag.objects.filter(pk=tag_id).update(retry_count=0, last_image_task_token=base_token, sync_state='PROCESSING', **reset)
+            # A late result for the previous push must not confirm the new image
+            hardware_registry.announce(dropped=[tag_id])
         else:
             ESLTag.objects.filter(pk=tag_id).update(sync_state='PROCESSING')
 
@@ -85,26 +125,23 @@ def update_tag_image_task(self, tag_id, is_retry=False):
             cache.delete(lock_id)
             return "Skipped: No product"
 
-        # CALL UTILS: Render the actual BMP image using Pillow (PIL)
+        # CALL UTILS: Render the BMP (or reuse cached bytes for identical content)
         try:
-            pil_img = generate_esl_image(tag_id, tag_instance=tag)
+            bmp_bytes, render_hash, cache_hit = render_tag_bmp(tag)
         except Exception as e:
             logger.exception(f"Image gen failed for {tag.tag_mac}")
             ESLTag.objects.filter(pk=tag_id).update(sync_state='GEN_FAILED')
             cache.delete(lock_id)
             return f"Generation Failed: {str(e)}"
 
-        # SAVE TO DISK:
-        # Write the image to a memory buffer, then save it to Django's storage system.
-        buf = io.BytesIO()
-        pil_img.save(buf, format='BMP')
-        filename = f"{tag.tag_mac.replace(':', '')}_{int(time.time())}.bmp"
-        tag.tag_image.save(filename, ContentFile(buf.getvalue()), save=False)
+        # SAVE TO DISK
+        _write_tag_image(tag, bmp_bytes, render_hash)
 
         # UPDATE DB: Record that the image is ready for delivery.
         now = timezone.now()
         ESLTag.objects.filter(pk=tag_id).update(
             tag_image=tag.tag_image.name,
+            render_hash=render_hash,
             sync_state='IMAGE_READY',
             last_image_gen_success=now,
             last_image_task_id=self.request.id
@@ -114,8 +151,8 @@ def update_tag_image_task(self, tag_id, is_retry=False):
         cache.delete(lock_id)
 
         # CHAINING: Trigger the next stage (MQTT Delivery)
-        dispatch_tag_image_task.delay(tag_id)
-        return f"BMP Generated for {tag.tag_mac}"
+        dispatch_tag_image_task.delay(tag_id, priority=priority)
+        return f"BMP {'reused' if cache_hit else 'generated'} for {tag.tag_mac}"
 
     except Exception as e:
         logger.exception(f"Critical error in update_tag_image_task for tag {tag_id}")
@@ -123,8 +160,115 @@ def update_tag_image_task(self, tag_id, is_retry=False):
         if 'lock_id' in locals(): cache.delete(lock_id)
         raise e
 
+@shared_task(bind=True, name="core.tasks.render_tag_batch_task")
+def render_tag_batch_task(self, tag_ids, priority=delivery_queue.PRIORITY_PRICE, is_retry=False):
+    """
+    STAGE 1 (BATCH): GROUPED IMAGE GENERATION
+    -----------------------------------------
+    Bulk counterpart of update_tag_image_task for an in-flight set of tags.
+    Tags showing the same product on the same hardware spec and template
+    have identical pixels, so each (product, hardware_spec, template_id)
+    group is rendered once and the result is attached to every tag in it.
+    With 'is_retry' only RETRY_WAITING tags are rendered and their retry
+    counters and tokens are kept.
+    """
+    # DEDUPLICATION: Skip tags that are already mid-pipeline (same rule as the single task)
+    candidates = ESLTag.objects.filter(pk__in=tag_ids)
+    if is_retry:
+        candidates = candidates.filter(sync_state='RETRY_WAITING')
+    else:
+        candidates = candidates.exclude(sync_state__in=['PROCESSING', 'IMAGE_READY'])
+    # ADMISSION CONTROL: Tags of stores without an online gateway are parked, not rendered
+    candidate_ids = admit(list(candidates.values_list('id', 'store_id')))
+
+    # DISTRIBUTED LOCKING: Shares the per-tag lock with update_tag_image_task
+    locked_ids = [tid for tid in candidate_ids if cache.add(f"lock-tag-gen-{tid}", self.request.id, 60)]
+    if not locked_ids:
+        return "Skipped: Nothing to render"
+
+    ready_ids = []
+    try:
+        # DATA PREFETCHING: One query for the whole batch
+        tags = list(ESLTag.objects.select_related(
+            'hardware_spec',
+            'paired_product__preferred_supplier',
+            'gateway__store__company'
+        ).filter(pk__in=locked_ids))
+
+        # Fresh update: reset retries and give every tag its own base token
+        if is_retry:
+            ESLTag.objects.filter(pk__in=locked_ids).update(sync_state='PROCESSING')
+        else:
+            for tag in tags:
+                tag.retry_count = 0
+                tag.last_image_task_token = random.randint(0, 16383)
+                tag.sync_state = 'PROCESSING'
+            ESLTag.objects.bulk_update(tags, ['retry_count', 'last_image_task_token', 'sync_state'])
+            hardware_registry.announce(dropped=[tag.pk for tag in tags])
+
+        # GROUPING: Tags that would render identical pixels
+        groups = {}
+        unpaired_ids = []
+        for tag in tags:
+            if not tag.paired_product:
+                unpaired_ids.append(tag.pk)
+                continue
+            groups.setdefault((tag.paired_product_id, tag.hardware_spec_id, tag.template_id), []).append(tag)
+
+        if unpaired_ids:
+            ESLTag.objects.filter(pk__in=unpaired_ids).update(sync_state='IDLE')
+
+        now = timezone.now()
+        rendered, failed_ids = [], []
+        for group_tags in groups.values():
+            # RENDER ONCE...
+            try:
+                bmp_bytes, render_hash, _ = render_tag_bmp(group_tags[0])
+            except Exception:
+                logger.exception(f"Image gen failed for group led by {group_tags[0].tag_mac}")
+                failed_ids.extend(t.pk for t in group_tags)
+                continue
+
+            # ...AND FAN OUT to every tag in the group
+            for tag in group_tags:
+                _write_tag_image(tag, bmp_bytes, render_hash)
+                tag.render_hash = render_hash
+                tag.sync_state = 'IMAGE_READY'
+                tag.last_image_gen_success = now
+                tag.last_image_task_id = self.request.id
+                rendered.append(tag)
+
+        if failed_ids:
+            ESLTag.objects.filter(pk__in=failed_ids).update(sync_state='GEN_FAILED')
+
+        if rendered:
+            ESLTag.objects.bulk_update(
+                rendered,
+                ['tag_image', 'render_hash', 'sync_state', 'last_image_gen_success', 'last_image_task_id']
+            )
+        ready_ids = [t.pk for t in rendered]
+
+        logger.info(f"Batch render: {len(ready_ids)} tags from {len(groups)} renders (Task: {self.request.id})")
+    except Exception:
+        logger.exception("Critical error in render_tag_batch_task")
+        ESLTag.objects.filter(pk__in=locked_ids, sync_state='PROCESSING').update(sync_state='FAILED')
+        raise
+    finally:
+        # RELEASE LOCKS
+        cache.delete_many([f"lock-tag-gen-{tid}" for tid in locked_ids])
+
+    # CHAINING: Trigger the next stage (MQTT Delivery)
+    for tid in ready_ids:
+        dispatch_tag_image_task.delay(tid, priority=priority)
+    return f"Batch rendered {len(ready_ids)} tags ({len(groups)} unique images)"
+
 def trigger_gateway_processing(gateway_id):
     """Ensures a worker is processing the queue for this gateway."""
+    if settings.ESL_DELIVERY_MODE == 'daemon':
+        # The delivery daemon owns the send loops: just wake the gateway's loop
+        delivery_queue.notify(gateway_id)
+        return
+
     lock_key = f"gateway_proc_lock_{gateway_id}"
     # Use a specific value to identify the active task
     if cache.add(lock_key, "active", 60):
@@ -134,11 +278,12 @@ def trigger_gateway_processing(gateway_id):
         logger.debug(f"Queue processor already active for gateway {gateway_id}")
 
 @shared_task(name="core.tasks.dispatch_tag_image_task")
-def dispatch_tag_image_task(tag_id):
+def dispatch_tag_image_task(tag_id, priority=delivery_queue.PRIORITY_PRICE):
     """
     STAGE 2: GATEWAY ASSIGNMENT
     ---------------------------
-    Decides which gateway will handle this tag and triggers the queue.
+    Decides which gateway will handle this tag, adds it to that gateway's
+    delivery queue in the given priority lane and triggers the queue.
     """
     lock_id = f"lock-tag-gen-{tag_id}"
     try:
@@ -151,18 +296,16 @@ def dispatch_tag_image_task(tag_id):
 
         # REAL-TIME CONNECTIVITY CHECK
         # We fetch ALL gateways for this store and verify their heartbeat status
-        all_store_gateways = list(Gateway.objects.filter(store=tag.store))
+        all_store_gateways = gateway_telemetry.apply(Gateway.objects.filter(store=tag.store))
         online_gateways = [gw for gw in all_store_gateways if gw.is_currently_online()]
 
         if not online_gateways:
-            # If NO gateways are online for the store, we mark it as a terminal failure
-            # or trigger a retry which will eventually land in PUSH_FAILED.
-            logger.warning(f"No online gateways found for store {tag.store.name}. Tag {tag.tag_mac} push aborted.")
+            # If NO gateways are online for the store, the tag is PARKED with its image.
+            # The first gateway of the store to reconnect releases it (see core/retries.py).
+            logger.warning(f"No online gateways found for store {tag.store.name}. Tag {tag.tag_mac} parked.")
             cache.delete(lock_id)
-
-            # Update sync_state to PUSH_FAILED immediately for accurate reporting
-            ESLTag.objects.filter(pk=tag_id).update(sync_state='PUSH_FAILED')
-            return "Gateway push failed: All gateways offline"
+            ESLTag.objects.filter(pk=tag_id).update(sync_state='PARKED')
+            return "Parked: All gateways offline"
 
         # FAILOVER ROTATION STRATEGY
         # We prioritize the last successful gateway, then the assigned one,
@@ -195,6 +338,7 @@ def dispatch_tag_image_task(tag_id):
             sync_state='IMAGE_READY'
         )
 
+        delivery_queue.enqueue(best_gateway_id, [tag_id], priority=priority)
         trigger_gateway_processing(best_gateway_id)
         cache.delete(lock_id)
         return f"Queued for gateway {best_gateway_id}"
@@ -210,10 +354,10 @@ def process_gateway_queue_task(gateway_id):
     """
     STAGE 3: SERIALIZED DELIVERY
     ----------------------------
-    Processes tags for a specific gateway one by one with a dynamic delay.
-    Ensures strict serialization and one-at-a-time delivery.
+    Processes tags for a specific gateway in batches (ESL_TASK_BATCH_SIZE
+    tags per message, default 1) with a dynamic delay between messages.
+    Ensures strict serialization: one message in flight per gateway loop.
     """
-    from django.db import transaction
     lock_key = f"gateway_proc_lock_{gateway_id}"
 
     # 1. Ensure the lock is held to prevent other workers from starting a parallel loop.
@@ -221,6 +365,8 @@ def process_gateway_queue_task(gateway_id):
     cache.set(lock_key, "active", 60)
 
     # 2. Dynamic Settings
+    # With flow control the gateway's window paces delivery instead of a fixed delay.
+    flow_controlled = flow_control.is_enabled()
     delay_ms = int(GlobalSetting.objects.filter(key='ESL_SEND_DELAY_MS').values_list('value', flat=True).first() or 500)
     delay_seconds = max(0.1, delay_ms / 1000.0)
 
@@ -233,74 +379,32 @@ def process_gateway_queue_task(gateway_id):
         # Extend the lock periodically
         cache.set(lock_key, "active", 60)
 
-        tag = None
-        # 3. Find and LOCK the next tag in the queue for THIS gateway
-        with transaction.atomic():
-            tag = ESLTag.objects.select_for_update(skip_locked=True).filter(
-                gateway__estation_id=gateway_id,
-                sync_state='IMAGE_READY'
-            ).order_by('updated_at').first()
-
-            if not tag:
-                logger.info(f"Queue for gateway {gateway_id} is empty. (Processed: {tags_processed_count})")
-                # IMPORTANT: Only delete if it's been less than 45s, otherwise we might delete a NEW task's lock
-                if (time.time() - start_time) < 45:
-                    cache.delete(lock_key)
-                return f"Queue empty. Processed: {tags_processed_count}"
-
-            # Mark as 'PROCESSING' immediately to claim it
-            ESLTag.objects.filter(pk=tag.pk).update(sync_state='PROCESSING')
-            # Update in-memory object to keep it consistent without an extra query
-            tag.sync_state = 'PROCESSING'
-
-        # 4. Prepare and Send
-        try:
-            # Redundant refresh_from_db() removed for performance ($O(1)$ query reduction per tag)
-            tag_mac = tag.tag_mac.upper()
-
-            # REAL-TIME CONNECTIVITY VERIFICATION
-            # If the gateway went offline since the task was queued, trigger a failure/retry
-            if not tag.gateway.is_currently_online():
-                 logger.warning(f"Gateway {gateway_id} is OFFLINE. Aborting push for tag {tag_mac}.")
-                 handle_tag_failure_task.delay(tag.id, reason="Gateway Offline during delivery")
-                 continue
-
-            if not tag.tag_image:
-                 logger.error(f"Tag {tag.tag_mac} in queue has no image.")
-                 ESLTag.objects.filter(pk=tag.pk).update(sync_state='GEN_FAILED')
-            else:
-                with tag.tag_image.open('rb') as f:
-                    image_bytes = f.read()
-
-                # TOKEN LOGIC: 2 bits for retry, 14 bits for unique ID
-                base_token = (tag.last_image_task_token or 0) & 0x3FFF
-                token = ((tag.retry_count & 0x03) << 14) | base_token
-
-                logger.info(f"Pushing tag {tag_mac} to {gateway_id} | Token: {token} | Retry: {tag.retry_count}")
-
-                success = mqtt_service.publish_tag_update(gateway_id, tag_mac, image_bytes, token)
-
-                if success:
-                    ESLTag.objects.filter(pk=tag.pk).update(
-                        sync_state='PUSHED',
-                        last_image_task_token=token,
-                        last_pushed_at=timezone.now()
-                    )
-                else:
-                    logger.warning(f"MQTT Publish failed for tag {tag.tag_mac}")
-                    handle_tag_failure_task.delay(tag.id, reason="MQTT Publish Failed")
-
-        except Exception as e:
-            logger.exception(f"Error processing tag {tag.tag_mac} in gateway queue: {str(e)}")
-            handle_tag_failure_task.delay(tag.id, reason=f"Queue Error: {str(e)}")
-
-        tags_processed_count += 1
-
-        # 5. Precise Delay
-        # We wait the specified delay between EACH tag.
-        time.sleep(delay_seconds)
-
-    # 6. Chain if there's potentially more work (reached time limit)
+        # 3. Pop and send the next batch of tags for THIS gateway (see core/delivery.py)
+        # An empty queue is waited on briefly (blocking pop) so tags arriving right
+        # after a batch don't need a new task.
+        handled = deliver_next_batch(
+            gateway_id, flow_controlled=flow_controlled, block_seconds=delivery_queue.QUEUE_IDLE_WAIT_SECONDS
+        )
+        if handled is None:
+            logger.info(f"Queue for gateway {gateway_id} is empty. (Processed: {tags_processed_count})")
+            # IMPORTANT: Only delete if it's been less than 45s, otherwise we might delete a NEW task's lock
+            if (time.time() - start_time) < 45:
+                cache.delete(lock_key)
+            return f"Queue empty. Processed: {tags_processed_count}"
+
+        if handled == 0:
+            # WINDOW FULL: the next /result for this gateway restarts the loop
+            cache.delete(lock_key)
+            return f"Window full. Processed: {tags_processed_count}"
+
+        tags_processed_count += handled
+
+        # 4. Precise Delay
+        # We wait the specified delay between EACH message (one or more tags).
+        if not flow_controlled:
+            time.sleep(delay_seconds)
+
+    # 5. Chain if there's potentially more work (reached time limit)
     logger.info(f"Reached time budget for gateway {gateway_id} queue. Re-triggering.")
     process_gateway_queue_task.delay(gateway_id)
     return f"Time budget reached. Processed: {tags_processed_count}"
@@ -310,55 +414,94 @@ def handle_tag_failure_task(tag_id, reason="Unknown"):
     """
     RETRY LOGIC
     -----------
-    Implements 5m, 15m, 30m backoff for failed updates.
+    Implements 5m, 15m, 30m backoff for a failed update.
+    Single-tag entry point of core/retries.py; code that sees several
+    failures at once calls process_tag_failures() directly.
     """
     try:
-        from .models import ESLTag, MQTTMessage
-        tag = ESLTag.objects.get(pk=tag_id)
-
-        # 1. SUCCESS CHECK: Don't retry if the tag already succeeded
-        if tag.sync_state == 'SUCCESS':
-            return "Skipping retry: Tag already successful"
-
-        # 2. LOGGING & AUDIT: Record the failure in the system logs for visibility
-        if reason == "Timeout" and tag.gateway:
-            # Create a synthetic MQTT log entry to ensure the 'stuck' tag is visible in audit logs
-            MQTTMessage.objects.create(
-                direction='received',
-                estation_id=tag.gateway.estation_id,
-                topic=f"/estation/{tag.gateway.estation_id}/timeout",
-                data=f"TIMEOUT FAILURE: No response from tag {tag.tag_mac} after 60 seconds.",
-                is_success=False
-            )
-
-        # Lock to prevent concurrent retry triggers
-        lock_key = f"retry_lock_{tag_id}"
-        if not cache.add(lock_key, "locked", 15):
-            # If the lock is held, it means another worker is already processing the failure
-            # for this specific tag. We return so we don't duplicate the retry schedule.
-            logger.info(f"Retry/Failure processing already in progress for {tag.tag_mac}. Skipping.")
-            return "Retry already in progress"
-
-        if tag.retry_count < 3:
-            tag.retry_count += 1
-            ESLTag.objects.filter(pk=tag.pk).update(retry_count=tag.retry_count, sync_state='RETRY_WAITING')
-
-            # Backoff: 5m, 15m, 30m
-            delays = [300, 900, 1800]
-            delay = delays[tag.retry_count - 1]
-
-            logger.info(f"Scheduling retry #{tag.retry_count} for {tag.tag_mac} due to {reason}. (Attempt: {tag.retry_count}, Delay: {delay}s)")
-            update_tag_image_task.apply_async(kwargs={'tag_id': tag_id, 'is_retry': True}, countdown=delay)
-            return f"Retry #{tag.retry_count} scheduled"
-        else:
-            tag.sync_state = 'PUSH_FAILED'
-            tag.save()
-            logger.warning(f"Max retries reached for tag {tag.tag_mac} (Final failure: {reason})")
+        retried, failed = process_tag_failures([(tag_id, reason)])
+        if retried:
+            return "Retry scheduled"
+        if failed:
             return f"Max retries reached: {reason}"
+        return "Skipping retry: Tag already successful or waiting"
     except Exception:
         logger.exception(f"Error in handle_tag_failure_task for {tag_id}")
         return "Failure handling failed"
 
+@shared_task(name="core.tasks.sweep_due_retries_task")
+def sweep_due_retries_task():
+    """
+    RETRY SCHEDULER
+    ---------------
+    Runs every minute. Re-renders all tags whose retry is due (see
+    core/retries.py). Only one sweep runs at a time.
+    """
+    lock_key = "retry_sweep_lock"
+    if not cache.add(lock_key, "active", 5 * 60):
+        return "Skipped: Sweep already running"
+    try:
+        count = sweep_due_retries()
+        return f"Started {count} due retries"
+    except Exception:
+        logger.exception("Error in sweep_due_retries_task")
+        return "Retry sweep failed"
+    finally:
+        cache.delete(lock_key)
+
+@shared_task(name="core.tasks.flush_gateway_telemetry_task")
+def flush_gateway_telemetry_task():
+    """
+    GATEWAY TELEMETRY FLUSH
+    -----------------------
+    Writes the heartbeat telemetry collected in Redis to the gateway table
+    in one bulk update (see core/gateway_telemetry.py).
+    """
+    try:
+        return f"Flushed telemetry of {gateway_telemetry.flush()} gateways"
+    except Exception:
+        logger.exception("Error in flush_gateway_telemetry_task")
+        return "Telemetry flush failed"
+
+@shared_task(name="core.tasks.flush_coalesced_edits_task")
+def flush_coalesced_edits_task():
+    """
+    EDIT COALESCING
+    ---------------
+    Renders the tags of every store whose settle window has closed (see
+    core/coalesce.py). Scheduled at the end of each window and run every
+    minute as a safety net.
+    """
+    try:
+        count = flush_due()
+        return f"Flushed {count} coalesced tags"
+    except Exception:
+        logger.exception("Error in flush_coalesced_edits_task")
+        return "Coalesced flush failed"
+
+def on_gateway_reconnected(store_id):
+    """Releases the store's parked tags and retries once per reconnect burst."""
+    if store_id:
+        # New updates for the store are admitted again right away
+        forget_store(store_id)
+    if store_id and cache.add(f"store_release_lock_{store_id}", "active", 30):
+        release_store_backlog_task.delay(store_id)
+
+@shared_task(name="core.tasks.release_store_backlog_task")
+def release_store_backlog_task(store_id):
+    """
+    RECONNECT CATCH-UP
+    ------------------
+    A gateway of this store came back online: deliver the tags parked
+    while it was offline and bring its waiting retries forward.
+    """
+    try:
+        released, rescheduled = release_store_backlog(store_id)
+        return f"Released {released} parked tags, {rescheduled} retries brought forward"
+    except Exception:
+        logger.exception(f"Error in release_store_backlog_task for store {store_id}")
+        return "Release failed"
+
 @shared_task(name="core.tasks.refresh_store_products_task")
 def refresh_store_products_task(store_id):
     """
@@ -366,6 +509,7 @@ def refresh_store_products_task(store_id):
     ------------
     Queues an update for EVERY tag in a specific store.
     Useful after a template change or a bulk import.
+    Large stores are handed to the render farm instead of one task per tag.
     """
     try:
         # Use .values_list('id') to get only IDs (very fast, low memory).
@@ -374,16 +518,41 @@ def refresh_store_products_task(store_id):
             paired_product__isnull=False
         ).values_list('id', flat=True))
 
+        farm_threshold = int(GlobalSetting.objects.filter(key='RENDER_FARM_MIN_TAGS').values_list('value', flat=True).first() or 500)
+        if len(tag_ids) >= farm_threshold:
+            render_store_task.delay(store_id)
+            return f"Render farm started for {len(tag_ids)} tags in store {store_id}"
+
         if tag_ids:
             # Performance: Use trigger_bulk_sync (O(1) Redis round-trips via Celery group)
             # instead of a manual O(N) loop of .delay() calls.
-            trigger_bulk_sync(tag_ids)
+            trigger_bulk_sync(tag_ids, priority=delivery_queue.PRIORITY_BULK)
 
         return f"Queued {len(tag_ids)} tags for store {store_id}"
     except Exception as e:
         logger.exception(f"Error in refresh_store_products_task for store {store_id}")
         raise e
 
+@shared_task(bind=True, name="core.tasks.render_store_task")
+def render_store_task(self, store_id, workers=None):
+    """
+    STORE-WIDE RENDER FARM
+    ----------------------
+    Re-renders every tag of a store on a local process pool and hands the
+    results to the gateways in bulk (see core/render_farm.py).
+    Only one farm runs per store at a time.
+    """
+    from .render_farm import render_store
+
+    lock_key = f"render_farm_lock_{store_id}"
+    if not cache.add(lock_key, self.request.id, 60 * 60):
+        return f"Skipped: Render farm already running for store {store_id}"
+    try:
+        summary = render_store(store_id, workers=workers, task_id=self.request.id)
+        return f"Rendered {summary['tags']} tags ({summary['renders']} renders) in {summary['seconds']}s"
+    finally:
+        cache.delete(lock_key)
+
 @shared_task(name="core.tasks.check_gateways_status_task")
 def check_gateways_status_task():
     """
@@ -395,6 +564,9 @@ def check_gateways_status_task():
     try:
         from django.db.models import F, ExpressionWrapper, DurationField, Q
 
+        # WRITE-BEHIND: Bring last_heartbeat up to date before judging it
+        gateway_telemetry.flush()
+
         # Load multiplier from Global Settings (Default: 4x)
         multiplier = int(GlobalSetting.objects.filter(key='OFFLINE_TIMEOUT_MULTIPLIER').values_list('value', flat=True).first() or 4)
         now = timezone.now()
@@ -412,15 +584,19 @@ def check_gateways_status_task():
 
             # Update all online/error gateways with THIS interval that haven't been seen since the cutoff.
             # update() runs a single SQL query: UPDATE ... WHERE ...
-            updated = Gateway.objects.exclude(
+            stale = Gateway.objects.exclude(
                 is_online='OFFLINE'
             ).filter(
                 heartbeat_interval=interval_val,
                 last_heartbeat__lt=cutoff
-            ).update(
+            )
+            stale_ids = list(stale.values_list('estation_id', flat=True))
+            updated = stale.update(
                 is_online='OFFLINE',
                 last_error_message=f"Offline: No heartbeat received for {timeout_seconds}s (Checked at {now.strftime('%H:%M:%S')})"
             )
+            # The next heartbeat of these gateways must reach the database (reconnect)
+            gateway_telemetry.forget(stale_ids)
             count_offline += updated
 
         # Handle edge case: Gateways that never sent a heartbeat (last_heartbeat is null)
@@ -449,21 +625,42 @@ def check_gateways_status_task():
         timed_out_tags = list(ESLTag.objects.filter(
             Q(sync_state='PUSHED', last_pushed_at__lt=timeout_cutoff) |
             Q(sync_state='PROCESSING', updated_at__lt=stuck_cutoff)
-        ).values_list('id', flat=True))
+        ).values_list('id', 'sync_state', 'gateway__estation_id'))
 
-        count_tag_timeouts = 0
-        for tid in timed_out_tags:
-            # We don't countdown here, we call immediately so it enters RETRY_WAITING or PUSH_FAILED
-            handle_tag_failure_task.delay(tid, reason="Timeout")
-            count_tag_timeouts += 1
+        # All timeouts go through one bulk failure pass (RETRY_WAITING or PUSH_FAILED)
+        process_tag_failures((tid, "Timeout") for tid, _, _ in timed_out_tags)
+        count_tag_timeouts = len(timed_out_tags)
+
+        unacked_by_gateway = {}
+        for tid, state, gw_id in timed_out_tags:
+            if state == 'PUSHED' and gw_id:
+                unacked_by_gateway[gw_id] = unacked_by_gateway.get(gw_id, 0) + 1
+
+        # Results that never arrived are a congestion signal for flow control
+        for gw_id, count in unacked_by_gateway.items():
+            flow_control.record_timeouts(gw_id, count)
 
         if count_tag_timeouts > 0:
             logger.info(f"Triggered recovery/retry for {count_tag_timeouts} tags due to timeout or stuck processing.")
 
+        # Parked tags whose store has an online gateway again (reconnects that
+        # were not seen as an OFFLINE -> ONLINE transition, e.g. short blips)
+        parked_stores = ESLTag.objects.filter(sync_state='PARKED').values_list('store_id', flat=True).distinct()
+        online_stores = {
+            gw.store_id for gw in gateway_telemetry.apply(Gateway.objects.filter(store_id__in=parked_stores))
+            if gw.is_currently_online()
+        }
+        for store_id in online_stores:
+            on_gateway_reconnected(store_id)
+
         # NEW: Restart stalled queues (in case a worker died)
-        # We look for any tag in 'IMAGE_READY' state and ensure its gateway's queue is active.
-        gateways_with_pending = list(Gateway.objects.filter(tags__sync_state='IMAGE_READY').values_list('estation_id', flat=True).distinct())
-        for gw_id in gateways_with_pending:
+        # We look for any tag in 'IMAGE_READY' state and ensure it is queued and its gateway's queue is active.
+        # Re-queuing is harmless: tags already in the queue keep their better score.
+        pending_by_gateway = {}
+        for tid, gw_id in ESLTag.objects.filter(sync_state='IMAGE_READY', gateway__isnull=False).values_list('id', 'gateway__estation_id'):
+            pending_by_gateway.setdefault(gw_id, []).append(tid)
+        for gw_id, tag_ids in pending_by_gateway.items():
+            delivery_queue.enqueue(gw_id, tag_ids, priority=delivery_queue.PRIORITY_BULK)
             trigger_gateway_processing(gw_id)
 
         return f"Checked status. Marked {count_offline} gateways offline and {count_tag_timeouts} tag timeouts."
@@ -478,6 +675,7 @@ def cleanup_old_logs_task():
     -----------------
     Deletes old MQTT messages and log files to keep the database
     and disk from filling up. Retention is usually 15-30 days.
+    Battery history follows 'BATTERY_HISTORY_DAYS' (default 365).
     """
     try:
         from django.conf import settings
@@ -488,12 +686,16 @@ def cleanup_old_logs_task():
         cutoff = timezone.now() - timezone.timedelta(days=retention_days)
         db_count, _ = MQTTMessage.objects.filter(timestamp__lt=cutoff).delete()
 
+        # Daily battery ranges are small and kept much longer than packet logs
+        history_days = int(GlobalSetting.objects.filter(key='BATTERY_HISTORY_DAYS').values_list('value', flat=True).first() or 365)
+        history_count = battery_history.purge(history_days)
+
         # 2. File Purge
         log_dirs = [
-            os.path.join(settings.BASE_DIR, 'logs', 'mqtt', 'received'),
-            os.path.join(settings.BASE_DIR, 'logs', 'mqtt', 'sent'),
-            os.path.join(settings.BASE_DIR, 'logs', 'mqtt'),
-            os.path.join(settings.BASE_DIR, 'logs'),
+            os.path.join(settings.LOGS_DIR, 'mqtt', 'received'),
+            os.path.join(settings.LOGS_DIR, 'mqtt', 'sent'),
+            os.path.join(settings.LOGS_DIR, 'mqtt'),
+            settings.LOGS_DIR,
         ]
 
         now = time.time()
@@ -511,7 +713,7 @@ def cleanup_old_logs_task():
                     os.remove(filepath)
                     count_deleted += 1
 
-        return f"Cleaned up {db_count} DB records and {count_deleted} log files."
+        return f"Cleaned up {db_count} DB records, {history_count} battery history days and {count_deleted} log files."
     except Exception:
         logger.exception("Error in cleanup_old_logs_task")
         return "Cleanup failed"
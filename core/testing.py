@@ -0,0 +1,168 @@
+import time
+import shutil
+import tempfile
+import unittest
+import threading
+from unittest import mock
+from django.test import override_settings
+from django.test.runner import DiscoverRunner
+
+"""
+TEST SUPPORT
+------------
+Helpers shared by the core/tests_*.py modules. Nothing here is used by
+the application itself.
+
+- TempMediaMixin: tests that render or save tag images write them to a
+  throwaway MEDIA_ROOT instead of the project's media/ folder.
+- LocalRedis: an in-memory stand-in for the Redis commands the app uses.
+  TestRunner (settings.TEST_RUNNER) patches delivery_queue.get_redis() to
+  return one for the whole run, so the suite needs no Redis server, and
+  empties it before every test, so queues, dirty sets and telemetry never
+  leak from one test into the next.
+"""
+
+
+class TempMediaMixin:
+    """Points MEDIA_ROOT at a temporary directory for the whole test class."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls._media_root = tempfile.mkdtemp(prefix='sais-test-media-')
+        cls._media_override = override_settings(MEDIA_ROOT=cls._media_root)
+        cls._media_override.enable()
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        cls._media_override.disable()
+        shutil.rmtree(cls._media_root, ignore_errors=True)
+
+
+class LocalRedis:
+    """
+    In-process stand-in for the few sorted-set and hash commands the app
+    uses (delivery queues, coalescing, telemetry). Only shared between
+    threads of one process.
+    """
+    def __init__(self):
+        self._sets = {}
+        self._hashes = {}
+        self._cond = threading.Condition()
+
+    @staticmethod
+    def _member(member):
+        return member if isinstance(member, bytes) else str(member).encode()
+
+    def zadd(self, key, mapping, lt=False):
+        with self._cond:
+            zset = self._sets.setdefault(key, {})
+            for member, score in mapping.items():
+                member = self._member(member)
+                if lt and member in zset and zset[member] <= score:
+                    continue
+                zset[member] = score
+            self._cond.notify_all()
+
+    def zpopmin(self, key, count=1):
+        with self._cond:
+            zset = self._sets.get(key, {})
+            items = sorted(zset.items(), key=lambda kv: (kv[1], kv[0]))[:count]
+            for member, _ in items:
+                del zset[member]
+            return items
+
+    def bzpopmin(self, key, timeout=0):
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while True:
+                items = self.zpopmin(key, 1)
+                if items:
+                    return (key.encode(), items[0][0], items[0][1])
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self._cond.wait(remaining)
+
+    def zrangebyscore(self, key, min, max):
+        with self._cond:
+            zset = self._sets.get(key, {})
+            return [m for m, score in sorted(zset.items(), key=lambda kv: (kv[1], kv[0])) if min <= score <= max]
+
+    def zcard(self, key):
+        return len(self._sets.get(key, {}))
+
+    def zrem(self, key, *members):
+        with self._cond:
+            zset = self._sets.get(key, {})
+            return sum(1 for m in members if zset.pop(self._member(m), None) is not None)
+
+    def delete(self, *keys):
+        with self._cond:
+            for key in keys:
+                self._sets.pop(key, None)
+                self._hashes.pop(key, None)
+
+    def hset(self, key, mapping):
+        with self._cond:
+            self._hashes.setdefault(key, {}).update({k: str(v).encode() for k, v in mapping.items()})
+
+    def hgetall(self, key):
+        with self._cond:
+            return {k.encode(): v for k, v in self._hashes.get(key, {}).items()}
+
+    def expire(self, key, seconds):
+        return True  # Keys live as long as the process
+
+    def publish(self, channel, message):
+        return 0  # No subscribers without Redis
+
+    def pipeline(self, transaction=True):
+        return LocalPipeline(self)
+
+    def flushall(self):
+        with self._cond:
+            self._sets.clear()
+            self._hashes.clear()
+
+
+class LocalPipeline:
+    """Queues LocalRedis calls and runs them on execute(), like a Redis pipeline."""
+    def __init__(self, client):
+        self._client = client
+        self._calls = []
+
+    def __getattr__(self, name):
+        method = getattr(self._client, name)
+        return lambda *args, **kwargs: self._calls.append((method, args, kwargs)) or self
+
+    def execute(self):
+        calls, self._calls = self._calls, []
+        return [method(*args, **kwargs) for method, args, kwargs in calls]
+
+
+class FreshRedisResultMixin:
+    """Test result mixin: every test starts with an empty LocalRedis."""
+
+    def startTest(self, test):
+        from core import delivery_queue
+        delivery_queue.get_redis().flushall()
+        super().startTest(test)
+
+
+class TestRunner(DiscoverRunner):
+    """Runs the suite against LocalRedis instead of settings.REDIS_URL."""
+
+    def get_resultclass(self):
+        base = super().get_resultclass() or unittest.TextTestResult
+        return type(f"FreshRedis{base.__name__}", (FreshRedisResultMixin, base), {})
+
+    def setup_test_environment(self, **kwargs):
+        super().setup_test_environment(**kwargs)
+        self._redis_patch = mock.patch('core.delivery_queue.get_redis', return_value=LocalRedis())
+        self._redis_patch.start()
+
+    def teardown_test_environment(self, **kwargs):
+        self._redis_patch.stop()
+        super().teardown_test_environment(**kwargs)
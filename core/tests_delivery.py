@@ -0,0 +1,244 @@
+import msgpack
+from unittest import mock
+from django.test import TestCase, override_settings
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.utils import timezone
+from core.models import Company, Store, Gateway, ESLTag, TagHardware, GlobalSetting
+from core.mqtt_client import mqtt_service
+from core import delivery, flow_control, delivery_queue
+from core.testing import TempMediaMixin
+
+
+class DeliveryTestBase(TempMediaMixin, TestCase):
+    def setUp(self):
+        cache.clear()
+        self.company = Company.objects.create(name="Delivery Co")
+        self.store = Store.objects.create(name="Delivery Store", company=self.company)
+        self.gateway = Gateway.objects.create(
+            estation_id="DG01", store=self.store, gateway_mac="DG:01", is_online='ONLINE',
+            last_heartbeat=timezone.now()
+        )
+        self.hw = TagHardware.objects.create(model_number="D250", width_px=250, height_px=122, color_scheme='BW', display_size_inch=2.13)
+        with mock.patch('core.tasks.update_tag_image_task.delay'):
+            self.tags = [
+                ESLTag.objects.create(tag_mac=f"DD000000000{i}", store=self.store, gateway=self.gateway, hardware_spec=self.hw)
+                for i in range(5)
+            ]
+        for i, tag in enumerate(self.tags):
+            tag.tag_image.save(f"DD000000000{i}.bmp", ContentFile(b'BM' + bytes(1000)), save=False)
+        ESLTag.objects.bulk_update(self.tags, ['tag_image'])
+        ESLTag.objects.filter(store=self.store).update(sync_state='IMAGE_READY', last_image_task_token=42)
+        delivery_queue.enqueue("DG01", [t.pk for t in self.tags])
+
+    def _deliver_all(self):
+        payloads = []
+        with mock.patch.object(mqtt_service.client, 'is_connected', return_value=True), \
+             mock.patch.object(mqtt_service.client, 'publish') as publish, \
+             mock.patch.object(mqtt_service, '_log_mqtt_message'):
+            publish.return_value.rc = 0
+            while delivery.deliver_next_batch("DG01") is not None:
+                if publish.call_count > len(payloads):
+                    payloads.append(msgpack.unpackb(publish.call_args[0][1], raw=False))
+        return payloads
+
+
+class BatchedDeliveryTest(DeliveryTestBase):
+    def test_default_sends_one_tag_per_message(self):
+        payloads = self._deliver_all()
+        self.assertEqual([len(p) for p in payloads], [1] * 5)
+
+    def test_batches_several_tags_per_message(self):
+        GlobalSetting.objects.create(key='ESL_TASK_BATCH_SIZE', value='3')
+        payloads = self._deliver_all()
+
+        self.assertEqual([len(p) for p in payloads], [3, 2])
+        self.assertEqual({task[0] for p in payloads for task in p}, {t.tag_mac for t in self.tags})
+        self.assertTrue(all(task[7] == 42 for p in payloads for task in p))
+        self.assertEqual(set(ESLTag.objects.filter(store=self.store).values_list('sync_state', flat=True)), {'PUSHED'})
+
+    @override_settings(ESL_MAX_PAYLOAD_BYTES=3000)
+    def test_batches_are_capped_by_payload_bytes(self):
+        GlobalSetting.objects.create(key='ESL_TASK_BATCH_SIZE', value='10')
+        payloads = self._deliver_all()
+        # Each Base64 task is ~1.4 KB: two fit under 3 KB
+        self.assertEqual([len(p) for p in payloads], [2, 2, 1])
+        self.assertEqual(delivery_queue.queue_length("DG01"), 0)
+
+    def test_unreadable_image_fails_only_its_tag(self):
+        GlobalSetting.objects.create(key='ESL_TASK_BATCH_SIZE', value='5')
+        broken = self.tags[2]
+        broken.tag_image.storage.delete(broken.tag_image.name)
+
+        payloads = self._deliver_all()
+        self.assertEqual([len(p) for p in payloads], [4])
+        self.assertEqual({task[0] for task in payloads[0]}, {t.tag_mac for t in self.tags if t != broken})
+        self.assertEqual(
+            dict(ESLTag.objects.filter(store=self.store).values_list('tag_mac', 'sync_state')),
+            {t.tag_mac: 'GEN_FAILED' if t == broken else 'PUSHED' for t in self.tags}
+        )
+
+
+class PriorityQueueTest(DeliveryTestBase):
+    def test_urgent_lanes_overtake_bulk(self):
+        queue = delivery_queue.get_redis()
+        queue.delete(delivery_queue.queue_key("DG01"))
+        delivery_queue.enqueue("DG01", [t.pk for t in self.tags[:3]], priority=delivery_queue.PRIORITY_BULK)
+        delivery_queue.enqueue("DG01", [self.tags[3].pk], priority=delivery_queue.PRIORITY_PRICE)
+        delivery_queue.enqueue("DG01", [self.tags[4].pk], priority=delivery_queue.PRIORITY_INTERACTIVE)
+
+        payloads = self._deliver_all()
+        order = [task[0] for p in payloads for task in p]
+        self.assertEqual(order[:2], [self.tags[4].tag_mac, self.tags[3].tag_mac])
+        self.assertEqual(set(order[2:]), {t.tag_mac for t in self.tags[:3]})
+
+    def test_requeue_keeps_better_score(self):
+        tag_id = self.tags[0].pk
+        delivery_queue.enqueue("DG01", [tag_id], priority=delivery_queue.PRIORITY_INTERACTIVE)
+        delivery_queue.enqueue("DG01", [tag_id], priority=delivery_queue.PRIORITY_BULK)
+        self.assertEqual(delivery_queue.pop("DG01", 1)[0][0], tag_id)
+        self.assertEqual(delivery_queue.queue_length("DG01"), 4)
+
+    def test_stale_entries_are_skipped(self):
+        ESLTag.objects.filter(pk=self.tags[0].pk).update(sync_state='SUCCESS')
+        payloads = self._deliver_all()
+        self.assertEqual(len(payloads), 4)
+        self.assertEqual(ESLTag.objects.get(pk=self.tags[0].pk).sync_state, 'SUCCESS')
+
+
+class FlowControlTest(DeliveryTestBase):
+    def setUp(self):
+        super().setUp()
+        GlobalSetting.objects.create(key='ESL_FLOW_CONTROL', value='1')
+
+    def test_aimd_window(self):
+        window = flow_control.FlowWindow("DG01")
+        window.on_ack(3, max_window=64)
+        self.assertEqual(window.size, 5)  # Slow start: +1 per confirmed tag
+
+        self.assertTrue(window.on_congestion())
+        self.assertEqual(window.size, 2)
+        self.assertFalse(window.on_congestion())  # Same burst: no second halving
+
+        window.on_ack(2, max_window=64)
+        self.assertEqual(window.size, 3)  # Additive increase: ~+1 per window
+
+        window.queued = 10
+        window.on_ack(5, max_window=64)
+        self.assertEqual(window.size, 3)  # Gateway backlog holds the window
+
+    def _run_queue(self):
+        from core.tasks import process_gateway_queue_task
+        with mock.patch.object(mqtt_service.client, 'is_connected', return_value=True), \
+             mock.patch.object(mqtt_service.client, 'publish') as publish, \
+             mock.patch.object(mqtt_service, '_log_mqtt_message'), \
+             mock.patch('core.tasks.time.sleep') as sleep:
+            publish.return_value.rc = 0
+            result = process_gateway_queue_task.apply(args=["DG01"]).get()
+        sleep.assert_not_called()
+        return result, publish.call_count
+
+    def test_delivery_stops_when_window_is_full(self):
+        result, publishes = self._run_queue()
+        self.assertTrue(result.startswith("Window full"))
+        self.assertEqual(publishes, flow_control.INITIAL_WINDOW)
+        self.assertEqual(ESLTag.objects.filter(sync_state='PUSHED').count(), flow_control.INITIAL_WINDOW)
+
+    def test_results_open_window_and_trigger_next_send(self):
+        self._run_queue()
+        pushed = list(ESLTag.objects.filter(sync_state='PUSHED'))
+        results = [[t.tag_mac, 0, 30, 0, 1, t.last_image_task_token] for t in pushed]
+
+        with mock.patch('core.tasks.trigger_gateway_processing') as trigger:
+            mqtt_service.handle_result("DG01", [1, 0, 0, 1, results])
+        trigger.assert_called_once_with("DG01")
+        self.assertEqual(flow_control.FlowWindow.load("DG01").size, flow_control.INITIAL_WINDOW + len(pushed))
+
+        with mock.patch.object(delivery_queue, 'QUEUE_IDLE_WAIT_SECONDS', 0):
+            result, publishes = self._run_queue()
+        self.assertEqual(publishes, 3)  # Remaining queue fits in the larger window
+        self.assertTrue(result.startswith("Queue empty"))
+
+    def test_max_limit_closes_window(self):
+        flow_control.FlowWindow("DG01", cwnd=16).save()
+        with mock.patch('core.tasks.trigger_gateway_processing'):
+            mqtt_service.handle_result("DG01", [1, 0, 0, 8, [["FFFFFFFFFFFF", 0, 30, 0, 0, 1]]])
+        self.assertEqual(flow_control.FlowWindow.load("DG01").size, 8)
+
+
+class UnchangedImageTest(DeliveryTestBase):
+    def test_displayed_image_is_not_sent_again(self):
+        self._deliver_all()
+        shown = self.tags[0]
+        mqtt_service.handle_result("DG01", [shown.tag_mac, -60, 29, "v1", 1, 42])
+        shown.refresh_from_db()
+        self.assertEqual(shown.sync_state, 'SUCCESS')
+        self.assertEqual(shown.displayed_image_hash, shown.pushed_image_hash)
+        self.assertIsNotNone(shown.displayed_image_hash)
+
+        # Store-wide refresh with identical images: only unconfirmed tags are sent
+        ESLTag.objects.filter(store=self.store).update(sync_state='IMAGE_READY')
+        delivery_queue.enqueue("DG01", [t.pk for t in self.tags])
+        payloads = self._deliver_all()
+
+        self.assertEqual({task[0] for p in payloads for task in p}, {t.tag_mac for t in self.tags[1:]})
+        self.assertEqual(ESLTag.objects.get(pk=shown.pk).sync_state, 'SUCCESS')
+
+    def test_force_clears_displayed_image(self):
+        from core.models import Product
+        from core.utils import trigger_bulk_sync
+        product = Product.objects.create(sku="444", name="Forced Product", price="1.00", store=self.store)
+        ESLTag.objects.filter(store=self.store).update(displayed_image_hash="a" * 40, paired_product=product, sync_state='SUCCESS')
+
+        with mock.patch('core.utils.group'):
+            trigger_bulk_sync([self.tags[0].pk], force=True)
+        self.assertIsNone(ESLTag.objects.get(pk=self.tags[0].pk).displayed_image_hash)
+        self.assertEqual(ESLTag.objects.get(pk=self.tags[1].pk).displayed_image_hash, "a" * 40)
+
+
+class DeliveryDaemonTest(DeliveryTestBase):
+    def test_gateways_are_split_across_shards(self):
+        from core.delivery_daemon import DeliveryDaemon, gateway_shard
+        ids = [f"GW{i:02d}" for i in range(40)]
+        owners = [[gw for gw in ids if DeliveryDaemon(shard=s, shards=3).owns(gw)] for s in range(3)]
+        self.assertEqual(sorted(sum(owners, [])), ids)  # Each gateway has exactly one owner
+        self.assertTrue(all(owners))
+        self.assertEqual(gateway_shard("gw01", 3), gateway_shard("GW01", 3))
+
+    def test_daemon_mode_wakes_instead_of_starting_celery_loop(self):
+        from core.tasks import trigger_gateway_processing
+        with override_settings(ESL_DELIVERY_MODE='daemon'), \
+             mock.patch('core.tasks.delivery_queue.notify') as notify, \
+             mock.patch('core.tasks.process_gateway_queue_task.delay') as delay:
+            trigger_gateway_processing("DG01")
+        notify.assert_called_once_with("DG01")
+        delay.assert_not_called()
+
+    def test_gateway_loop_paces_without_blocking(self):
+        import asyncio
+        from core.delivery_daemon import DeliveryDaemon
+
+        daemon = DeliveryDaemon()
+        deliver = mock.Mock(side_effect=[2, 2, 1, None])
+
+        async def scenario():
+            daemon.stopping = asyncio.Event()
+            daemon.wake_events["DG01"] = asyncio.Event()
+
+            async def fake_db(fn, *args, **kwargs):
+                result = fn(*args, **kwargs)
+                if result is None:
+                    daemon.stopping.set()
+                    daemon.wake("DG01")
+                return result
+
+            daemon.db = fake_db
+            await daemon.run_gateway("DG01")
+
+        with mock.patch('core.delivery_daemon.deliver_next_batch', deliver), \
+             mock.patch('core.delivery_daemon.asyncio.sleep', new_callable=mock.AsyncMock) as sleep:
+            asyncio.run(asyncio.wait_for(scenario(), 5))
+
+        self.assertEqual(deliver.call_count, 4)
+        deliver.assert_called_with("DG01", flow_controlled=False)
+        self.assertEqual(sleep.await_count, 3)  # One paced wait per sent message
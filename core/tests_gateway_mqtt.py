@@ -1,7 +1,13 @@
-from django.test import TestCase
+import time
+import msgpack
+import threading
+from unittest import mock
+from django.test import TestCase, TransactionTestCase
 from django.utils import timezone
-from core.models import Gateway, Store, Company
+from core.models import Gateway, Store, Company, ESLTag, MQTTMessage, TagHardware
 from core.mqtt_client import mqtt_service
+from core.ingestion import IngestionPipeline
+from core import protocol
 
 class GatewayMqttTest(TestCase):
     def setUp(self):
@@ -108,3 +114,301 @@ class GatewayMqttTest(TestCase):
         gw.refresh_from_db()
         self.assertEqual(gw.is_online, 'OFFLINE')
         self.assertIn("Offline: No heartbeat received", gw.last_error_message)
+
+
+class PayloadEncodingTest(TestCase):
+    def setUp(self):
+        self.company = Company.objects.create(name="Encoding Company")
+        self.store = Store.objects.create(name="Encoding Store", company=self.company)
+        self.gateway = Gateway.objects.create(estation_id="ENC1", store=self.store, gateway_mac="EN:C1", ap_version="1.0.30.0")
+
+    def test_auto_negotiates_from_firmware_version(self):
+        with self.settings(ESL_PAYLOAD_MIN_AP_VERSION={'BINARY': '', 'GZIP': ''}):
+            self.assertEqual(self.gateway.get_payload_encoding(), 'BASE64')
+        with self.settings(ESL_PAYLOAD_MIN_AP_VERSION={'BINARY': '1.0.29.0', 'GZIP': '1.0.31.0'}):
+            self.assertEqual(self.gateway.get_payload_encoding(), 'BINARY')
+            self.gateway.ap_version = "1.0.31.2"
+            self.assertEqual(self.gateway.get_payload_encoding(), 'GZIP')
+            self.gateway.payload_encoding = 'BASE64'
+            self.assertEqual(self.gateway.get_payload_encoding(), 'BASE64')
+
+    def test_binary_payloads_skip_base64_overhead(self):
+        import gzip
+        import msgpack
+        from unittest import mock
+
+        bmp = b'BM' + bytes(4000)
+        sizes = {}
+        with mock.patch.object(mqtt_service.client, 'is_connected', return_value=True), \
+             mock.patch.object(mqtt_service.client, 'publish') as publish, \
+             mock.patch.object(mqtt_service, '_log_mqtt_message'):
+            publish.return_value.rc = 0
+            for encoding in ('BASE64', 'BINARY', 'GZIP'):
+                self.assertTrue(mqtt_service.publish_tag_update("ENC1", "AA:00:00:00:00:01", bmp, 5, encoding=encoding))
+                payload = publish.call_args[0][1]
+                sizes[encoding] = len(payload)
+                image = msgpack.unpackb(payload, raw=False)[0][10]
+                if encoding == 'GZIP':
+                    self.assertEqual(gzip.decompress(image), bmp)
+                elif encoding == 'BINARY':
+                    self.assertEqual(image, bmp)
+
+        self.assertLess(sizes['BINARY'], sizes['BASE64'])
+        self.assertLess(sizes['GZIP'], sizes['BINARY'])
+
+    def test_batch_log_sanitizes_each_task(self):
+        import json
+
+        # 11 tasks: the batch list itself has the length of one task's parameters
+        tasks = [(f"AA:00:00:00:00:{i:02d}", b'BM' + bytes(400), i) for i in range(11)]
+        with mock.patch.object(mqtt_service.client, 'is_connected', return_value=True), \
+             mock.patch.object(mqtt_service.client, 'publish') as publish:
+            publish.return_value.rc = 0
+            self.assertTrue(mqtt_service.publish_tag_batch("ENC1", tasks))
+
+        logged = json.loads(MQTTMessage.objects.get(direction='sent').data)
+        self.assertEqual([params[0] for params in logged], [f"AA00000000{i:02d}" for i in range(11)])
+        for params in logged:
+            self.assertEqual(params[8:10], ["********", "********"])
+            self.assertTrue(params[10].startswith("<data:"))
+
+
+class IngestionBatchTest(TestCase):
+    def setUp(self):
+        self.company = Company.objects.create(name="Ingest Company")
+        self.store = Store.objects.create(name="Ingest Store", company=self.company)
+        self.gateways = [
+            Gateway.objects.create(estation_id=f"IG0{i}", store=self.store, gateway_mac=f"IG:0{i}", is_online='OFFLINE')
+            for i in range(2)
+        ]
+        hw = TagHardware.objects.create(model_number="I250", width_px=250, height_px=122, color_scheme='BW', display_size_inch=2.13)
+        self.tags = [
+            ESLTag.objects.create(tag_mac=f"EE000000000{i}", store=self.store, gateway=self.gateways[i], hardware_spec=hw)
+            for i in range(2)
+        ]
+        ESLTag.objects.update(sync_state='PUSHED', last_image_task_token=7)
+
+    def _message(self, topic, data):
+        return (topic, msgpack.packb(data, use_bin_type=True), time.monotonic())
+
+    def test_batch_is_handled_with_bulk_queries(self):
+        batch = [
+            self._message("/estation/IG00/heartbeat", ["IG00", 0, "1.0.30.0", "BT", 4, "", 3, 1, []]),
+            self._message("/estation/IG01/heartbeat", ["IG01", 0, "1.0.30.0", "BT", 7, "", 9, 1, []]),
+            self._message("/estation/IG00/result", [self.tags[0].tag_mac, -60, 30, "v1", 1, 7]),
+            self._message("/estation/IG01/result", [self.tags[1].tag_mac, -60, 30, "v1", 1, 7]),
+            self._message("/estation/IG01/bogus", b"not msgpack"),
+        ]
+
+        with mock.patch('core.tasks.on_gateway_reconnected') as reconnected, \
+             mock.patch('core.mqtt_client.random.random', return_value=0.0):
+            mqtt_service.process_messages(batch)
+
+        self.assertEqual(reconnected.call_count, 2)
+        self.assertEqual(dict(Gateway.objects.values_list('estation_id', 'is_online')), {"IG00": 'ONLINE', "IG01": 'ERROR'})
+        self.assertEqual(Gateway.objects.get(estation_id="IG01").tags_queued_count, 9)
+        self.assertEqual(set(ESLTag.objects.values_list('sync_state', flat=True)), {'SUCCESS'})
+        self.assertEqual(MQTTMessage.objects.count(), 5)
+
+    def test_result_lookup_does_not_grow_with_batch(self):
+        def run(batch):
+            with mock.patch('core.mqtt_client.random.random', return_value=1.0):
+                mqtt_service.process_messages(batch)
+
+        # Failed results: audit insert, gateways, tags, telemetry, retry policy, flow control
+        single = [self._message("/estation/IG00/result", [self.tags[0].tag_mac, -60, 30, "v1", 2, 7])]
+        with self.assertNumQueries(10) as one:
+            run(single)
+        ESLTag.objects.update(sync_state='PUSHED')
+        batch = [
+            self._message("/estation/IG00/result", [tag.tag_mac, -60, 30, "v1", 2, 7])
+            for tag in self.tags
+        ]
+        with self.assertNumQueries(len(one.captured_queries)):
+            run(batch)
+        self.assertEqual(set(ESLTag.objects.values_list('sync_state', flat=True)), {'RETRY_WAITING'})
+
+
+class IngestionPipelineTest(TransactionTestCase):
+    def test_messages_are_batched_per_worker(self):
+        batches = []
+        done = threading.Event()
+
+        def handler(batch):
+            batches.append([topic for topic, _, _ in batch])
+            if sum(len(b) for b in batches) >= 4:
+                done.set()
+
+        pipeline = IngestionPipeline(handler, workers=2, max_queue=100, window_ms=200, max_batch=10)
+        for i in range(4):
+            self.assertTrue(pipeline.submit("/estation/GW01/result", b"x"))
+        pipeline.start()
+        try:
+            self.assertTrue(done.wait(5))
+        finally:
+            pipeline.stop()
+
+        # One gateway: one worker, one batch, order kept
+        self.assertEqual(batches, [["/estation/GW01/result"] * 4])
+        metrics = pipeline.metrics()
+        self.assertEqual((metrics['processed'], metrics['dropped'], metrics['queue_depth']), (4, 0, 0))
+
+    def test_full_queue_drops_instead_of_blocking(self):
+        pipeline = IngestionPipeline(lambda batch: None, workers=1, max_queue=2)
+        results = [pipeline.submit("/estation/GW01/heartbeat", b"x") for _ in range(3)]
+        self.assertEqual(results, [True, True, False])
+        self.assertEqual(pipeline.metrics()['dropped'], 1)
+        self.assertEqual(pipeline.metrics()['queue_depth'], 2)
+
+
+class GatewayTelemetryTest(TestCase):
+    def setUp(self):
+        self.company = Company.objects.create(name="Telemetry Company")
+        self.store = Store.objects.create(name="Telemetry Store", company=self.company)
+        self.gateway = Gateway.objects.create(estation_id="TG01", store=self.store, gateway_mac="TG:01")
+        self.old = timezone.now() - timezone.timedelta(minutes=10)
+
+    def _heartbeat(self, code=4, queued=0):
+        mqtt_service.handle_heartbeat("TG01", ["TG01", 0, "1.0.30.0", "BT", code, "", queued, 0, []])
+
+    def test_steady_heartbeats_are_written_behind(self):
+        from core import gateway_telemetry
+        self._heartbeat()  # First heartbeat: written through
+        Gateway.objects.filter(pk=self.gateway.pk).update(last_heartbeat=self.old)
+
+        with self.assertNumQueries(0):
+            self._heartbeat(queued=12)
+        row = Gateway.objects.get(pk=self.gateway.pk)
+        self.assertEqual((row.last_heartbeat, row.tags_queued_count), (self.old, 0))
+
+        # Readers that load the live values see them before the flush
+        gateway_telemetry.apply([row])
+        self.assertEqual(row.get_real_time_status()[0], 'ONLINE')
+        self.assertEqual(row.tags_queued_count, 12)
+
+        self.assertEqual(gateway_telemetry.flush(), 1)
+        row = Gateway.objects.get(pk=self.gateway.pk)
+        self.assertGreater(row.last_heartbeat, self.old)
+        self.assertEqual(row.tags_queued_count, 12)
+
+    def test_state_changes_are_written_through(self):
+        self._heartbeat()
+        self._heartbeat(code=7)
+        row = Gateway.objects.get(pk=self.gateway.pk)
+        self.assertEqual((row.is_online, row.last_error_code), ('ERROR', 7))
+
+    def test_offline_gateway_reconnects_through_database(self):
+        from core.tasks import check_gateways_status_task
+        self._heartbeat()
+        Gateway.objects.filter(pk=self.gateway.pk).update(last_heartbeat=self.old)
+        with mock.patch('core.gateway_telemetry.flush'):  # Buffered heartbeat lost
+            check_gateways_status_task()
+        self.assertEqual(Gateway.objects.get(pk=self.gateway.pk).is_online, 'OFFLINE')
+
+        with mock.patch('core.tasks.on_gateway_reconnected') as reconnected:
+            self._heartbeat()
+        reconnected.assert_called_once_with(self.store.pk)
+
+
+class HardwareRegistryTest(TestCase):
+    def setUp(self):
+        from core.hardware_registry import HardwareRegistry
+        self.company = Company.objects.create(name="Registry Company")
+        self.store = Store.objects.create(name="Registry Store", company=self.company)
+        self.gateway = Gateway.objects.create(estation_id="RG01", store=self.store, gateway_mac="RG:01")
+        hw = TagHardware.objects.create(model_number="R250", width_px=250, height_px=122, color_scheme='BW', display_size_inch=2.13)
+        self.tags = [
+            ESLTag.objects.create(tag_mac=f"DD000000000{i}", store=self.store, gateway=self.gateway, hardware_spec=hw)
+            for i in range(2)
+        ]
+        ESLTag.objects.update(sync_state='PUSHED', last_image_task_token=7, pushed_image_hash='abc')
+        self.registry = HardwareRegistry()
+
+    def _results(self, token=7):
+        with mock.patch.object(mqtt_service, 'registry', self.registry):
+            mqtt_service.handle_results([
+                ("RG01", protocol.decode_result([tag.tag_mac, -60, 30, "v1", 1, token])) for tag in self.tags
+            ])
+
+    def test_results_are_verified_without_reads(self):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        self.registry.tag_lookup([self.store.pk])
+        self.registry.gateways_by_id(["RG01"])
+
+        with CaptureQueriesContext(connection) as ctx:
+            self._results()
+        tables = [q['sql'] for q in ctx.captured_queries if 'core_esltag' in q['sql'] or 'core_gateway' in q['sql']]
+        self.assertEqual(len(tables), 1)
+        self.assertTrue(tables[0].startswith('UPDATE'))
+        self.assertEqual(
+            set(ESLTag.objects.values_list('sync_state', 'displayed_image_hash', 'battery_level')),
+            {('SUCCESS', 'abc', 100)}
+        )
+
+    def test_announcements_keep_tokens_current(self):
+        self.registry.tag_lookup([self.store.pk])
+        # Re-rendered: the token of the previous push no longer confirms anything
+        self.registry.apply({'drop': [self.tags[0].pk]})
+        # Pushed with a new token (retry bits set)
+        self.registry.apply({'tags': [[self.store.pk, self.tags[1].tag_mac, self.tags[1].pk, (1 << 14) | 9, 1]]})
+
+        self._results(token=9)
+        self.assertEqual(
+            dict(ESLTag.objects.values_list('tag_mac', 'sync_state')),
+            {self.tags[0].tag_mac: 'PUSHED', self.tags[1].tag_mac: 'SUCCESS'}
+        )
+
+    def test_result_before_announcement_is_confirmed(self):
+        self.registry.tag_lookup([self.store.pk])
+        # Pushed with a new token and a new tag paired, but neither announcement has arrived yet
+        ESLTag.objects.filter(pk=self.tags[0].pk).update(last_image_task_token=9)
+        self.tags.append(ESLTag.objects.create(
+            tag_mac="DD0000000009", store=self.store, gateway=self.gateway, hardware_spec=self.tags[0].hardware_spec
+        ))
+        ESLTag.objects.filter(pk=self.tags[2].pk).update(sync_state='PUSHED', last_image_task_token=9)
+
+        with mock.patch.object(mqtt_service, 'registry', self.registry):
+            mqtt_service.handle_results([
+                ("RG01", protocol.decode_result([tag.tag_mac, -60, 30, "v1", 1, 9])) for tag in self.tags
+            ])
+        self.assertEqual(
+            dict(ESLTag.objects.values_list('tag_mac', 'sync_state')),
+            {self.tags[0].tag_mac: 'SUCCESS', self.tags[1].tag_mac: 'PUSHED', self.tags[2].tag_mac: 'SUCCESS'}
+        )
+        self.assertEqual(self.registry.tag_lookup([self.store.pk])(self.store.pk, self.tags[0].tag_mac).token, 9)
+
+
+class ProtocolTest(TestCase):
+    def test_decoders_build_structs(self):
+        packet = protocol.decode("/estation/PG01/heartbeat", msgpack.packb(
+            ["PG01", 0, "1.0.30.0", "BT", 7, "", 3, 1, [["AA0000000001", -50, 28, "v1"]]]
+        ))
+        heartbeat = packet.message
+        self.assertEqual((packet.kind, packet.estation_id, heartbeat.msg_code, heartbeat.queued), ('heartbeat', "PG01", 7, 3))
+        self.assertTrue(heartbeat.is_error)
+        self.assertEqual([(t.mac, t.battery) for t in heartbeat.tags], [("AA0000000001", 28)])
+
+        result = protocol.decode_result([13, 0, 2, 8, [["AA0000000001", -69, 30, "v1", 1, 100], ["AA0000000002", -60, 29, "v1", 2, 101]]])
+        self.assertEqual((result.message_code, [t.token for t in result.tags]), (8, [100, 101]))
+        self.assertFalse(result.all_succeeded)
+
+    def test_json_fallback_only_for_known_kinds(self):
+        payload = b'{"TagId": "AA0000000001", "Battery": 30, "Status": 1, "Token": 5}'
+        self.assertEqual(protocol.decode("/estation/PG01/result", payload).message.tags[0].token, 5)
+        with self.assertRaises(ValueError):
+            protocol.decode("/estation/PG01/message", payload)
+
+    def test_each_packet_is_decoded_once(self):
+        company = Company.objects.create(name="Protocol Company")
+        Gateway.objects.create(estation_id="PG01", store=Store.objects.create(name="Protocol Store", company=company), gateway_mac="PG:01")
+        batch = [
+            ("/estation/PG01/result", msgpack.packb([f"AA000000000{i}", -60, 30, "v1", 1, 7]), time.monotonic())
+            for i in range(3)
+        ]
+        decode_result = mock.Mock(wraps=protocol.decode_result)
+        with mock.patch('core.protocol.msgpack.unpackb', wraps=msgpack.unpackb) as unpack, \
+             mock.patch.dict(protocol.DECODERS, {'result': decode_result}):
+            mqtt_service.process_messages(batch)
+        self.assertEqual((unpack.call_count, decode_result.call_count), (3, 3))
+        self.assertEqual(MQTTMessage.objects.filter(is_success=True).count(), 3)
@@ -160,6 +160,53 @@ class MultiTagResultTest(TestCase):
         # Battery should still be 75
         self.assertEqual(self.tag1.battery_level, 75)
 
+    def test_repeated_tag_list_writes_nothing(self):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+
+        tags_list = [["840000C3281C", -50, 28, "v1"], ["390000F41F5F", -50, 30, "v1"]]
+        mqtt_service._process_tags("GW01", tags_list)
+        self.tag1.refresh_from_db()
+        self.assertEqual(self.tag1.battery_level, 75)
+        self.assertEqual(self.tag1.last_successful_gateway_id, "GW01")
+
+        # Same gateway, same battery buckets: no UPDATE of the tag rows
+        with CaptureQueriesContext(connection) as ctx:
+            mqtt_service._process_tags("GW01", tags_list)
+        self.assertFalse([q for q in ctx.captured_queries if q['sql'].startswith('UPDATE')])
+
+    def test_battery_history_keeps_daily_range(self):
+        from core.models import TagBatteryDaily
+
+        for battery in (28, 30, 25, 27):
+            mqtt_service._process_tags("GW01", [["840000C3281C", -50, battery, "v1"]])
+
+        day = TagBatteryDaily.objects.get(tag=self.tag1)
+        self.assertEqual(day.day, timezone.localdate())
+        self.assertEqual((day.min_level, day.max_level), (37, 100))
+        self.assertEqual(TagBatteryDaily.objects.count(), 1)
+
+    def test_battery_history_race_keeps_stored_range(self):
+        from unittest import mock
+        from django.core.cache import cache
+        from core import battery_history
+        from core.models import TagBatteryDaily
+
+        day = timezone.localdate()
+        create = TagBatteryDaily.objects.bulk_create
+
+        def other_worker_first(rows, **kwargs):
+            # Another worker inserts the day's row between our read and our INSERT
+            TagBatteryDaily.objects.create(tag=self.tag1, day=day, min_level=10, max_level=90)
+            return create(rows, **kwargs)
+
+        with mock.patch.object(TagBatteryDaily.objects, 'bulk_create', side_effect=other_worker_first):
+            battery_history.record_samples({self.tag1.pk: 95}, day=day)
+
+        row = TagBatteryDaily.objects.get(tag=self.tag1)
+        self.assertEqual((row.min_level, row.max_level), (10, 95))
+        self.assertEqual(tuple(cache.get(battery_history._range_key(day, self.tag1.pk))), (10, 95))
+
     def test_admin_ui_helpers(self):
         from core.admin.monitoring import MQTTMessageAdmin
         from core.admin.base import admin_site
@@ -5,10 +5,11 @@ from django.contrib.auth.models import Permission
 from core.models import Company, Store, Product
 import openpyxl
 from io import BytesIO
+from core.testing import TempMediaMixin
 
 User = get_user_model()
 
-class ProductImportSecurityTest(TestCase):
+class ProductImportSecurityTest(TempMediaMixin, TestCase):
     """
     Security tests for the Product Import functionality.
     Ensures that granular RBAC (Add vs Change) is enforced during bulk imports.
@@ -0,0 +1,376 @@
+import time
+import io
+from unittest import mock
+from PIL import Image, ImageDraw
+from django.test import TestCase
+from django.core.cache import cache
+from django.utils import timezone
+from core.models import Company, Store, Gateway, ESLTag, TagHardware, Product, Supplier
+from core import utils
+from core.testing import TempMediaMixin
+
+
+class RenderCacheTest(TempMediaMixin, TestCase):
+    def setUp(self):
+        cache.clear()
+        self.company = Company.objects.create(name="Render Co")
+        self.store = Store.objects.create(name="Render Store", company=self.company)
+        self.gateway = Gateway.objects.create(
+            estation_id="RG01", store=self.store, gateway_mac="RG:01", is_online='ONLINE', last_heartbeat=timezone.now()
+        )
+        self.hw = TagHardware.objects.create(model_number="R296", width_px=296, height_px=128, color_scheme='BWR', display_size_inch=2.9)
+        self.supplier = Supplier.objects.create(name="Render Supplier", abbreviation="RSP")
+        self.product = Product.objects.create(sku="123456", name="Render Product", price="4.99", store=self.store, preferred_supplier=self.supplier)
+        with mock.patch('core.tasks.update_tag_image_task.delay'):
+            self.tag = ESLTag.objects.create(
+                tag_mac="AA0000000001", store=self.store, gateway=self.gateway,
+                hardware_spec=self.hw, paired_product=self.product
+            )
+
+    def _load_tag(self):
+        return ESLTag.objects.select_related('hardware_spec', 'paired_product__preferred_supplier').get(pk=self.tag.pk)
+
+    def test_render_hash_is_stable_and_content_sensitive(self):
+        first = utils.get_render_hash(self._load_tag())
+        self.assertEqual(first, utils.get_render_hash(self._load_tag()))
+
+        Product.objects.filter(pk=self.product.pk).update(price="5.49")
+        self.assertNotEqual(first, utils.get_render_hash(self._load_tag()))
+
+    def test_cache_hit_skips_pillow(self):
+        bmp, render_hash, hit = utils.render_tag_bmp(self._load_tag())
+        self.assertFalse(hit)
+        self.assertTrue(bmp.startswith(b'BM'))
+
+        with mock.patch('core.utils._render_esl_image') as render:
+            bmp_again, hash_again, hit_again = utils.render_tag_bmp(self._load_tag())
+            render.assert_not_called()
+        self.assertTrue(hit_again)
+        self.assertEqual(hash_again, render_hash)
+        self.assertEqual(bmp_again, bmp)
+
+    def test_failed_render_is_not_cached(self):
+        with mock.patch('core.utils._render_esl_image', side_effect=ValueError("boom")):
+            bmp, render_hash, hit = utils.render_tag_bmp(self._load_tag())
+        self.assertIsNone(render_hash)
+        self.assertFalse(hit)
+        self.assertIsNone(cache.get(f"esl_render_{utils.get_render_hash(self._load_tag())}"))
+
+    def test_task_records_render_hash(self):
+        from core.tasks import update_tag_image_task
+        with mock.patch('core.tasks.dispatch_tag_image_task.delay'), mock.patch('core.tasks.time.sleep'):
+            update_tag_image_task.apply(args=[self.tag.pk])
+
+        tag = self._load_tag()
+        self.assertEqual(tag.sync_state, 'IMAGE_READY')
+        self.assertEqual(tag.render_hash, utils.get_render_hash(tag))
+        self.assertTrue(tag.tag_image)
+
+
+class BatchRenderTest(TempMediaMixin, TestCase):
+    def setUp(self):
+        cache.clear()
+        self.company = Company.objects.create(name="Batch Co")
+        self.store = Store.objects.create(name="Batch Store", company=self.company)
+        Gateway.objects.create(estation_id="BG01", store=self.store, gateway_mac="BG:01", is_online='ONLINE', last_heartbeat=timezone.now())
+        self.hw = TagHardware.objects.create(model_number="B250", width_px=250, height_px=122, color_scheme='BW', display_size_inch=2.13)
+        self.product_a = Product.objects.create(sku="111", name="Facing Product", price="1.99", store=self.store)
+        self.product_b = Product.objects.create(sku="222", name="Other Product", price="2.99", store=self.store)
+        with mock.patch('core.tasks.update_tag_image_task.delay'):
+            self.facings = [
+                ESLTag.objects.create(tag_mac=f"BB000000000{i}", store=self.store, hardware_spec=self.hw, paired_product=self.product_a)
+                for i in range(3)
+            ]
+            self.other = ESLTag.objects.create(tag_mac="BB0000000009", store=self.store, hardware_spec=self.hw, paired_product=self.product_b)
+
+    def test_groups_render_once_and_fan_out(self):
+        from core.tasks import render_tag_batch_task
+        tag_ids = [t.pk for t in self.facings] + [self.other.pk]
+
+        with mock.patch('core.tasks.render_tag_bmp', wraps=utils.render_tag_bmp) as render, \
+             mock.patch('core.tasks.dispatch_tag_image_task.delay') as dispatch:
+            render_tag_batch_task.apply(args=[tag_ids])
+
+        self.assertEqual(render.call_count, 2)
+        self.assertEqual(dispatch.call_count, 4)
+
+        tags = ESLTag.objects.filter(pk__in=tag_ids)
+        self.assertTrue(all(t.sync_state == 'IMAGE_READY' and t.tag_image for t in tags))
+        self.assertEqual(len({t.render_hash for t in tags if t.paired_product_id == self.product_a.pk}), 1)
+        self.assertEqual(len({t.tag_image.name for t in tags}), 4)
+
+    def test_skips_tags_already_in_pipeline(self):
+        from core.tasks import render_tag_batch_task
+        ESLTag.objects.filter(pk=self.other.pk).update(sync_state='IMAGE_READY')
+
+        with mock.patch('core.tasks.dispatch_tag_image_task.delay') as dispatch:
+            render_tag_batch_task.apply(args=[[self.other.pk]])
+
+        dispatch.assert_not_called()
+
+
+class FontMetricsTest(TestCase):
+    def test_metrics_match_freetype_layout(self):
+        for font_type in ("bold", "condensed"):
+            for size in (9, 14, 26, 55):
+                font = utils.get_font_by_type(size, font_type)
+                for text in ("$124", "50", "SALE!", "AV TOWER", "Ay", "123456789000", "GSC:WATER 12.5OZ"):
+                    self.assertEqual(
+                        utils.LayoutEngine.get_text_bbox(text, font),
+                        utils._MEASURE_DRAW.textbbox((0, 0), text, font=font),
+                        f"{font_type} {size}px {text!r}"
+                    )
+
+    def test_dynamic_font_needs_no_freetype_layout(self):
+        utils.LayoutEngine.get_dynamic_font("$12", 100, 60, 70)
+        with mock.patch.object(utils._MEASURE_DRAW, 'textbbox') as textbbox:
+            font = utils.LayoutEngine.get_dynamic_font("$12", 100, 60, 70)
+            utils.LayoutEngine.get_dynamic_multiline_font(["RENDER", "PRODUCT"], 120, 70, 30, "condensed")
+            textbbox.assert_not_called()
+
+        w, h = utils.LayoutEngine.get_text_size("$12", font)
+        self.assertTrue(w <= 100 and h <= 60)
+        bigger = utils.get_font_by_type(font.size + 1, "bold")
+        w, h = utils.LayoutEngine.get_text_size("$12", bigger)
+        self.assertFalse(w <= 100 and h <= 60)
+
+
+class BarcodeRasterizerTest(TestCase):
+    def test_bars_are_whole_pixels_and_memoized(self):
+        utils.render_sharp_barcode.cache_clear()
+        img = utils.render_sharp_barcode("123456789000", 160, 30, quiet_zone_px=10)
+        self.assertEqual(img.mode, 'RGBA')
+        self.assertEqual(img.height, 30)
+
+        # Quiet zone is white and every row is identical (pure black/white bars)
+        self.assertEqual(img.getpixel((0, 0)), (255, 255, 255, 255))
+        top = img.crop((0, 0, img.width, 1)).tobytes()
+        self.assertEqual(top, img.crop((0, 29, img.width, 30)).tobytes())
+        self.assertEqual({color for _, color in img.getcolors()}, {(0, 0, 0, 255), (255, 255, 255, 255)})
+
+        self.assertIs(img, utils.render_sharp_barcode("123456789000", 160, 30, quiet_zone_px=10))
+        self.assertEqual(utils.render_sharp_barcode.cache_info().hits, 1)
+
+
+class PaletteOutputTest(TestCase):
+    def _render(self, color_scheme):
+        image = Image.new('RGB', (296, 128), (255, 255, 255))
+        product = mock.Mock(name="product", sku="123456", price="12.99", is_on_special=True, preferred_supplier=None)
+        product.name = "PALETTE PRODUCT"
+        utils.template_v1(image, ImageDraw.Draw(image), product, 296, 128, color_scheme)
+        return image
+
+    def test_bw_labels_are_one_bit(self):
+        bmp = utils.encode_bmp(utils.quantize_for_display(self._render('BW'), 'BW'))
+        decoded = Image.open(io.BytesIO(bmp))
+        self.assertEqual(decoded.mode, '1')
+        self.assertLess(len(bmp), 6000)
+
+    def test_color_labels_are_four_bit_palette(self):
+        for scheme, inks in (('BWR', 3), ('BWRY', 4)):
+            quantized = utils.quantize_for_display(self._render(scheme), scheme)
+            bmp = utils.encode_bmp(quantized)
+            decoded = Image.open(io.BytesIO(bmp))
+
+            self.assertEqual(bmp[28], 4)  # biBitCount
+            self.assertEqual(decoded.mode, 'P')
+            self.assertLessEqual(len(decoded.getcolors()), inks)
+            self.assertEqual(decoded.convert('RGB').tobytes(), quantized.convert('RGB').tobytes())
+            self.assertLess(len(bmp), 20000)
+
+
+class BaseLayerTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        utils._get_base_layer.cache_clear()
+        self.product = mock.Mock(sku="123456", price="12.99", is_on_special=True, preferred_supplier=None)
+        self.product.name = "LAYERED PRODUCT"
+
+    def _composite(self, template_id, price):
+        content = utils.get_label_content(self.product)._replace(price=price)
+        image = utils.get_base_layer(template_id, content, 296, 128, 'BWR').copy()
+        utils.get_template_layers(template_id)[1](image, ImageDraw.Draw(image), content, utils.compile_layout(296, 128, 'BWR', template_id))
+        return image
+
+    def test_composite_matches_full_render(self):
+        for template_id, template in ((1, utils.template_v1), (2, utils.template_v2), (3, utils.template_v3)):
+            full = Image.new('RGB', (296, 128), (255, 255, 255))
+            template(full, ImageDraw.Draw(full), self.product, 296, 128, 'BWR')
+            self.assertEqual(self._composite(template_id, "12.99").tobytes(), full.tobytes())
+
+    def test_price_change_reuses_base_layer(self):
+        self._composite(1, "12.99")
+        base_fn = mock.Mock()
+        with mock.patch.dict(utils.TEMPLATE_LAYERS, {1: (base_fn, utils._v1_price)}):
+            self._composite(1, "13.49")
+            self.assertEqual(utils._get_base_layer.cache_info().hits, 1)
+
+            # Another worker process reuses the shared copy
+            utils._get_base_layer.cache_clear()
+            self._composite(1, "14.99")
+        base_fn.assert_not_called()
+
+
+class RenderAssetRegistryTest(TestCase):
+    def test_warm_registry_renders_without_disk_access(self):
+        from core.render_assets import assets
+        assets.warm()
+        self.assertTrue(assets.warmed)
+
+        product = mock.Mock(sku="123456", price="3.99", is_on_special=True, preferred_supplier=None)
+        product.name = "PROMO PRODUCT"
+        with mock.patch('core.render_assets.Image.open') as image_open, \
+             mock.patch('core.render_assets.os.path.exists') as exists:
+            for template in (utils.template_v1, utils.template_v3):
+                for scheme in ('BW', 'BWR'):
+                    image = Image.new('RGB', (296, 128), (255, 255, 255))
+                    template(image, ImageDraw.Draw(image), product, 296, 128, scheme)
+            image_open.assert_not_called()
+            exists.assert_not_called()
+
+    def test_scaled_icons_are_shared(self):
+        from core.render_assets import assets
+        icon, sale_w = assets.sale_banner('red', 38)
+        self.assertIs(icon, assets.sale_banner('red', 38)[0])
+        self.assertGreater(sale_w, 0)
+
+
+class LayoutCompilerTest(TestCase):
+    def test_plans_are_cached_and_immutable(self):
+        from core.layouts import compile_layout, V1Layout, V3Layout
+        plan = compile_layout(296, 128, 'BWR', 1)
+        self.assertIs(plan, compile_layout(296, 128, 'BWR', 1))
+        self.assertIsInstance(plan, V1Layout)
+        self.assertEqual(plan.split_x, int(296 * 0.62))
+        with self.assertRaises(AttributeError):
+            plan.split_x = 0
+
+        self.assertIsInstance(compile_layout(296, 128, 'BWR', 3), V3Layout)
+        self.assertIsInstance(compile_layout(296, 128, 'BWR', 99), V1Layout)
+
+    def test_promo_colours_follow_color_scheme(self):
+        from core.layouts import compile_layout, BLACK, WHITE, RED
+        bw = compile_layout(250, 122, 'BW', 1)
+        self.assertEqual((bw.price_bg[False], bw.price_bg[True]), (WHITE, BLACK))
+        self.assertEqual(bw.promo_icon[True], "white")
+        self.assertEqual(compile_layout(250, 122, 'bwr', 1).price_bg[False], RED)
+
+
+class RenderFarmTest(TempMediaMixin, TestCase):
+    def setUp(self):
+        cache.clear()
+        self.company = Company.objects.create(name="Farm Co")
+        self.store = Store.objects.create(name="Farm Store", company=self.company)
+        self.gateway = Gateway.objects.create(
+            estation_id="FG01", store=self.store, gateway_mac="FG:01", is_online='ONLINE',
+            last_heartbeat=timezone.now()
+        )
+        self.hw = TagHardware.objects.create(model_number="F250", width_px=250, height_px=122, color_scheme='BW', display_size_inch=2.13)
+        product_a = Product.objects.create(sku="311", name="Farm Product", price="1.99", store=self.store)
+        product_b = Product.objects.create(sku="322", name="Other Farm Product", price="2.49", store=self.store)
+        with mock.patch('core.tasks.update_tag_image_task.delay'):
+            self.tags = [
+                ESLTag.objects.create(tag_mac=f"FF000000000{i}", store=self.store, hardware_spec=self.hw,
+                                      paired_product=product_a if i < 3 else product_b)
+                for i in range(4)
+            ]
+
+    def test_store_renders_in_bulk_on_process_pool(self):
+        from core.render_farm import render_store
+        with mock.patch('core.tasks.trigger_gateway_processing') as trigger:
+            summary = render_store(self.store.pk, workers=2, chunk_size=3)
+
+        self.assertEqual(summary['tags'], 4)
+        self.assertEqual(summary['renders'], 2)
+        trigger.assert_called_with("FG01")
+
+        for tag in ESLTag.objects.filter(store=self.store).select_related('hardware_spec', 'paired_product__preferred_supplier'):
+            self.assertEqual(tag.sync_state, 'IMAGE_READY')
+            self.assertEqual(tag.gateway_id, self.gateway.pk)
+            self.assertEqual(tag.render_hash, utils.get_render_hash(tag))
+            with tag.tag_image.open('rb') as f:
+                self.assertEqual(f.read(), utils.render_tag_bmp(tag)[0])
+
+    def test_second_run_reuses_render_cache(self):
+        from core.render_farm import render_store
+        with mock.patch('core.tasks.trigger_gateway_processing'):
+            render_store(self.store.pk, workers=1)
+            ESLTag.objects.filter(store=self.store).update(sync_state='SUCCESS')
+            summary = render_store(self.store.pk, workers=1)
+        self.assertEqual((summary['renders'], summary['cache_hits']), (0, 2))
+
+    def test_refresh_in_daemonic_worker_renders_on_pool(self):
+        import os
+        import multiprocessing
+        from core.models import GlobalSetting
+        from core.tasks import refresh_store_products_task, render_store_task
+
+        # Celery prefork children are daemonic; the farm must still get its own processes
+        process = multiprocessing.current_process()
+        process.daemon = True
+        self.addCleanup(setattr, process, 'daemon', False)
+        GlobalSetting.objects.update_or_create(key='RENDER_FARM_MIN_TAGS', defaults={'value': '4'})
+        ESLTag.objects.filter(store=self.store).update(gateway=self.gateway)
+
+        # Each image records the process that rendered it
+        with mock.patch('core.render_farm.encode_bmp', side_effect=lambda image: f"pid:{os.getpid()}".encode()), \
+             mock.patch.object(render_store_task, 'delay', side_effect=lambda *args: render_store_task.apply(args=args, kwargs={'workers': 2})), \
+             mock.patch('core.tasks.trigger_gateway_processing') as trigger:
+            refresh_store_products_task(self.store.pk)
+
+        trigger.assert_called_with("FG01")
+        pids = set()
+        for tag in ESLTag.objects.filter(store=self.store):
+            self.assertEqual(tag.sync_state, 'IMAGE_READY')
+            with tag.tag_image.open('rb') as f:
+                pids.add(int(f.read().split(b':')[1]))
+        self.assertNotIn(os.getpid(), pids)
+
+
+class CoalescingTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.company = Company.objects.create(name="Coalesce Co")
+        self.store = Store.objects.create(name="Coalesce Store", company=self.company, coalesce_window_seconds=30)
+        self.hw = TagHardware.objects.create(model_number="C250", width_px=250, height_px=122, color_scheme='BW', display_size_inch=2.13)
+        self.product = Product.objects.create(sku="333", name="Edited Product", price="1.00", store=self.store)
+        with mock.patch('core.coalesce.mark_dirty'):
+            self.tags = [
+                ESLTag.objects.create(tag_mac=f"CC000000000{i}", store=self.store, hardware_spec=self.hw, paired_product=self.product)
+                for i in range(2)
+            ]
+
+    def test_rapid_edits_render_once_after_window(self):
+        from core import coalesce
+        with mock.patch('core.utils.trigger_bulk_sync') as sync, \
+             mock.patch('core.tasks.flush_coalesced_edits_task.apply_async') as schedule:
+            for price in ("1.10", "1.20", "1.30"):
+                with self.captureOnCommitCallbacks(execute=True):
+                    self.product.price = price
+                    self.product.save()
+
+            sync.assert_not_called()
+            schedule.assert_called_once_with(countdown=30)
+            self.assertEqual(coalesce.flush_due(), 0)  # Window still open
+
+            with mock.patch('core.coalesce.time.time', return_value=time.time() + 31):
+                self.assertEqual(coalesce.flush_due(), 2)
+                self.assertEqual(coalesce.flush_due(), 0)
+
+        sync.assert_called_once()
+        self.assertEqual(sorted(sync.call_args.args[0]), sorted(t.pk for t in self.tags))
+
+    def test_flush_drains_more_than_one_batch(self):
+        from core import coalesce, delivery_queue
+        delivery_queue.get_redis().zadd(coalesce.dirty_key(self.store.pk), {str(i): 0 for i in range(5)})
+        with mock.patch('core.utils.trigger_bulk_sync') as sync, mock.patch.object(coalesce, 'FLUSH_BATCH', 2):
+            self.assertEqual(coalesce.flush_store(self.store.pk), 5)
+        self.assertEqual(sorted(i for call in sync.call_args_list for i in call.args[0]), list(range(5)))
+        self.assertEqual(delivery_queue.get_redis().zcard(coalesce.dirty_key(self.store.pk)), 0)
+
+    def test_zero_window_renders_immediately(self):
+        Store.objects.filter(pk=self.store.pk).update(coalesce_window_seconds=0)
+        with mock.patch('core.utils.trigger_bulk_sync') as sync, self.captureOnCommitCallbacks(execute=True):
+            self.product.price = "2.00"
+            self.product.save()
+        sync.assert_called_once()
@@ -0,0 +1,137 @@
+from unittest import mock
+from django.test import TestCase
+from django.core.cache import cache
+from django.utils import timezone
+from core.models import Company, Store, Gateway, ESLTag, TagHardware, MQTTMessage, Product
+from core.retries import process_tag_failures, sweep_due_retries, reschedule_retries, cancel_retries, RETRY_DELAYS
+
+
+class RetryTestBase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.company = Company.objects.create(name="Retry Co")
+        self.store = Store.objects.create(name="Retry Store", company=self.company)
+        self.gateway = Gateway.objects.create(
+            estation_id="RG01", store=self.store, gateway_mac="RG:01", is_online='ONLINE',
+            last_heartbeat=timezone.now()
+        )
+        self.hw = TagHardware.objects.create(model_number="R250", width_px=250, height_px=122, color_scheme='BW', display_size_inch=2.13)
+        with mock.patch('core.tasks.update_tag_image_task.delay'):
+            self.tags = [
+                ESLTag.objects.create(tag_mac=f"RR000000000{i}", store=self.store, gateway=self.gateway, hardware_spec=self.hw)
+                for i in range(5)
+            ]
+        for tag, retries in zip(self.tags, [0, 0, 1, 2, 3]):
+            ESLTag.objects.filter(pk=tag.pk).update(sync_state='PUSHED', retry_count=retries)
+
+
+class BulkFailureTest(RetryTestBase):
+    def test_bulk_transitions_with_due_times(self):
+        before = timezone.now()
+        with self.assertNumQueries(5):  # Savepoint, lock+read, update, audit insert, release
+            retried, failed = process_tag_failures([(t.pk, "Timeout") for t in self.tags])
+
+        self.assertEqual((retried, failed), (4, 1))
+        rows = {pk: rest for pk, *rest in ESLTag.objects.values_list('pk', 'sync_state', 'retry_count', 'retry_due_at')}
+        self.assertEqual([rows[t.pk][0] for t in self.tags], ['RETRY_WAITING'] * 4 + ['PUSH_FAILED'])
+        self.assertEqual([rows[t.pk][1] for t in self.tags], [1, 1, 2, 3, 3])
+
+        # Backoff per attempt, no due time once retries are exhausted
+        delays = [round((rows[t.pk][2] - before).total_seconds() / 60) if rows[t.pk][2] else None for t in self.tags]
+        self.assertEqual(delays, [d // 60 for d in (RETRY_DELAYS[0], RETRY_DELAYS[0], RETRY_DELAYS[1], RETRY_DELAYS[2])] + [None])
+        self.assertEqual(MQTTMessage.objects.filter(topic="/estation/RG01/timeout").count(), 5)
+
+    def test_duplicate_reports_are_ignored(self):
+        process_tag_failures([(self.tags[0].pk, "A"), (self.tags[0].pk, "B")])
+        process_tag_failures([(self.tags[0].pk, "C")])
+        self.assertEqual(ESLTag.objects.get(pk=self.tags[0].pk).retry_count, 1)
+
+    def test_sweep_starts_only_due_retries(self):
+        process_tag_failures([(t.pk, "Timeout") for t in self.tags[:3]])
+        reschedule_retries([self.tags[0].pk, self.tags[1].pk], timezone.now())
+        # Refreshed manually in the meantime: no longer waiting
+        ESLTag.objects.filter(pk=self.tags[1].pk).update(sync_state='IMAGE_READY')
+
+        with mock.patch('core.utils.trigger_bulk_sync') as bulk_sync:
+            self.assertEqual(sweep_due_retries(), 1)
+            self.assertEqual(sweep_due_retries(), 0)  # Claimed: not started twice
+        bulk_sync.assert_called_once_with([self.tags[0].pk], is_retry=True)
+        self.assertIsNone(ESLTag.objects.get(pk=self.tags[1].pk).retry_due_at)
+        self.assertIsNotNone(ESLTag.objects.get(pk=self.tags[2].pk).retry_due_at)
+
+    def test_cancel_retries(self):
+        process_tag_failures([(self.tags[0].pk, "Timeout")])
+        self.assertEqual(cancel_retries([self.tags[0].pk]), 1)
+        tag = ESLTag.objects.get(pk=self.tags[0].pk)
+        self.assertEqual((tag.sync_state, tag.retry_due_at), ('PUSH_FAILED', None))
+
+
+class ReconnectCatchUpTest(RetryTestBase):
+    def test_dispatch_parks_tags_when_store_is_offline(self):
+        from core.tasks import dispatch_tag_image_task
+        Gateway.objects.filter(pk=self.gateway.pk).update(is_online='OFFLINE', last_heartbeat=None)
+        tag = self.tags[0]
+        tag.tag_image.name = "tags/RR0000000000.bmp"
+        ESLTag.objects.filter(pk=tag.pk).update(tag_image=tag.tag_image.name)
+
+        self.assertEqual(dispatch_tag_image_task(tag.pk), "Parked: All gateways offline")
+        self.assertEqual(ESLTag.objects.get(pk=tag.pk).sync_state, 'PARKED')
+
+    def test_heartbeat_after_offline_releases_store_once(self):
+        from core.mqtt_client import mqtt_service
+        Gateway.objects.filter(pk=self.gateway.pk).update(is_online='OFFLINE')
+        heartbeat = ["RG01", 1, "1.0", "1.0", 1, 0, 0, 0, []]
+
+        with mock.patch('core.tasks.release_store_backlog_task.delay') as release:
+            mqtt_service.handle_heartbeat("RG01", heartbeat)
+            mqtt_service.handle_heartbeat("RG01", heartbeat)  # Already online: no second release
+        release.assert_called_once_with(self.store.pk)
+        self.assertEqual(Gateway.objects.get(pk=self.gateway.pk).is_online, 'ONLINE')
+
+    def test_release_staggers_parked_tags_and_retries(self):
+        from core import retries
+        ESLTag.objects.filter(pk__in=[self.tags[0].pk, self.tags[1].pk]).update(sync_state='PARKED')
+        process_tag_failures([(t.pk, "Timeout") for t in self.tags[2:4]])
+
+        with mock.patch.object(retries, 'RELEASE_BATCH', 1), \
+             mock.patch('core.utils.trigger_bulk_sync') as sync, \
+             mock.patch('core.tasks.sweep_due_retries_task.delay') as sweep:
+            self.assertEqual(retries.release_store_backlog(self.store.pk), (2, 2))
+
+        # First parked batch rendered now, everything else one batch per minute
+        sync.assert_called_once_with([self.tags[0].pk])
+        sweep.assert_called_once()
+        now = timezone.now()
+        due = {
+            tag_id: round((due_at - now).total_seconds() / 60)
+            for tag_id, due_at in ESLTag.objects.filter(sync_state='RETRY_WAITING').values_list('id', 'retry_due_at')
+        }
+        self.assertEqual(due, {self.tags[1].pk: 1, self.tags[2].pk: 2, self.tags[3].pk: 3})
+
+
+class AdmissionControlTest(RetryTestBase):
+    def test_offline_store_is_parked_before_rendering(self):
+        from core.tasks import update_tag_image_task
+        from core.utils import trigger_bulk_sync
+        product = Product.objects.create(sku="777", name="Admission Product", price="1.00", store=self.store)
+        Gateway.objects.filter(pk=self.gateway.pk).update(is_online='OFFLINE', last_heartbeat=None)
+        ESLTag.objects.filter(pk__in=[t.pk for t in self.tags]).update(sync_state='IDLE', paired_product=product)
+
+        with mock.patch('core.tasks.render_tag_batch_task.delay') as render, \
+             mock.patch('core.tasks.update_tag_image_task.delay') as single:
+            trigger_bulk_sync([t.pk for t in self.tags])
+        render.assert_not_called()
+        single.assert_not_called()
+        self.assertEqual(ESLTag.objects.filter(sync_state='PARKED').count(), 5)
+
+        self.assertEqual(update_tag_image_task.apply(args=[self.tags[0].pk]).get(), "Deferred: All store gateways offline")
+
+    def test_snapshot_is_cached_until_reconnect(self):
+        from core import admission
+        self.assertTrue(admission.is_store_reachable(self.store.pk))
+        Gateway.objects.filter(pk=self.gateway.pk).update(is_online='OFFLINE', last_heartbeat=None)
+        with self.assertNumQueries(0):
+            self.assertTrue(admission.is_store_reachable(self.store.pk))
+
+        admission.forget_store(self.store.pk)
+        self.assertFalse(admission.is_store_reachable(self.store.pk))
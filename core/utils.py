@@ -1,12 +1,25 @@
+import collections
+import functools
+import hashlib
+import io
+import json
 import logging
 import os
 import textwrap
 import re
+import struct
+import zlib
 from django.conf import settings
+from django.core.cache import cache
 from PIL import Image, ImageDraw, ImageFont
 import barcode
 from barcode.writer import ImageWriter
 from celery import group
+from .font_metrics import get_font_metrics
+from .render_assets import assets, SALE_TEXT
+from .delivery_queue import PRIORITY_PRICE
+from .admission import admit
+from .layouts import compile_layout, SAFE_PAD, QUIET_ZONE_PX
 
 """
 SAIS UTILITIES: IMAGE RENDERING & HELPER FUNCTIONS
@@ -19,7 +32,9 @@ Key Components:
 1. FONT MANAGEMENT: Dynamic resizing to ensure text always fits the screen.
 2. TEMPLATES: Different visual layouts (Standard, Promo, Modern).
 3. BARCODE GENERATION: Creating Code128 barcodes from SKUs.
-4. TASK TRIGGERING: Helpers for mass-updating tags.
+4. RENDER CACHE: Reusing BMP bytes when the label content hasn't changed.
+5. BASE LAYER CACHE: Price-only changes redraw just the price region.
+6. TASK TRIGGERING: Helpers for mass-updating tags.
 """
 
 logger = logging.getLogger('core')
@@ -34,6 +49,14 @@ def normalize_mac(raw_mac):
         return ""
     return re.sub(r'[^0-9A-Za-z]', '', str(raw_mac)).strip().upper()
 
+def parse_version(raw_version):
+    """
+    Converts a firmware version string (e.g. '1.0.28.0') into a tuple of
+    integers for comparison. Returns None if no number can be found.
+    """
+    parts = re.findall(r'\d+', str(raw_version or ''))
+    return tuple(int(p) for p in parts) if parts else None
+
 # Module-level cache to prevent redundant font loading from disk (Performance)
 _FONT_CACHE = {}
 
@@ -47,31 +70,67 @@ class LayoutEngine:
     Provides consistent padding, font sizing, and text bounding box
     calculations across all templates and the Design Lab.
     """
-    SAFE_PAD = 8
-    QUIET_ZONE_PX = 10
+    SAFE_PAD = SAFE_PAD
+    QUIET_ZONE_PX = QUIET_ZONE_PX
+
+    MIN_FONT_SIZE = 8
 
     @staticmethod
-    def get_text_size(text, font):
-        bbox = _MEASURE_DRAW.textbbox((0, 0), text, font=font)
+    def get_text_bbox(text, font):
+        """
+        Equivalent of textbbox((0, 0), text, font). Uses the precomputed
+        glyph tables (see font_metrics.py) and only falls back to a
+        FreeType layout for glyphs outside the tables.
+        """
+        metrics = get_font_metrics(font)
+        if metrics and metrics.covers(text):
+            return metrics.bbox(text)
+        return _MEASURE_DRAW.textbbox((0, 0), text, font=font)
+
+    @classmethod
+    def get_text_size(cls, text, font):
+        bbox = cls.get_text_bbox(text, font)
         return bbox[2] - bbox[0], bbox[3] - bbox[1]
 
     @classmethod
-    def get_dynamic_font(cls, text, max_w, max_h, initial_size, font_type="bold"):
-        low = 8
-        high = initial_size
-        best_size = 8
+    def _solve_font_size(cls, measure, max_w, max_h, initial_size, font_type):
+        """
+        Returns the largest size in [MIN_FONT_SIZE, initial_size] whose
+        measured (w, h) fits inside max_w x max_h.
 
-        while low <= high:
-            mid = (low + high) // 2
-            font = get_font_by_type(mid, font_type)
-            w, h = cls.get_text_size(text, font)
+        Text extents scale linearly with the font size, so a single
+        measurement at initial_size gives a closed-form estimate. A short
+        walk of one or two sizes then corrects for hinting and rounding.
+        """
+        min_size = cls.MIN_FONT_SIZE
+
+        def fits(size):
+            w, h = measure(get_font_by_type(size, font_type))
+            return w <= max_w and h <= max_h
+
+        if initial_size <= min_size:
+            return min_size
+
+        w, h = measure(get_font_by_type(initial_size, font_type))
+        if w <= max_w and h <= max_h:
+            return initial_size
+
+        ratios = [limit / dim for limit, dim in ((max_w, w), (max_h, h)) if dim > 0]
+        size = int(initial_size * min(ratios)) if ratios else min_size
+        size = max(min_size, min(initial_size - 1, size))
 
-            if w <= max_w and h <= max_h:
-                best_size = mid
-                low = mid + 1
-            else:
-                high = mid - 1
+        while size < initial_size - 1 and fits(size + 1):
+            size += 1
+        while size > min_size and not fits(size):
+            size -= 1
+        return size
 
+    @classmethod
+    def get_dynamic_font(cls, text, max_w, max_h, initial_size, font_type="bold"):
+        best_size = cls._solve_font_size(
+            lambda font: cls.get_text_size(text, font),
+            max_w, max_h, initial_size, font_type
+        )
         return get_font_by_type(best_size, font_type)
 
     @classmethod
@@ -80,28 +139,16 @@ class LayoutEngine:
         Calculates the best font size for a block of text, ensuring
         no line exceeds max_w and the total block height exceeds max_h_total.
         """
-        low = 8
-        high = initial_size
-        best_size = 8
         longest_line = max(lines, key=len) if lines else ""
 
-        while low <= high:
-            mid = (low + high) // 2
-            font = get_font_by_type(mid, font_type)
-
+        def measure(font):
             # Width check
             w = cls.get_text_size(longest_line, font)[0]
-
             # Height check (using "Ay" for consistent line height)
             h = cls.get_text_size("Ay", font)[1]
-            total_h = (h + line_spacing) * len(lines)
-
-            if w <= max_w and total_h <= max_h_total:
-                best_size = mid
-                low = mid + 1
-            else:
-                high = mid - 1
+            return w, (h + line_spacing) * len(lines)
 
+        best_size = cls._solve_font_size(measure, max_w, max_h_total, initial_size, font_type)
         return get_font_by_type(best_size, font_type)
 
 def get_font_by_type(size, font_type="bold"):
@@ -112,15 +159,14 @@ def get_font_by_type(size, font_type="bold"):
     - 'bold': Arial Bold (Classic look)
     - 'condensed': Roboto Condensed (Fits more text)
     """
-    fname = 'Roboto_Condensed-Bold.ttf' if font_type == "condensed" else 'ArialBold.ttf'
-    font_path = os.path.join(settings.BASE_DIR, 'core', 'static', 'fonts', fname)
-
-    cache_key = (font_path, size)
-    if cache_key in _FONT_CACHE:
-        return _FONT_CACHE[cache_key]
+    cache_key = (font_type, size)
+    font = _FONT_CACHE.get(cache_key)
+    if font is not None:
+        return font
 
     try:
-        if os.path.exists(font_path):
+        font_path = assets.font_path(font_type)
+        if font_path:
             font = ImageFont.truetype(font_path, size)
             _FONT_CACHE[cache_key] = font
             return font
@@ -134,12 +180,28 @@ def get_dynamic_font_size(text, max_w, max_h, initial_size, font_type="bold"):
     """
     return LayoutEngine.get_dynamic_font(text, max_w, max_h, initial_size, font_type)
 
+# Maps a code128 module string ('1' = bar, '0' = space) straight to
+# 8-bit grayscale pixels (black/white) in one C-level pass.
+_MODULE_PIXELS = bytes.maketrans(b'01', b'\xff\x00')
+
+# Bounded LRU of rendered barcodes. SKUs rarely change, so store-wide
+# refreshes mostly hit this cache.
+BARCODE_CACHE_SIZE = 1024
+
+@functools.lru_cache(maxsize=BARCODE_CACHE_SIZE)
 def render_sharp_barcode(sku, max_w, max_h, quiet_zone_px=10):
     """
     PIXEL-PERFECT BARCODE GENERATOR
     ------------------------------
     Ensures each "bar" is an integer number of pixels to prevent
     anti-aliasing/blur on E-ink screens.
+
+    One row of modules is built as a byte string and scaled up with
+    NEAREST resampling (integer factors replicate columns and rows
+    exactly), instead of drawing one rectangle per bar.
+
+    NOTE: Results are memoized per (sku, max_w, max_h, quiet_zone_px) and
+    shared between callers; treat the returned image as read-only.
     """
     code128 = barcode.get_barcode_class('code128')
     try:
@@ -165,287 +227,419 @@ def render_sharp_barcode(sku, max_w, max_h, quiet_zone_px=10):
         barcode_w = num_modules * module_px
         total_w = barcode_w + 2 * qz
 
-        img = Image.new('RGBA', (total_w, max_h), (255, 255, 255, 255))
-        draw = ImageDraw.Draw(img)
+        # 1. One pixel per module, one row high
+        row = Image.frombytes('L', (num_modules, 1), full_code.encode('ascii').translate(_MODULE_PIXELS))
 
-        curr_x = qz
-        for char in full_code:
-            if char == '1':
-                draw.rectangle([curr_x, 0, curr_x + module_px - 1, max_h], fill=(0, 0, 0, 255))
-            curr_x += module_px
+        # 2. Replicate each module horizontally and the row vertically
+        bars = row.resize((barcode_w, max_h), Image.Resampling.NEAREST)
 
-        return img
+        img = Image.new('L', (total_w, max_h), 255)
+        img.paste(bars, (qz, 0))
+        return img.convert('RGBA')
     except Exception as e:
         logger.error(f"Sharp barcode error: {e}")
         return None
 
-def template_v1(image, draw, product, width, height, color_scheme):
-    """
-    LAYOUT: STANDARD SPLIT (V1)
-    ---------------------------
-    - Left 62%: Product Name (top) and Barcode (bottom).
-    - Right 38%: Large Price with superscript cents.
-    - Background: Yellow if on special and supported by hardware.
-    """
-    is_promo = getattr(product, 'is_on_special', False)
-    is_bw_only = 'R' not in color_scheme and 'Y' not in color_scheme
+# =================================================================
+# TEMPLATES (Static Base Layer + Dynamic Price Layer)
+# =================================================================
 
-    # 1. Colors & Background logic
-    left_bg = (255, 255, 0) if (is_promo and 'Y' in color_scheme) else (255, 255, 255)
-    if 'R' in color_scheme or 'Y' in color_scheme:
-        price_bg = (255, 0, 0) # Red/Yellow tags use a bright price box
-        price_txt_col = (255, 255, 255)
-    else:
-        price_bg = (0, 0, 0) if (is_promo and is_bw_only) else (255, 255, 255)
-        price_txt_col = (255, 255, 255) if (is_promo and is_bw_only) else (0, 0, 0)
+# Plain, hashable snapshot of the product fields a label shows.
+# 'price' is the only field drawn by the dynamic layer.
+LabelContent = collections.namedtuple('LabelContent', ['name', 'price', 'sku', 'supplier', 'is_promo'])
 
-    draw.rectangle([0, 0, width, height], fill=left_bg)
+def get_label_content(product):
+    """Snapshot of the label fields of a product (None if unpaired)."""
+    if not product:
+        return None
+    supplier = product.preferred_supplier
+    return LabelContent(
+        name=product.name,
+        price=product.price,
+        sku=product.sku,
+        supplier=supplier.abbreviation if supplier else "",
+        is_promo=bool(getattr(product, 'is_on_special', False)),
+    )
+
+def _paste_pricetag_icon(image, draw, tag_color, sale_size, x0, zone_w, top, text_color, label):
+    """Draws the pricetag icon plus 'SALE!' centred in a zone (promo banner)."""
+    try:
+        icon, sale_w = assets.sale_banner(tag_color, sale_size)
+        if icon is not None:
+            icon_w, icon_h = icon.size
+            total_w = sale_w + icon_w + 5
+            start_x = int(x0 + (zone_w - total_w) // 2)
+
+            image.paste(icon, (start_x, top), icon)
+            draw.text((start_x + icon_w + 5, top + (icon_h // 2)), SALE_TEXT, fill=text_color, font=get_font_by_type(sale_size, "bold"), anchor="lm")
+    except Exception as e:
+        logger.error(f"Error drawing pricetag icon ({label}): {e}")
 
-    # 2. Split Screen
-    split_x = int(width * 0.62)
-    safe_pad = LayoutEngine.SAFE_PAD
-    left_zone_w = split_x - (safe_pad * 2)
-    draw.rectangle([split_x, 0, width, height], fill=price_bg)
+def _v1_base(image, draw, content, plan):
+    """V1 static layer: backgrounds, name, supplier, promo banner, barcode and SKU."""
+    is_promo = content.is_promo if content else False
 
-    if not product: return
+    # 1. Backgrounds (split screen)
+    draw.rectangle([0, 0, plan.width, plan.height], fill=plan.left_bg[is_promo])
+    draw.rectangle([plan.split_x, 0, plan.width, plan.height], fill=plan.price_bg[is_promo])
 
-    # 3. BARCODE GEOMETRY (Needed for name spacing)
-    barcode_h = int(height * 0.25)
-    barcode_y = height - barcode_h - 15
+    if not content: return
 
-    # 4. DRAW PRODUCT NAME (Left Top)
-    name_text = product.name.upper()
+    # 2. DRAW PRODUCT NAME (Left Top)
+    name_text = content.name.upper()
     wrapper = textwrap.TextWrapper(width=14) # Wrap text to prevent overflow
     lines = wrapper.wrap(text=name_text)[:4] # Max 4 lines
 
     if lines:
-        curr_y = 4
-        # Calculate available height for name, ensuring an 8px gap before barcode
-        max_h_total = barcode_y - curr_y - 8
+        curr_y = plan.name_y
 
         # Performance: Use multiline binary search for speed and correctness (O(log N))
-        best_font = LayoutEngine.get_dynamic_multiline_font(lines, left_zone_w, max_h_total, 30, "condensed", line_spacing=2)
+        best_font = LayoutEngine.get_dynamic_multiline_font(lines, plan.left_zone_w, plan.name_max_h, 30, "condensed", line_spacing=2)
 
-        bbox = draw.textbbox((0, 0), "Ay", font=best_font)
-        line_height = bbox[3] - bbox[1] + 2
+        line_height = LayoutEngine.get_text_size("Ay", best_font)[1] + 2
 
         for line in lines:
-            draw.text((safe_pad, curr_y), line, fill=(0,0,0), font=best_font)
+            draw.text((plan.safe_pad, curr_y), line, fill=(0,0,0), font=best_font)
             curr_y += line_height
 
-    # 5. DRAW PRICE & SUPPLIER (Right Box)
+    # 3. SUPPLIER (Right Box, always visible at bottom)
+    price_txt_col = plan.price_color[is_promo]
+    supp_abbr = content.supplier
+    supp_font = get_dynamic_font_size(supp_abbr, plan.supplier_max_w, 20, 16, "bold")
+    draw.text(plan.supplier_anchor, supp_abbr, fill=price_txt_col, font=supp_font, anchor="mb")
+
+    if is_promo:
+        # Increased size from 18 to 26 for better visibility
+        _paste_pricetag_icon(image, draw, plan.promo_icon[is_promo], 26, plan.split_x, plan.price_zone_w, 8, price_txt_col, "V1")
+
+    # 4. DRAW BARCODE (Left Bottom)
     try:
-        price_val = float(product.price)
+        # Use pixel-perfect barcode renderer with 10px quiet zone (approx 0.85mm at 300dpi)
+        # We increase the default to 10px to meet the "quiet zone" requirement
+        b_img = render_sharp_barcode(content.sku, plan.left_zone_w, plan.barcode_h, quiet_zone_px=plan.quiet_zone)
+
+        if b_img:
+            # Center the barcode in the left zone, but ensure it doesn't spill into the left buffer
+            barcode_x = plan.safe_pad + max(0, (plan.left_zone_w - b_img.width) // 2)
+            image.paste(b_img, (barcode_x, plan.barcode_y), b_img)
+
+            display_text = f"{content.sku}"
+            s_font = get_dynamic_font_size(display_text, plan.left_zone_w, 16, 14, "condensed")
+            # Center SKU text relative to the zone
+            draw.text(plan.sku_anchor, display_text, fill=(0,0,0), font=s_font, anchor="mb")
+    except Exception as e:
+        logger.error(f"Barcode error (V1): {e}")
+
+def _v1_price(image, draw, content, plan):
+    """V1 dynamic layer: large dollars with superscript cents in the right box."""
+    if not content: return
+    price_txt_col = plan.price_color[content.is_promo]
+
+    try:
+        price_val = float(content.price)
         p_parts = f"{price_val:.2f}".split('.')
         dollars, cents = f"${p_parts[0]}", p_parts[1]
     except:
         dollars, cents = "$0", "00"
 
-    p_box_w = (width - split_x) - (safe_pad * 1)
-
-    # Calculate available height for price
-    price_h_limit = height * 0.60
-    d_font = get_dynamic_font_size(dollars + "0", p_box_w, price_h_limit, int(height * 0.65), "bold")
+    d_font = get_dynamic_font_size(dollars + "0", plan.price_max_w, plan.price_max_h, plan.price_initial_size, "bold")
 
-    d_bbox = draw.textbbox((0,0), dollars, font=d_font)
-    d_w = d_bbox[2] - d_bbox[0]
+    d_w = LayoutEngine.get_text_size(dollars, d_font)[0]
 
     # SUPERSCRIPT: Cents are 45% of the size of dollars
     c_size = int(d_font.size * 0.45)
     c_font = get_font_by_type(c_size, "bold")
-    c_w = draw.textbbox((0,0), cents, font=c_font)[2]
+    c_w = LayoutEngine.get_text_bbox(cents, c_font)[2]
     total_p_w = d_w + c_w + 2
 
-    p_x = split_x + ((width - split_x) - total_p_w) // 2
-    y_center = height // 2
-
-    # Supplier Abbreviation (Always visible at bottom)
-    supp_abbr = product.preferred_supplier.abbreviation if product.preferred_supplier else ""
-    supp_font = get_dynamic_font_size(supp_abbr, p_box_w, 20, 16, "bold")
-    draw.text((split_x + (width - split_x)//2, height - 8), supp_abbr, fill=price_txt_col, font=supp_font, anchor="mb")
-
-    if is_promo:
-        try:
-            # Color logic for V1: Use white icon if price_bg is dark (Red or Black)
-            # price_bg is (255,0,0) for color tags or (0,0,0) for BW promo
-            is_dark_bg = (price_bg == (255,0,0) or price_bg == (0,0,0))
-            tag_color = "white" if is_dark_bg else "black"
-            icon_path = os.path.join(settings.BASE_DIR, 'core', 'static', 'core', 'img', 'templates', f'pricetag-{tag_color}.png')
-
-            sale_text = "SALE!"
-            # Increased size from 18 to 26 for better visibility
-            sale_font = get_font_by_type(26, "bold")
-            sale_bbox = draw.textbbox((0, 0), sale_text, font=sale_font)
-            sale_w = sale_bbox[2] - sale_bbox[0]
-            sale_h = sale_bbox[3] - sale_bbox[1]
-
-            icon_h = int(sale_h * 1.2)
-            if os.path.exists(icon_path):
-                icon = Image.open(icon_path).convert("RGBA")
-                icon_w = int(icon.width * (icon_h / icon.height))
-                icon = icon.resize((icon_w, icon_h), Image.Resampling.LANCZOS)
-
-                total_w = sale_w + icon_w + 5
-                start_x = split_x + (width - split_x - total_w) // 2
-
-                image.paste(icon, (int(start_x), 8), icon)
-                draw.text((int(start_x + icon_w + 5), 8 + (icon_h // 2)), sale_text, fill=price_txt_col, font=sale_font, anchor="lm")
-        except Exception as e:
-            logger.error(f"Error drawing pricetag icon (V1): {e}")
+    p_x = plan.split_x + (plan.price_zone_w - total_p_w) // 2
+    y_center = plan.price_y
 
     # Draw dollars and then draw cents slightly higher
     draw.text((p_x, y_center), dollars, fill=price_txt_col, font=d_font, anchor="lm")
     draw.text((p_x + d_w + 2, (y_center) - int(d_font.size * 0.15)), cents, fill=price_txt_col, font=c_font, anchor="lm")
 
-    # 6. DRAW BARCODE (Left Bottom)
-    try:
-        # Use pixel-perfect barcode renderer with 10px quiet zone (approx 0.85mm at 300dpi)
-        # We increase the default to 10px to meet the "quiet zone" requirement
-        b_img = render_sharp_barcode(product.sku, left_zone_w, barcode_h, quiet_zone_px=LayoutEngine.QUIET_ZONE_PX)
-
-        if b_img:
-            # Center the barcode in the left zone, but ensure it doesn't spill into the left buffer
-            barcode_x = safe_pad + max(0, (left_zone_w - b_img.width) // 2)
-            image.paste(b_img, (barcode_x, barcode_y), b_img)
-
-            display_text = f"{product.sku}"
-            s_font = get_dynamic_font_size(display_text, left_zone_w, 16, 14, "condensed")
-            # Center SKU text relative to the zone
-            draw.text((safe_pad + (left_zone_w // 2), height - 2), display_text, fill=(0,0,0), font=s_font, anchor="mb")
-    except Exception as e:
-        logger.error(f"Barcode error (V1): {e}")
-
-def template_v2(image, draw, product, width, height, color_scheme):
-    """
-    LAYOUT: PROMO / LARGE PRICE (V2)
-    --------------------------------
-    Designed for maximum visibility from a distance.
-    """
-    is_promo = getattr(product, 'is_on_special', False)
-    bg_color = (255, 255, 0) if (is_promo and 'Y' in color_scheme) else (255, 255, 255)
-    draw.rectangle([0, 0, width, height], fill=bg_color)
-    if not product: return
+def _v2_base(image, draw, content, plan):
+    """V2 static layer: background, name header, supplier/SKU and 'SPECIAL' marker."""
+    is_promo = content.is_promo if content else False
+    draw.rectangle([0, 0, plan.width, plan.height], fill=plan.bg[is_promo])
+    if not content: return
 
     # Black header bar
-    draw.rectangle([0, 0, width, 25], fill=(0, 0, 0))
+    draw.rectangle([0, 0, plan.width, plan.header_h], fill=(0, 0, 0))
     name_font = get_font_by_type(14, "bold")
-    draw.text((width//2, 12), product.name.upper()[:25], fill=(255,255,255), font=name_font, anchor="mm")
-
-    # Massive Price
-    price_str = f"${product.price}"
-    price_font = get_dynamic_font_size(price_str, width - 20, height - 60, 55)
-    p_color = (255, 0, 0) if ('R' in color_scheme) else (0,0,0)
-    draw.text((width//2, height//2 + 5), price_str, fill=p_color, font=price_font, anchor="mm")
-
-    supp_abbr = product.preferred_supplier.abbreviation if product.preferred_supplier else ""
-    sku_text = f"{supp_abbr}: {product.sku}" if supp_abbr else f"{product.sku}"
-    draw.text((width - 5, height - 5), sku_text, fill=(0,0,0), font=get_font_by_type(12, "condensed"), anchor="rb")
-    if is_promo: draw.text((5, height - 5), "SPECIAL", fill=(0,0,0), font=get_font_by_type(20, "bold"), anchor="lb")
-
-def template_v3(image, draw, product, width, height, color_scheme):
-    """
-    LAYOUT: MODERN / CLEAN (V3)
-    ---------------------------
-    Uses white space and a clean vertical split.
-    Refined based on user feedback.
-    """
-    is_promo = getattr(product, 'is_on_special', False)
-    split_x = int(width * 0.45)
-    draw.rectangle([0, 0, split_x, height], fill=(255, 255, 255))
-    right_bg = (255, 255, 0) if (is_promo and 'Y' in color_scheme) else (255, 255, 255)
-    draw.rectangle([split_x, 0, width, height], fill=right_bg)
-    if not product: return
-
-    safe_pad = LayoutEngine.SAFE_PAD
-    left_zone_w = split_x - (safe_pad * 2)
-
-    # 1. DRAW BARCODE & SKU (Left Bottom First - to calculate remaining space)
-    barcode_h = int(height * 0.18)
+    draw.text(plan.name_anchor, content.name.upper()[:25], fill=(255,255,255), font=name_font, anchor="mm")
+
+    supp_abbr = content.supplier
+    sku_text = f"{supp_abbr}: {content.sku}" if supp_abbr else f"{content.sku}"
+    draw.text(plan.sku_anchor, sku_text, fill=(0,0,0), font=get_font_by_type(12, "condensed"), anchor="rb")
+    if is_promo: draw.text(plan.special_anchor, "SPECIAL", fill=(0,0,0), font=get_font_by_type(20, "bold"), anchor="lb")
+
+def _v2_price(image, draw, content, plan):
+    """V2 dynamic layer: massive centred price."""
+    if not content: return
+    price_str = f"${content.price}"
+    price_font = get_dynamic_font_size(price_str, plan.price_max_w, plan.price_max_h, 55)
+    draw.text(plan.price_anchor, price_str, fill=plan.price_color, font=price_font, anchor="mm")
+
+def _v3_base(image, draw, content, plan):
+    """V3 static layer: split backgrounds, barcode/SKU, name block and promo banner."""
+    is_promo = content.is_promo if content else False
+    draw.rectangle([0, 0, plan.split_x, plan.height], fill=(255, 255, 255))
+    draw.rectangle([plan.split_x, 0, plan.width, plan.height], fill=plan.right_bg[is_promo])
+    if not content: return
+
+    # 1. DRAW BARCODE & SKU (Left Bottom)
     try:
         # Use pixel-perfect barcode renderer with 10px quiet zone
-        b_img = render_sharp_barcode(product.sku, left_zone_w, barcode_h, quiet_zone_px=LayoutEngine.QUIET_ZONE_PX)
-
-        barcode_y = height - barcode_h - 22 # Default fallback position
+        b_img = render_sharp_barcode(content.sku, plan.left_zone_w, plan.barcode_h, quiet_zone_px=plan.quiet_zone)
 
         if b_img:
             # Center the barcode in the left zone, but ensure it doesn't spill into the left buffer
-            barcode_x = safe_pad + max(0, (left_zone_w - b_img.width) // 2)
-            barcode_y = height - barcode_h - 22 # Lifted up to give SKU label room
-            image.paste(b_img, (barcode_x, barcode_y), b_img)
+            barcode_x = plan.safe_pad + max(0, (plan.left_zone_w - b_img.width) // 2)
+            image.paste(b_img, (barcode_x, plan.barcode_y), b_img)
 
-        display_text = f"{product.sku}"
+        display_text = f"{content.sku}"
         # Increased font size for SKU bottom
-        s_font = get_dynamic_font_size(display_text, left_zone_w, 20, 18, "condensed")
+        s_font = get_dynamic_font_size(display_text, plan.left_zone_w, 20, 18, "condensed")
         # Center SKU text relative to the zone
-        draw.text((safe_pad + (left_zone_w // 2), height - 2), display_text, fill=(0,0,0), font=s_font, anchor="mb")
+        draw.text(plan.sku_anchor, display_text, fill=(0,0,0), font=s_font, anchor="mb")
     except Exception as e:
         logger.error(f"Barcode error (V3): {e}")
 
     # 2. DRAW PRODUCT NAME (Left Top/Center)
-    supp_abbr = product.preferred_supplier.abbreviation if product.preferred_supplier else ""
-    full_name_text = f"{supp_abbr}:{product.name.upper()}" if supp_abbr else product.name.upper()
+    supp_abbr = content.supplier
+    full_name_text = f"{supp_abbr}:{content.name.upper()}" if supp_abbr else content.name.upper()
 
     wrapper = textwrap.TextWrapper(width=14)
     lines = wrapper.wrap(text=full_name_text)[:4]
 
     if lines:
-        # Utilize the space from top till the barcode, with 12px safety gap
-        max_h_total = barcode_y - 12
-
         # Performance: Use multiline binary search for speed and correctness (O(log N))
-        n_font = LayoutEngine.get_dynamic_multiline_font(lines, left_zone_w, max_h_total, 28, "bold", line_spacing=2)
+        n_font = LayoutEngine.get_dynamic_multiline_font(lines, plan.left_zone_w, plan.name_max_h, 28, "bold", line_spacing=2)
 
-        bbox = draw.textbbox((0, 0), "Ay", font=n_font)
-        line_height = bbox[3] - bbox[1] + 2
+        line_height = LayoutEngine.get_text_size("Ay", n_font)[1] + 2
 
         # Center the block of text vertically in the available space
         total_text_h = line_height * len(lines)
-        curr_y = (max_h_total - total_text_h) // 2 + 5
+        curr_y = (plan.name_max_h - total_text_h) // 2 + 5
 
         for line in lines:
-            draw.text((safe_pad, curr_y), line, fill=(0,0,0), font=n_font)
+            draw.text((plan.safe_pad, curr_y), line, fill=(0,0,0), font=n_font)
             curr_y += line_height
 
     # 3. PROMO SECTION (Right Side Top)
     if is_promo:
-        try:
-            tag_color = "red" if ('R' in color_scheme or 'Y' in color_scheme) else "black"
-            icon_path = os.path.join(settings.BASE_DIR, 'core', 'static', 'core', 'img', 'templates', f'pricetag-{tag_color}.png')
+        # Increased size from 32 to 38 for better visibility
+        _paste_pricetag_icon(image, draw, plan.promo_icon, 38, plan.split_x, plan.price_zone_w, 15, plan.promo_color, "V3")
+
+def _v3_price(image, draw, content, plan):
+    """V3 dynamic layer: price on the right (lowered under the promo banner)."""
+    if not content: return
+    price_str = f"${content.price}"
+    price_font = get_dynamic_font_size(price_str, plan.price_max_w, plan.price_max_h, 65, "condensed")
+    draw.text((plan.price_x, plan.price_y[content.is_promo]), price_str, fill=plan.price_color, font=price_font, anchor="mm")
+
+# template_id -> (static base layer, dynamic price layer)
+TEMPLATE_LAYERS = {
+    1: (_v1_base, _v1_price),
+    2: (_v2_base, _v2_price),
+    3: (_v3_base, _v3_price),
+}
+
+def get_template_layers(template_id):
+    return TEMPLATE_LAYERS.get(template_id, TEMPLATE_LAYERS[1])
+
+def _draw_template(template_id, image, draw, product, width, height, color_scheme):
+    content = get_label_content(product)
+    plan = compile_layout(width, height, color_scheme, template_id)
+    base_fn, price_fn = get_template_layers(template_id)
+    base_fn(image, draw, content, plan)
+    price_fn(image, draw, content, plan)
+
+def template_v1(image, draw, product, width, height, color_scheme):
+    """
+    LAYOUT: STANDARD SPLIT (V1)
+    ---------------------------
+    - Left 62%: Product Name (top) and Barcode (bottom).
+    - Right 38%: Large Price with superscript cents.
+    - Background: Yellow if on special and supported by hardware.
+    """
+    _draw_template(1, image, draw, product, width, height, color_scheme)
+
+def template_v2(image, draw, product, width, height, color_scheme):
+    """
+    LAYOUT: PROMO / LARGE PRICE (V2)
+    --------------------------------
+    Designed for maximum visibility from a distance.
+    """
+    _draw_template(2, image, draw, product, width, height, color_scheme)
+
+def template_v3(image, draw, product, width, height, color_scheme):
+    """
+    LAYOUT: MODERN / CLEAN (V3)
+    ---------------------------
+    Uses white space and a clean vertical split.
+    Refined based on user feedback.
+    """
+    _draw_template(3, image, draw, product, width, height, color_scheme)
+
+# =================================================================
+# BASE LAYER CACHE (Price-Only Fast Path)
+# =================================================================
+
+# Most catalogue updates only change prices. The static part of a label
+# (background, name, barcode, SKU, promo banner) is therefore cached and
+# a price change only draws the price onto a copy of it.
+# - Per process: the most recent base layers as PIL images.
+# - Shared (Redis): zlib-compressed pixels, so any worker can reuse a base
+#   layer rendered by another one (e.g. during the morning price wave).
+BASE_LAYER_CACHE_SIZE = 256
+BASE_LAYER_CACHE_TIMEOUT = 60 * 60 * 24 * 7
+
+def get_base_layer(template_id, content, width, height, color_scheme):
+    """
+    Returns the cached static layer (RGB) for a label. 'content' may carry
+    any price: it is excluded from the cache key. Callers must copy() the
+    result before drawing on it.
+    """
+    base_content = content._replace(price=None) if content else None
+    return _get_base_layer(template_id, base_content, width, height, color_scheme)
 
-            sale_text = "SALE!"
-            # Increased size from 32 to 38 for better visibility
-            sale_font = get_font_by_type(38, "bold")
-            sale_bbox = draw.textbbox((0, 0), sale_text, font=sale_font)
-            sale_w = sale_bbox[2] - sale_bbox[0]
-            sale_h = sale_bbox[3] - sale_bbox[1]
+@functools.lru_cache(maxsize=BASE_LAYER_CACHE_SIZE)
+def _get_base_layer(template_id, base_content, width, height, color_scheme):
+    key_src = json.dumps([get_render_version_stamp(), template_id, base_content, width, height, color_scheme])
+    cache_key = f"esl_base_{hashlib.sha1(key_src.encode()).hexdigest()}"
 
-            icon_h = int(sale_h * 1.2)
-            if os.path.exists(icon_path):
-                icon = Image.open(icon_path).convert("RGBA")
-                icon_w = int(icon.width * (icon_h / icon.height))
-                icon = icon.resize((icon_w, icon_h), Image.Resampling.LANCZOS)
+    cached = cache.get(cache_key)
+    if cached is not None:
+        try:
+            return Image.frombytes('RGB', (width, height), zlib.decompress(cached))
+        except Exception:
+            logger.warning(f"Discarding unreadable base layer {cache_key}")
 
-                total_w = sale_w + icon_w + 5
-                start_x = split_x + (width - split_x - total_w) // 2
+    image = Image.new('RGB', (width, height), color=(255, 255, 255))
+    base_fn, _ = get_template_layers(template_id)
+    base_fn(image, ImageDraw.Draw(image), base_content, compile_layout(width, height, color_scheme, template_id))
 
-                banner_color = (255, 0, 0) if ('R' in color_scheme or 'Y' in color_scheme) else (0,0,0)
-                image.paste(icon, (start_x, 15), icon)
-                draw.text((start_x + icon_w + 5, 15 + (icon_h // 2)), sale_text, fill=banner_color, font=sale_font, anchor="lm")
-        except Exception as e:
-            logger.error(f"Error drawing pricetag icon (V3): {e}")
+    cache.set(cache_key, zlib.compress(image.tobytes(), 1), BASE_LAYER_CACHE_TIMEOUT)
+    return image
 
-    # 4. PRICE SECTION (Right Side Bottom or Center)
-    price_str = f"${product.price}"
-    price_font = get_dynamic_font_size(price_str, (width - split_x) - 10, height // 2, 65, "condensed")
+def render_label_image(inputs):
+    """
+    Renders a label from its plain render inputs (see get_render_inputs).
+    Needs no database access, so it can run in a separate process.
+    Raises on failure so callers can decide how to fall back.
+    """
+    width, height = inputs['width'], inputs['height']
+    color_scheme = inputs['color_scheme']
+    tid = inputs['template_id']
+    content = None
+    if inputs['name'] is not None:
+        content = LabelContent(
+            name=inputs['name'], price=inputs['price'], sku=inputs['sku'],
+            supplier=inputs['supplier'], is_promo=inputs['is_on_special'],
+        )
+
+    # HARDWARE-ALIGNED RENDERING (as per working sandbox code)
+    # 1. Start from the cached static layer (exact dimensions, RGB)
+    image = get_base_layer(tid, content, width, height, color_scheme).copy()
+    draw = ImageDraw.Draw(image)
+
+    # 2. Fill the price into the compiled layout
+    _, price_fn = get_template_layers(tid)
+    price_fn(image, draw, content, compile_layout(width, height, color_scheme, tid))
+
+    # 3. Map onto the panel's native colours
+    if settings.ESL_IMAGE_FORMAT == 'indexed':
+        return quantize_for_display(image, color_scheme)
+
+    # Legacy output: match user test code sequence exactly: convert("RGBA") THEN resize(..., LANCZOS)
+    image = image.convert("RGBA")
+    image = image.resize((width, height), Image.Resampling.LANCZOS)
+
+    return image
+
+def _render_esl_image(tag):
+    """
+    Renders the label for a tag that already has its 'hardware_spec' and
+    'paired_product__preferred_supplier' relations loaded.
+    """
+    return render_label_image(get_render_inputs(tag))
+
+# =================================================================
+# E-INK PALETTE OUTPUT
+# =================================================================
+
+# Native ink colours, in palette index order. Each panel type uses the
+# black/white base plus the extra inks named in its color scheme.
+ESL_INKS = {
+    'B': (0, 0, 0),
+    'W': (255, 255, 255),
+    'R': (255, 0, 0),
+    'Y': (255, 255, 0),
+}
+
+@functools.lru_cache(maxsize=None)
+def _get_palette_image(inks):
+    """Palette-only 'P' image used as the quantization target for a set of inks."""
+    palette_img = Image.new('P', (1, 1))
+    palette_img.putpalette([channel for ink in inks for channel in ESL_INKS[ink]])
+    return palette_img
+
+def quantize_for_display(image, color_scheme):
+    """
+    PALETTE QUANTIZATION
+    --------------------
+    Maps every pixel to the nearest colour the panel can physically show
+    (no dithering, so text edges stay crisp). Pillow does the mapping in
+    C over the whole buffer.
+    - BW:   Returns a 1-bit ('1') image.
+    - BWR:  Returns a 3-colour palette ('P') image.
+    - BWRY: Returns a 4-colour palette ('P') image.
+    """
+    inks = 'BW' + ''.join(ink for ink in 'RY' if ink in color_scheme)
+    indexed = image.convert('RGB').quantize(palette=_get_palette_image(inks), dither=Image.Dither.NONE)
+    if inks == 'BW':
+        return indexed.convert('1', dither=Image.Dither.NONE)
+    return indexed
 
-    p_color = (255, 0, 0) if ('R' in color_scheme or 'Y' in color_scheme) else (0,0,0)
+def encode_bmp(image):
+    """
+    Serializes a label to BMP using the smallest standard bit depth:
+    1-bit for BW, 4-bit for palettes up to 16 colours, else Pillow's default.
+    """
+    if image.mode == 'P':
+        palette = image.getpalette() or []
+        if len(palette) // 3 <= 16:
+            return _encode_bmp_4bit(image, palette)
 
-    if is_promo:
-        p_y = height - 35
-    else:
-        p_y = height // 2 # Center vertically for non-promo tags
+    buf = io.BytesIO()
+    image.save(buf, format='BMP')
+    return buf.getvalue()
 
-    draw.text((split_x + (width - split_x)//2, p_y), price_str, fill=p_color, font=price_font, anchor="mm")
+def _encode_bmp_4bit(image, palette):
+    """
+    Pillow can't write 4-bit BMPs, so we build the headers ourselves and
+    let Pillow's raw packer produce the bottom-up, 4-byte aligned rows.
+    """
+    width, height = image.size
+    colors = len(palette) // 3
+    stride = ((width * 4 + 31) // 32) * 4
+    pixels = image.tobytes('raw', ('P;4', stride, -1))
+
+    # Palette entries are stored as Blue, Green, Red, Reserved
+    color_table = b''.join(
+        bytes((palette[i + 2], palette[i + 1], palette[i], 0)) for i in range(0, colors * 3, 3)
+    )
+    offset = 14 + 40 + len(color_table)
+    file_header = struct.pack('<2sIHHI', b'BM', offset + len(pixels), 0, 0, offset)
+    info_header = struct.pack('<IiiHHIIiiII', 40, width, height, 1, 4, 0, len(pixels), 3780, 3780, colors, colors)
+    return file_header + info_header + color_table + pixels
+
+def _fallback_image():
+    """Blank 250x122 RGBA canvas used when a render fails."""
+    return Image.new('RGBA', (250, 122), color=(255, 255, 255, 255))
 
 def generate_esl_image(tag_id, tag_instance=None):
     """
@@ -461,50 +655,171 @@ def generate_esl_image(tag_id, tag_instance=None):
         else:
             tag = ESLTag.objects.select_related('hardware_spec', 'paired_product__preferred_supplier').get(pk=tag_id)
 
-        spec, product = tag.hardware_spec, tag.paired_product
-        width, height = int(spec.width_px or 250), int(spec.height_px or 122)
-        color_scheme = (spec.color_scheme or "BW").upper()
+        return _render_esl_image(tag)
+    except Exception as e:
+        logger.error(f"Critical error in generate_esl_image: {e}", exc_info=True)
+        # Return a blank image as fallback (250x122 RGBA)
+        return _fallback_image()
+
+# =================================================================
+# RENDER CACHE (Content-Addressed BMP Reuse)
+# =================================================================
 
-        # HARDWARE-ALIGNED RENDERING (as per working sandbox code)
-        # 1. Create canvas with exact dimensions in RGB mode initially
-        image = Image.new('RGB', (width, height), color=(255, 255, 255))
-        draw = ImageDraw.Draw(image)
+# Bump this whenever template geometry or drawing logic changes so that
+# previously cached renders are no longer considered valid.
+RENDER_ENGINE_VERSION = 1
 
-        # 2. Apply template
-        tid = getattr(tag, 'template_id', 1)
-        if tid == 3: template_v3(image, draw, product, width, height, color_scheme)
-        elif tid == 2: template_v2(image, draw, product, width, height, color_scheme)
-        else: template_v1(image, draw, product, width, height, color_scheme)
+# Cached BMPs live in the shared (Redis) cache for a week. Labels that
+# don't change in that time are simply re-rendered once.
+RENDER_CACHE_TIMEOUT = 60 * 60 * 24 * 7
 
-        # 3. Final alignment and resampling
-        # Match user test code sequence exactly: convert("RGBA") THEN resize(..., LANCZOS)
-        image = image.convert("RGBA")
-        image = image.resize((width, height), Image.Resampling.LANCZOS)
+_RENDER_VERSION_STAMP = None
 
-        return image
+def get_render_version_stamp():
+    """
+    Fingerprint of everything the renderer depends on besides the label
+    content: the engine version plus the bytes of every bundled font and
+    template icon. Computed once per process.
+    """
+    global _RENDER_VERSION_STAMP
+    if _RENDER_VERSION_STAMP is None:
+        digest = hashlib.sha1(f"engine:{RENDER_ENGINE_VERSION}".encode())
+        asset_dirs = [
+            os.path.join(settings.BASE_DIR, 'core', 'static', 'fonts'),
+            os.path.join(settings.BASE_DIR, 'core', 'static', 'core', 'img', 'templates'),
+        ]
+        for directory in asset_dirs:
+            if not os.path.isdir(directory): continue
+            for fname in sorted(os.listdir(directory)):
+                with open(os.path.join(directory, fname), 'rb') as f:
+                    digest.update(fname.encode())
+                    digest.update(hashlib.sha1(f.read()).digest())
+        _RENDER_VERSION_STAMP = digest.hexdigest()[:12]
+    return _RENDER_VERSION_STAMP
+
+def get_render_inputs(tag):
+    """
+    Collects every value that influences the rendered pixels of a tag
+    into a plain dictionary (product fields, template and hardware spec).
+    """
+    spec, product = tag.hardware_spec, tag.paired_product
+    supplier = product.preferred_supplier if product else None
+    return {
+        'name': product.name if product else None,
+        'price': str(product.price) if product else None,
+        'sku': product.sku if product else None,
+        'is_on_special': bool(getattr(product, 'is_on_special', False)),
+        'supplier': supplier.abbreviation if supplier else "",
+        'template_id': getattr(tag, 'template_id', 1),
+        'width': int(spec.width_px or 250),
+        'height': int(spec.height_px or 122),
+        'color_scheme': (spec.color_scheme or "BW").upper(),
+    }
+
+# Lookups needed to build render inputs straight from a .values() query
+RENDER_INPUT_VALUES = (
+    'template_id', 'hardware_spec__width_px', 'hardware_spec__height_px', 'hardware_spec__color_scheme',
+    'paired_product_id', 'paired_product__name', 'paired_product__price', 'paired_product__sku',
+    'paired_product__is_on_special', 'paired_product__preferred_supplier__abbreviation',
+)
+
+def get_render_inputs_from_values(row):
+    """Same as get_render_inputs() for a row fetched with RENDER_INPUT_VALUES."""
+    has_product = row['paired_product_id'] is not None
+    return {
+        'name': row['paired_product__name'] if has_product else None,
+        'price': str(row['paired_product__price']) if has_product else None,
+        'sku': row['paired_product__sku'] if has_product else None,
+        'is_on_special': bool(row['paired_product__is_on_special']),
+        'supplier': row['paired_product__preferred_supplier__abbreviation'] or "",
+        'template_id': row['template_id'],
+        'width': int(row['hardware_spec__width_px'] or 250),
+        'height': int(row['hardware_spec__height_px'] or 122),
+        'color_scheme': (row['hardware_spec__color_scheme'] or "BW").upper(),
+    }
+
+def hash_render_inputs(inputs):
+    """Stable hash of the render inputs plus the renderer/font version stamp."""
+    payload = dict(
+        inputs,
+        version=get_render_version_stamp(),
+        image_format=settings.ESL_IMAGE_FORMAT,
+    )
+    return hashlib.sha1(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+
+def get_render_hash(tag):
+    return hash_render_inputs(get_render_inputs(tag))
+
+def render_tag_bmp(tag):
+    """
+    CACHED RENDERER
+    ---------------
+    Returns (bmp_bytes, render_hash, cache_hit) for a tag.
+
+    Identical labels (same product fields, template and hardware spec)
+    map to the same hash, so store-wide refreshes of unchanged labels
+    skip Pillow entirely and reuse the stored bytes.
+    """
+    try:
+        render_hash = get_render_hash(tag)
+    except Exception:
+        logger.exception(f"Could not compute render hash for tag {tag.pk}")
+        render_hash = None
+
+    cache_key = f"esl_render_{render_hash}"
+    if render_hash:
+        cached = cache.get(cache_key)
+        if cached is not None:
+            return cached, render_hash, True
+
+    try:
+        image = _render_esl_image(tag)
     except Exception as e:
         logger.error(f"Critical error in generate_esl_image: {e}", exc_info=True)
-        # Return a blank image as fallback (250x122 RGBA)
-        fallback = Image.new('RGBA', (250, 122), color=(255, 255, 255, 255))
-        return fallback
+        # Never cache the fallback: a later render may succeed.
+        image, render_hash = _fallback_image(), None
+
+    bmp_bytes = encode_bmp(image)
 
-def trigger_bulk_sync(tag_ids):
+    if render_hash:
+        cache.set(cache_key, bmp_bytes, RENDER_CACHE_TIMEOUT)
+    return bmp_bytes, render_hash, False
+
+# Tags per batch render task. Groups of tags sharing a product are kept
+# together by ordering, so most groups render exactly once.
+RENDER_BATCH_SIZE = 50
+
+def trigger_bulk_sync(tag_ids, priority=PRIORITY_PRICE, is_retry=False, force=False):
     """
     TASK DISPATCHER: CELERY GROUP
     -----------------------------
     Takes a list of tag IDs and queues them all for refresh in the
-    background as a single 'Group' of tasks.
+    background as a single 'Group' of batch render tasks.
+    'priority' is the delivery lane the rendered tags are queued in
+    (see core/delivery_queue.py); 'is_retry' keeps retry counters.
+    'force' sends the images even to tags that already display them.
     """
-    from core.tasks import update_tag_image_task
+    from core.tasks import render_tag_batch_task
     from .models import ESLTag
 
-    # Filter only tags that have a product and hardware spec
-    valid_tag_ids = list(ESLTag.objects.filter(id__in=tag_ids, paired_product__isnull=False, hardware_spec__isnull=False).values_list('id', flat=True))
+    # Filter only tags that have a product and hardware spec.
+    # Ordering by the render group key keeps identical labels in the same batch.
+    valid_tags = list(ESLTag.objects.filter(
+        id__in=tag_ids, paired_product__isnull=False, hardware_spec__isnull=False
+    ).order_by('paired_product_id', 'hardware_spec_id', 'template_id').values_list('id', 'store_id'))
+
+    # Admission control: tags of stores that can't receive them are parked, not rendered
+    valid_tag_ids = admit(valid_tags)
 
     if not valid_tag_ids: return None
 
+    if force:
+        # Forget what is on the glass so delivery can't skip these tags
+        ESLTag.objects.filter(id__in=valid_tag_ids).update(displayed_image_hash=None)
+
     # Create a Celery 'Group' - this allows us to track progress of the whole batch
-    job_group = group(update_tag_image_task.s(tid) for tid in valid_tag_ids)
+    chunks = [valid_tag_ids[i:i + RENDER_BATCH_SIZE] for i in range(0, len(valid_tag_ids), RENDER_BATCH_SIZE)]
+    job_group = group(render_tag_batch_task.s(chunk, priority=priority, is_retry=is_retry) for chunk in chunks)
     result = job_group.apply_async()
     result.save() # Persist the group ID to the database so the UI can see it
     return result
@@ -364,7 +364,8 @@ def bulk_map_tags_view(request):
 
                         # Trigger an immediate hardware update for this tag
                         from .tasks import update_tag_image_task
-                        update_tag_image_task.delay(item['tag_id'])
+                        from .delivery_queue import PRIORITY_INTERACTIVE
+                        update_tag_image_task.delay(item['tag_id'], priority=PRIORITY_INTERACTIVE)
 
                 messages.success(request, f"Successfully mapped {len(proposed_data)} tags.")
                 if 'pending_bulk_maps' in request.session: del request.session['pending_bulk_maps']
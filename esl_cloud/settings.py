@@ -69,7 +69,6 @@ CELERY_TIMEZONE = 'US/Central'
 # Log Filename Logic: Creates a new log file every day (e.g., SAIS_log_20231027.log)
 texas_tz = ZoneInfo('US/Central')
 LOG_FILENAME = f"SAIS_log_{datetime.now(texas_tz).strftime('%Y%m%d')}.log"
-LOG_PATH = os.path.join(BASE_DIR, 'logs', LOG_FILENAME)
 
 class LocalTimeFormatter(logging.Formatter):
     """Custom formatter to show log timestamps in local Texas time."""
@@ -199,6 +198,9 @@ else:
         }
     }
 
+# Tests run the Redis-backed queues on an in-memory stand-in (core/testing.py)
+TEST_RUNNER = 'core.testing.TestRunner'
+
 CELERY_BROKER_URL = REDIS_URL
 CELERY_RESULT_BACKEND = 'django-db' # Save success/failure status to the DB
 CELERY_TRACK_STARTED = True
@@ -210,6 +212,10 @@ CELERY_RESULT_EXPIRES = 259200  # Results expire after 3 days to save space
 
 from celery.schedules import crontab
 
+# Heartbeat telemetry is buffered in Redis and written to the gateway table
+# this often (state changes are written immediately; see core/gateway_telemetry.py)
+GATEWAY_TELEMETRY_FLUSH_SECONDS = env.int('GATEWAY_TELEMETRY_FLUSH_SECONDS', default=30)
+
 # CELERY BEAT: The 'Task Scheduler' (like Windows Task Scheduler or Cron).
 CELERY_BEAT_SCHEDULE = {
     # Every minute: Mark gateways offline if they haven't sent a heartbeat
@@ -217,6 +223,21 @@ CELERY_BEAT_SCHEDULE = {
         'task': 'core.tasks.check_gateways_status_task',
         'schedule': crontab(minute='*'),
     },
+    # Every minute: Start the tag retries that are due (core/retries.py)
+    'sweep-due-retries-every-minute': {
+        'task': 'core.tasks.sweep_due_retries_task',
+        'schedule': crontab(minute='*'),
+    },
+    # Every GATEWAY_TELEMETRY_FLUSH_SECONDS: Write buffered heartbeat telemetry (core/gateway_telemetry.py)
+    'flush-gateway-telemetry': {
+        'task': 'core.tasks.flush_gateway_telemetry_task',
+        'schedule': GATEWAY_TELEMETRY_FLUSH_SECONDS,
+    },
+    # Every minute: Render coalesced label edits whose settle window closed (core/coalesce.py)
+    'flush-coalesced-edits-every-minute': {
+        'task': 'core.tasks.flush_coalesced_edits_task',
+        'schedule': crontab(minute='*'),
+    },
     # Daily at midnight: Purge old logs from the database and disk
     'cleanup-old-logs-daily': {
         'task': 'core.tasks.cleanup_old_logs_task',
@@ -234,12 +255,57 @@ MQTT_USER = env('MQTT_USER', default='test')
 MQTT_PASS = env('MQTT_PASS', default='123456')
 MQTT_TOPIC = "gw/+/status"
 
+# Minimum base station firmware (Gateway.ap_version, e.g. '1.0.30.0') that
+# accepts each taskESL image encoding when a gateway is set to 'AUTO'.
+# Leave empty to never auto-select an encoding (Base64 remains the default).
+ESL_PAYLOAD_MIN_AP_VERSION = {
+    'BINARY': env('ESL_BINARY_PAYLOAD_MIN_AP_VERSION', default=''),
+    'GZIP': env('ESL_GZIP_PAYLOAD_MIN_AP_VERSION', default=''),
+}
+
+# Upper bound for one batched taskESL message (see core/delivery.py).
+# Keep below the broker's max_packet_size (1 MiB in mosquitto.conf).
+ESL_MAX_PAYLOAD_BYTES = env.int('ESL_MAX_PAYLOAD_BYTES', default=900 * 1024)
+
+# Who runs the per-gateway send loops:
+# - 'celery': process_gateway_queue_task on the Celery workers (default).
+# - 'daemon': 'manage.py delivery_worker' (core/delivery_daemon.py), one asyncio
+#             loop for all gateways, optionally sharded over several processes.
+ESL_DELIVERY_MODE = env('ESL_DELIVERY_MODE', default='celery')
+
+# MQTT worker ingestion (see core/ingestion.py): incoming messages are queued
+# (bounded, oldest kept, new ones dropped when full) and handled by worker
+# threads in micro-batches collected over a short window.
+MQTT_INGEST_WORKERS = env.int('MQTT_INGEST_WORKERS', default=4)
+MQTT_INGEST_QUEUE_SIZE = env.int('MQTT_INGEST_QUEUE_SIZE', default=20000)
+MQTT_INGEST_BATCH_WINDOW_MS = env.int('MQTT_INGEST_BATCH_WINDOW_MS', default=50)
+MQTT_INGEST_MAX_BATCH = env.int('MQTT_INGEST_MAX_BATCH', default=500)
+
 # =================================================================
-# 9. LOGGING CONFIGURATION
+# 9. ESL IMAGE RENDERING
+# =================================================================
+
+# Pixel format of the BMP files pushed to tags:
+# - 'indexed': Quantized to the tag's native palette (TagHardware.color_scheme).
+#              BW -> 1-bit BMP, BWR/BWRY -> 4-bit palette BMP (~8-30x smaller).
+# - 'rgba':    Legacy 32-bit RGBA BMP.
+ESL_IMAGE_FORMAT = env('ESL_IMAGE_FORMAT', default='indexed')
+
+# Processes used by the render farm for store-wide refreshes
+# (core/render_farm.py). 0 = one per CPU core.
+RENDER_FARM_WORKERS = env.int('RENDER_FARM_WORKERS', default=0)
+
+# =================================================================
+# 10. LOGGING CONFIGURATION
 # =================================================================
 
 LOGS_DIR = os.path.join(BASE_DIR, 'logs')
+if 'test' in sys.argv:
+    # Test runs must not leave log files in the project tree
+    import tempfile
+    LOGS_DIR = tempfile.mkdtemp(prefix='sais-test-logs-')
 os.makedirs(LOGS_DIR, exist_ok=True)
+LOG_PATH = os.path.join(LOGS_DIR, LOG_FILENAME)
 
 LOGGING = {
     'version': 1,